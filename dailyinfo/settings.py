@@ -1,4 +1,5 @@
 # Django settings for dailyinfo project.
+import os
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -21,6 +22,38 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered week/day pages. Use memcached or similar if running more than one process.
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'dailyinfo-pages',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,     # some entries are culled when this is reached
+        },
+    },
+}
+
+# Cache alias used for rendered week/day pages (None to disable)
+EVENTS_PAGE_CACHE = 'pages'
+
+# Maximum number of sanitised event descriptions kept, keyed by the hash of the raw
+# description (0 to disable the cache)
+EVENTS_DESCRIPTION_CACHE_SIZE = 20000
+
+# Number of events committed per transaction when ingesting event streams
+EVENTS_INGEST_CHUNK_SIZE = 500
+
+# Number of processes used to sanitise event descriptions during ingest by management
+# commands (1 to run serially); the batch add and upload pages always run serially
+EVENTS_INGEST_WORKERS = 4
+
+# Directory containing the screenscrapers, for 'manage.py run_scrapers'
+EVENTS_SCRAPER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scrapers')
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -5,8 +5,12 @@ class OccurrenceInline(admin.TabularInline):
     model = Occurrence
     extra = 1
 
+class RecurrenceInline(admin.TabularInline):
+    model = Recurrence
+    extra = 0
+
 class EventAdmin(admin.ModelAdmin):
-    inlines = [OccurrenceInline]
+    inlines = [OccurrenceInline, RecurrenceInline]
 
 admin.site.register(Venue)
 admin.site.register(Event, EventAdmin)
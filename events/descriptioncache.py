@@ -0,0 +1,152 @@
+# Cache of processed event descriptions
+#
+# Recurring events and repeated scrapes send the same raw descriptions over and over, so
+# the result of Event.process_description (the sanitised description and its summary) is
+# stored in the CachedDescription table, keyed by a hash of the raw text, its
+# description_is_html flag and VERSION. Lookups and inserts are done a batch at a time.
+# Once there are more than settings.EVENTS_DESCRIPTION_CACHE_SIZE entries, the table is
+# cut back by removing those added first (entries aren't reordered when they are used,
+# so this is FIFO rather than LRU). Hit and miss counters are kept in memory and written
+# to the DescriptionCacheStats table in batches.
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db.models import F
+import models
+
+# Increase this when Event.process_description changes its output, so descriptions
+# processed by older code are no longer found
+VERSION = 1
+
+# Keep IN (...) lists under SQLite's limit on the number of query parameters
+QUERY_CHUNK_SIZE = 500
+
+# The table is counted after this fraction of the cache size has been added by this
+# process, and culled to leave room for as many again
+CULL_FRACTION = 10
+
+# Counters are written to the database once this many lookups have been counted
+STATS_FLUSH_INTERVAL = 100
+
+_lock = threading.Lock()
+_added = 0
+_pending = { 'hits' : 0, 'misses' : 0 }
+
+def cache_size():
+    """Returns the maximum number of cached descriptions (0 if the cache is disabled)"""
+    return getattr(settings, 'EVENTS_DESCRIPTION_CACHE_SIZE', 0) or 0
+
+def description_key(text, is_html):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1('%d:%d:' % (VERSION, 1 if is_html else 0) + text).hexdigest()
+
+def _lookup(keys):
+    found = {}
+    keys = list(keys)
+    for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+        for cached in models.CachedDescription.objects.filter(key__in=keys[i:i + QUERY_CHUNK_SIZE]):
+            found[cached.key] = (cached.description, cached.summary, cached.summary_truncated)
+    return found
+
+def _cull(size, added):
+    """
+    Called after adding entries; once enough have been added since the last check,
+    removes the oldest entries if there are more than size
+    """
+    global _added
+    margin = max(size // CULL_FRACTION, 1)
+    with _lock:
+        _added += added
+        if _added < margin:
+            return
+        _added = 0
+
+    excess = models.CachedDescription.objects.count() - size
+    if excess > 0:
+        cutoff = models.CachedDescription.objects.order_by('id').values_list('id', flat=True)[excess + margin - 1]
+        models.CachedDescription.objects.filter(id__lte=cutoff).delete()
+
+def _count(hits, misses):
+    with _lock:
+        _pending['hits'] += hits
+        _pending['misses'] += misses
+        if _pending['hits'] + _pending['misses'] < STATS_FLUSH_INTERVAL:
+            return
+    flush_stats()
+
+def flush_stats():
+    """Writes the hit and miss counts of this process to the database"""
+    with _lock:
+        hits, misses = _pending['hits'], _pending['misses']
+        _pending['hits'] = _pending['misses'] = 0
+    if hits == 0 and misses == 0:
+        return
+
+    if models.DescriptionCacheStats.objects.update(hits=F('hits') + hits, misses=F('misses') + misses) == 0:
+        models.DescriptionCacheStats.objects.create(hits=hits, misses=misses)
+
+def process_descriptions(descriptions, process=None):
+    """
+    Returns Event.process_description results for a list of (text, is_html) tuples,
+    in the same order, using cached results where possible.
+
+    process is called with the list of descriptions not found in the cache and must
+    return their results in order; by default they are processed one by one.
+    """
+    if process is None:
+        process = lambda misses: [models.Event.process_description(text, is_html) for text, is_html in misses]
+
+    size = cache_size()
+    if size <= 0 or len(descriptions) == 0:
+        return process(descriptions)
+
+    keys = [description_key(text, is_html) for text, is_html in descriptions]
+    found = _lookup(set(keys))
+
+    # Process each distinct missing description once, adding them in order
+    missing = OrderedDict()
+    for key, description in zip(keys, descriptions):
+        if key not in found and key not in missing:
+            missing[key] = description
+
+    if len(missing) > 0:
+        missing_keys = missing.keys()
+        results = process([missing[key] for key in missing_keys])
+        new = OrderedDict((key, tuple(result)) for key, result in zip(missing_keys, results))
+        models.CachedDescription.objects.bulk_create([
+            models.CachedDescription(key=key, description=result[0], summary=result[1], summary_truncated=result[2])
+            for key, result in new.items()])
+        found.update(new)
+        _cull(size, len(new))
+
+    _count(len(keys) - len(missing), len(missing))
+
+    return [found[key] for key in keys]
+
+def process_description(text, is_html):
+    """Returns the Event.process_description result for a single description, using the cache"""
+    return process_descriptions([(text, is_html)])[0]
+
+def get_stats():
+    """
+    Returns a dictionary with the number of cache hits and misses so far: those in the
+    database plus those this process hasn't written yet
+    """
+    with _lock:
+        stats = dict(_pending)
+    for row in models.DescriptionCacheStats.objects.all():
+        stats['hits'] += row.hits
+        stats['misses'] += row.misses
+    return stats
+
+def reset_stats():
+    with _lock:
+        _pending['hits'] = _pending['misses'] = 0
+    models.DescriptionCacheStats.objects.all().delete()
+
+def clear():
+    """Removes all cached descriptions"""
+    models.CachedDescription.objects.all().delete()
@@ -0,0 +1,400 @@
+# Bulk event ingest
+#
+# Adds a batch of scraped events using a fixed number of set-based queries instead of
+# several queries per event (see Event.add_from_json for the one-at-a-time version).
+from datetime import datetime
+import json
+import multiprocessing
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.encoding import force_text
+import models
+import pagecache
+import descriptioncache
+
+# Keep IN (...) lists under SQLite's limit on the number of query parameters
+QUERY_CHUNK_SIZE = 500
+
+# Batches smaller than this aren't worth starting worker processes for
+PARALLEL_MIN_EVENTS = 50
+
+def _chunks(items, size=QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _lookup_by_name(model, names):
+    """Returns a dictionary mapping names to instances of model"""
+    found = {}
+    for chunk in _chunks(set(names)):
+        for obj in model.objects.filter(name__in=chunk):
+            found[obj.name] = obj
+    return found
+
+def existing_origin_keys(keys):
+    """
+    Returns a dictionary mapping those origin keys which are already in the database to
+    the fingerprint of the stored event
+    """
+    existing = {}
+    for chunk in _chunks(set(keys)):
+        existing.update(models.Event.objects.filter(origin_key__in=chunk).values_list('origin_key', 'fingerprint'))
+    return existing
+
+def _process_description(args):
+    # Module-level so it can be pickled for worker processes
+    return models.Event.process_description(*args)
+
+def ingest_workers(workers=None):
+    """Returns the number of worker processes to use (default settings.EVENTS_INGEST_WORKERS)"""
+    if workers is None:
+        workers = getattr(settings, 'EVENTS_INGEST_WORKERS', 1)
+    return workers
+
+def process_descriptions(ev_specs, workers=None, pool=None):
+    """
+    Runs Event.process_description for each event dictionary, spreading the work over
+    a pool of worker processes (default settings.EVENTS_INGEST_WORKERS). Returns the
+    results in the same order.
+
+    pool is an optional multiprocessing.Pool of that many processes to use; otherwise
+    one is started for this call if there is enough work. Descriptions already in the
+    description cache are not processed again; only the cache misses are sent to the
+    workers.
+    """
+    workers = ingest_workers(workers)
+
+    def process(descriptions):
+        if workers <= 1 or len(descriptions) < PARALLEL_MIN_EVENTS:
+            return map(_process_description, descriptions)
+
+        chunksize = max(1, len(descriptions) // (workers * 4))
+        if pool is not None:
+            return pool.map(_process_description, descriptions, chunksize=chunksize)
+
+        new_pool = multiprocessing.Pool(workers)
+        try:
+            return new_pool.map(_process_description, descriptions, chunksize=chunksize)
+        finally:
+            new_pool.close()
+            new_pool.join()
+
+    descriptions = [(spec['description'], spec['description_is_html']) for spec in ev_specs]
+    return descriptioncache.process_descriptions(descriptions, process)
+
+def _update_events(to_update, venues, categories, processed):
+    """
+    Applies changes to existing events. to_update is a list of event dictionaries whose
+    origin keys are in the database and processed their process_description() results.
+    Returns the number of events actually changed.
+    """
+    events = {}
+    for chunk in _chunks(ev_spec['origin_key'] for ev_spec in to_update):
+        for ev in models.Event.objects.filter(origin_key__in=chunk):
+            events[ev.origin_key] = ev
+
+    occurrences = dict((ev.id, []) for ev in events.values())
+    recurrences = dict((ev.id, []) for ev in events.values())
+    for chunk in _chunks(occurrences.keys()):
+        for occ in models.Occurrence.objects.filter(event__in=chunk):
+            occurrences[occ.event_id].append(occ)
+        for rec in models.Recurrence.objects.filter(event__in=chunk):
+            recurrences[rec.event_id].append(rec)
+
+    updated = 0
+    for ev_spec, ev_processed in zip(to_update, processed):
+        ev = events[ev_spec['origin_key']]
+        if ev.update_from_json(ev_spec, venues.get(ev_spec.get('venue')), categories.get(ev_spec.get('category')),
+                               occurrences[ev.id], ev_processed, recurrences[ev.id]):
+            updated += 1
+    return updated
+
+def ingest_events(ev_specs, workers=None, pool=None):
+    """
+    Adds a list of events in the format accepted by Event.add_from_json. Raises an
+    exception if there were any errors; you probably want to run this inside a
+    transaction, itself inside pagecache.deferred_invalidation() so cached pages are
+    only invalidated once it has committed!
+
+    Descriptions are processed by the given number of worker processes, using pool if
+    given (see process_descriptions); everything else, including all database access,
+    happens in the calling process.
+
+    Returns a tuple of the number of events (added, updated, duplicate).
+    """
+    ev_specs = list(ev_specs)
+    added = 0
+    updated = 0
+    duplicates = 0
+
+    # Resolve everything we need to look up in a few queries
+    existing_keys = existing_origin_keys(spec['origin_key'] for spec in ev_specs if 'origin_key' in spec)
+    venues = _lookup_by_name(models.Venue, [spec['venue'] for spec in ev_specs if 'venue' in spec])
+    categories = _lookup_by_name(models.Category, [spec['category'] for spec in ev_specs if 'category' in spec])
+
+    new_specs = []       # specs of events to add
+    to_update = []       # specs of existing events which have changed
+    seen_keys = set()
+
+    for ev_spec in ev_specs:
+        if 'origin_key' in ev_spec:
+            # later copies of a key in the same batch are duplicates
+            if ev_spec['origin_key'] in seen_keys:
+                duplicates += 1
+                continue
+            seen_keys.add(ev_spec['origin_key'])
+
+        if 'venue' in ev_spec and ev_spec['venue'] not in venues:
+            raise Exception("Failed to add event '%s': could not find venue '%s'" % (ev_spec['name'], ev_spec['venue']))
+        if 'category' in ev_spec and ev_spec['category'] not in categories:
+            raise Exception("Failed to add event '%s': could not find category '%s'" % (ev_spec['name'], ev_spec['category']))
+
+        if ev_spec.get('origin_key') in existing_keys:
+            # Comparing fingerprints avoids sanitising descriptions which haven't changed
+            if existing_keys[ev_spec['origin_key']] == models.Event.spec_fingerprint(ev_spec):
+                duplicates += 1
+            else:
+                to_update.append(ev_spec)
+        else:
+            new_specs.append(ev_spec)
+
+    # Sanitise descriptions and generate summaries for everything in one go
+    processed = process_descriptions(new_specs + to_update, workers, pool)
+
+    keyed_events = []    # (event, spec) for events with origin keys
+    unkeyed_events = []  # (event, spec) for events without
+
+    for ev_spec, ev_processed in zip(new_specs, processed):
+        ev = models.Event.from_json(ev_spec, venues.get(ev_spec.get('venue')), categories.get(ev_spec.get('category')), ev_processed)
+
+        if 'origin_key' in ev_spec:
+            keyed_events.append((ev, ev_spec))
+        else:
+            unkeyed_events.append((ev, ev_spec))
+
+        added += 1
+
+    # bulk_create() doesn't give us primary keys, so get them back using the origin keys
+    models.Event.objects.bulk_create([ev for ev, ev_spec in keyed_events])
+    event_ids = {}
+    for chunk in _chunks(ev_spec['origin_key'] for ev, ev_spec in keyed_events):
+        event_ids.update(models.Event.objects.filter(origin_key__in=chunk).values_list('origin_key', 'id'))
+    for ev, ev_spec in keyed_events:
+        ev.id = event_ids[ev_spec['origin_key']]
+
+    # Without an origin key there's no way to identify the inserted row
+    for ev, ev_spec in unkeyed_events:
+        ev.save()
+
+    occurrences = []
+    recurrences = []
+    for ev, ev_spec in keyed_events + unkeyed_events:
+        for occ_spec in ev_spec['occurrences']:
+            occurrences.append(models.Occurrence.from_json(occ_spec, ev))
+        for rec_spec in ev_spec.get('recurrences', []):
+            recurrences.append(models.Recurrence.from_json(rec_spec, ev))
+    models.Occurrence.objects.bulk_create(occurrences)
+    if len(recurrences) > 0:
+        models.Recurrence.objects.bulk_create(recurrences)
+
+    # bulk_create() doesn't send signals, so invalidate cached pages here
+    dates = []
+    for occ in occurrences:
+        dates += pagecache.occurrence_dates(occ)
+    for rec in recurrences:
+        dates += pagecache.recurrence_dates(rec)
+    pagecache.invalidate_dates(dates)
+
+    if len(to_update) > 0:
+        changed = _update_events(to_update, venues, categories, processed[len(new_specs):])
+        updated += changed
+        duplicates += len(to_update) - changed
+
+    return (added, updated, duplicates)
+
+def validate_spec(ev_spec):
+    """
+    Checks that an event dictionary has the fields add_from_json/ingest_events need.
+    Raises ValueError describing the first problem found.
+    """
+    if not isinstance(ev_spec, dict):
+        raise ValueError("event record must be an object")
+
+    for field in ('name', 'description', 'description_is_html', 'occurrences'):
+        if field not in ev_spec:
+            raise ValueError("missing field '%s'" % field)
+
+    if not isinstance(ev_spec['occurrences'], list) or not isinstance(ev_spec.get('recurrences', []), list):
+        raise ValueError("'occurrences' and 'recurrences' must be lists")
+    if len(ev_spec['occurrences']) == 0 and len(ev_spec.get('recurrences', [])) == 0:
+        raise ValueError("event has no occurrences or recurrences")
+
+    for occ_spec in ev_spec['occurrences']:
+        if not isinstance(occ_spec, dict) or 'start_date' not in occ_spec:
+            raise ValueError("occurrence without 'start_date'")
+        if 'start_time' not in occ_spec:
+            raise ValueError("occurrence without 'start_time'")
+        for field, fmt in (('start_date', "%Y-%m-%d"), ('end_date', "%Y-%m-%d"), ('start_time', "%H:%M"), ('end_time', "%H:%M")):
+            if field in occ_spec:
+                try:
+                    datetime.strptime(occ_spec[field], fmt)
+                except (ValueError, TypeError):
+                    raise ValueError("bad %s '%s'" % (field, occ_spec[field]))
+
+    for rec_spec in ev_spec.get('recurrences', []):
+        if not isinstance(rec_spec, dict):
+            raise ValueError("recurrence must be an object")
+        if rec_spec.get('frequency') not in (models.Recurrence.DAILY, models.Recurrence.WEEKLY):
+            raise ValueError("bad recurrence frequency '%s'" % rec_spec.get('frequency'))
+        for field in ('start_date', 'end_date', 'start_time'):
+            if field not in rec_spec:
+                raise ValueError("recurrence without '%s'" % field)
+
+        dates = [('start_date', rec_spec['start_date']), ('end_date', rec_spec['end_date'])]
+        dates += [('exception', d) for d in rec_spec.get('exceptions', [])]
+        for field, value in dates:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except (ValueError, TypeError):
+                raise ValueError("bad recurrence %s '%s'" % (field, value))
+        for field in ('start_time', 'end_time'):
+            if field in rec_spec:
+                try:
+                    datetime.strptime(rec_spec[field], "%H:%M")
+                except (ValueError, TypeError):
+                    raise ValueError("bad recurrence %s '%s'" % (field, rec_spec[field]))
+
+        if rec_spec['end_date'] < rec_spec['start_date']:
+            raise ValueError("recurrence ends before it starts")
+
+def ingest_chunk(records, errors, workers=None, pool=None):
+    """
+    Ingest a list of (record number, event dictionary) in one transaction. If that fails,
+    fall back to one transaction per record so only the bad ones are lost; their errors
+    are appended to errors as (record number, message). workers and pool are passed on
+    to ingest_events.
+    """
+    try:
+        with pagecache.deferred_invalidation():
+            with transaction.commit_on_success():
+                return ingest_events((spec for record_no, spec in records), workers, pool)
+    except Exception as e:
+        if len(records) == 1:
+            errors.append((records[0][0], force_text(e)))
+            return (0, 0, 0)
+
+    added, updated, duplicates = 0, 0, 0
+    for record_no, spec in records:
+        try:
+            with pagecache.deferred_invalidation():
+                with transaction.commit_on_success():
+                    result = ingest_events([spec], workers=1)
+        except Exception as e:
+            errors.append((record_no, force_text(e)))
+            continue
+        added += result[0]
+        updated += result[1]
+        duplicates += result[2]
+
+    return (added, updated, duplicates)
+
+class Ingester(object):
+    """
+    Adds events one at a time, committing them in chunks of chunk_size (default
+    settings.EVENTS_INGEST_CHUNK_SIZE). Invalid records are skipped and recorded in
+    errors rather than aborting the rest. Descriptions are processed by workers
+    processes (see process_descriptions), started the first time a chunk is big enough
+    and kept until close().
+
+    An event identical to one already seen by this Ingester (same origin key and
+    fingerprint) is counted as a duplicate straight away. Has the add()/close() interface
+    of a scraper event sink.
+    """
+    def __init__(self, chunk_size=None, workers=None):
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'EVENTS_INGEST_CHUNK_SIZE', 500)
+        self.chunk_size = chunk_size
+        self.workers = ingest_workers(workers)
+        self.pool = None
+
+        self.added = 0
+        self.updated = 0
+        self.duplicates = 0
+        self.errors = []        # (record number, message)
+        self.records = []       # (record number, event dictionary) waiting to be committed
+        self.seen = {}          # origin key => fingerprint
+        self.count = 0
+
+    def add(self, ev_spec, record_no=None):
+        """Adds an event dictionary. record_no identifies it in errors (by default, its position)."""
+        self.count += 1
+        if record_no is None:
+            record_no = self.count
+
+        try:
+            validate_spec(ev_spec)
+        except ValueError as e:
+            self.errors.append((record_no, force_text(e)))
+            return
+
+        if 'origin_key' in ev_spec:
+            fingerprint = models.Event.spec_fingerprint(ev_spec)
+            if self.seen.get(ev_spec['origin_key']) == fingerprint:
+                self.duplicates += 1
+                return
+            self.seen[ev_spec['origin_key']] = fingerprint
+
+        self.records.append((record_no, ev_spec))
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.records) > 0:
+            if self.pool is None and self.workers > 1 and len(self.records) >= PARALLEL_MIN_EVENTS:
+                self.pool = multiprocessing.Pool(self.workers)
+
+            added, updated, duplicates = ingest_chunk(self.records, self.errors, self.workers, self.pool)
+            self.added += added
+            self.updated += updated
+            self.duplicates += duplicates
+            self.records = []
+
+    def close(self):
+        try:
+            self.flush()
+            descriptioncache.flush_stats()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+def ingest_stream(lines, chunk_size=None, workers=None):
+    """
+    Adds events from an iterable of lines, each containing one event as a JSON object
+    (blank lines are ignored). Records are validated as they are read and committed in
+    chunks of chunk_size (default settings.EVENTS_INGEST_CHUNK_SIZE); invalid records
+    are skipped rather than aborting the whole upload. workers is passed on to
+    Ingester.
+
+    Returns a tuple (added, updated, duplicate, errors) where errors is a list of
+    (line number, message).
+    """
+    ingester = Ingester(chunk_size, workers)
+
+    for line_no, line in enumerate(lines, 1):
+        if line.strip() == '':
+            continue
+
+        try:
+            ev_spec = json.loads(line)
+        except ValueError as e:
+            ingester.errors.append((line_no, force_text(e)))
+            continue
+
+        ingester.add(ev_spec, line_no)
+
+    ingester.close()
+
+    return (ingester.added, ingester.updated, ingester.duplicates, ingester.errors)
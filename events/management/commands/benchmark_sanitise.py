@@ -0,0 +1,50 @@
+from optparse import make_option
+import io
+import json
+import os
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from events import sanitise
+
+CORPUS_FILE = os.path.join(os.path.dirname(sanitise.__file__), 'testdata', 'sanitise_corpus.json')
+
+def load_descriptions(filename):
+    """Loads (description, is_html) pairs from a JSON list or a file with one JSON event per line"""
+    with io.open(filename, encoding='utf-8') as f:
+        text = f.read()
+
+    if text.lstrip().startswith('['):
+        ev_specs = json.loads(text)
+    else:
+        ev_specs = [json.loads(line) for line in text.splitlines() if line.strip() != '']
+
+    return [(spec['description'], spec.get('description_is_html', False)) for spec in ev_specs]
+
+class Command(BaseCommand):
+    args = '[<file> ...]'
+    help = ("Compares the speed of the single-pass description sanitiser with the BeautifulSoup "
+            "implementation, using scraper output files or the built-in test corpus")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of times to sanitise each description'),
+    )
+
+    def handle(self, *args, **options):
+        descriptions = []
+        for filename in (args or [CORPUS_FILE]):
+            descriptions += load_descriptions(filename)
+
+        def run(func):
+            for text, is_html in descriptions:
+                func(text, is_html)
+
+        count = len(descriptions) * options['repeat']
+        results = {}
+        for name, func in (('soup', sanitise.sanitise_html_soup), ('single-pass', sanitise.sanitise_html)):
+            results[name] = timeit.timeit(lambda: run(func), number=options['repeat'])
+            self.stdout.write("%-12s %8.3fs  %8.1f descriptions/s" % (name, results[name], count / results[name]))
+
+        self.stdout.write("speedup      %8.1fx" % (results['soup'] / results['single-pass']))
@@ -0,0 +1,45 @@
+from optparse import make_option
+import timeit
+
+from bs4 import BeautifulSoup
+from django.core.management.base import BaseCommand
+
+from events import truncate
+from events.models import Event
+
+def nested_description(depth, paragraphs, words):
+    """
+    Returns a description with the given number of paragraphs of words, wrapped in depth
+    levels of nested tags (as pasted or scraped HTML often is)
+    """
+    text = ' '.join(['word'] * words)
+    description = ''.join('<p>%s <b>%s</b></p>' % (text, text) for i in range(paragraphs))
+    for i in range(depth):
+        tag = ('div', 'span')[i % 2]
+        description = '<%s>%s</%s>' % (tag, description, tag)
+    return description
+
+class Command(BaseCommand):
+    help = ("Compares the speed of the single-pass summary truncation with the original "
+            "implementation on long nested descriptions")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Number of times to summarise each description'),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [(0, 20, 10), (10, 20, 10), (20, 100, 10), (50, 200, 10), (100, 500, 10), (100, 2000, 5)]
+
+        self.stdout.write("%5s %6s %8s %12s %12s %8s" % ('depth', 'paras', 'chars', 'original', 'single-pass', 'speedup'))
+        for depth, paragraphs, words in sizes:
+            description = nested_description(depth, paragraphs, words)
+
+            results = {}
+            for name, func in (('original', truncate.keep_first_nwords_reference), ('single-pass', truncate.keep_first_nwords)):
+                # Parse outside the timed code, as it's the same for both
+                soups = [BeautifulSoup(description, 'html.parser') for i in range(options['repeat'])]
+                results[name] = timeit.timeit(lambda: func(soups.pop(), Event.summary_words), number=options['repeat'])
+
+            self.stdout.write("%5d %6d %8d %11.4fs %11.4fs %7.1fx" % (depth, paragraphs, len(description),
+                              results['original'], results['single-pass'], results['original'] / results['single-pass']))
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from events import descriptioncache
+
+class Command(BaseCommand):
+    help = "Shows how often processed event descriptions were found in the description cache"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='Reset the counters after showing them'),
+    )
+
+    def handle(self, *args, **options):
+        if descriptioncache.cache_size() <= 0:
+            self.stdout.write("The description cache is disabled (settings.EVENTS_DESCRIPTION_CACHE_SIZE)")
+
+        stats = descriptioncache.get_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = 100.0 * stats['hits'] / total if total > 0 else 0.0
+        self.stdout.write("Hits: %d\nMisses: %d\nHit ratio: %.1f%%" % (stats['hits'], stats['misses'], ratio))
+
+        if options['reset']:
+            descriptioncache.reset_stats()
+            self.stdout.write("Counters reset")
@@ -0,0 +1,37 @@
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from events import ingest
+
+class Command(BaseCommand):
+    args = '<file> [<file> ...]'
+    help = "Adds events from files containing one JSON event record per line ('-' for stdin)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help='Number of events to commit per transaction'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of processes used to sanitise descriptions (1 to run serially)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) == 0:
+            raise CommandError("No input files specified")
+
+        for filename in args:
+            if filename == '-':
+                added, updated, duplicates, errors = ingest.ingest_stream(sys.stdin, options['chunk_size'], options['workers'])
+            else:
+                try:
+                    f = open(filename)
+                except IOError as e:
+                    raise CommandError("Could not open '%s': %s" % (filename, e))
+                with f:
+                    added, updated, duplicates, errors = ingest.ingest_stream(f, options['chunk_size'], options['workers'])
+
+            for line_no, message in errors:
+                self.stderr.write(u"%s:%d: %s" % (filename, line_no, message))
+
+            self.stdout.write("%s: %d new, %d updated, %d duplicates, %d errors" % (filename, added, updated, duplicates, len(errors)))
@@ -0,0 +1,117 @@
+from datetime import datetime
+from optparse import make_option
+import json
+import os
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+
+from events import ingest
+
+class ScraperIngester(ingest.Ingester):
+    """Ingester for events coming straight from a scraper"""
+    def add(self, ev_spec, record_no=None):
+        # Give the event the same types it would have if read from the scraper's JSON output
+        ingest.Ingester.add(self, json.loads(json.dumps(ev_spec)), record_no)
+
+class Command(BaseCommand):
+    args = '<scraper name> [<scraper name> ...]'
+    help = "Runs screenscrapers and adds the events they find to the database as they are found"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scraper-dir', dest='scraper_dir', default=None,
+                    help='Directory containing the scrapers (default settings.EVENTS_SCRAPER_DIR)'),
+        make_option('--test', '-t', action='store_true', dest='use_local', default=False,
+                    help="Use the scrapers' saved test data instead of fetching pages"),
+        make_option('--max-age', dest='max_age', default=None,
+                    help='Use pages fetched less than this long ago (e.g. 3600, 30m, 6h, 2d) without asking the server'),
+        make_option('--no-cache', action='store_true', dest='no_cache', default=False,
+                    help="Don't use or update the scrapers' fetch caches"),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help="Fetch every item's page, not just new or stale ones"),
+        make_option('--from-date', dest='from_date', default=None, help='Start of date range (YYYY-MM-DD)'),
+        make_option('--to-date', dest='to_date', default=None, help='End of date range (YYYY-MM-DD)'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help='Number of events to commit per transaction'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of processes used to sanitise descriptions (1 to run serially)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) == 0:
+            raise CommandError("No scrapers specified")
+
+        scraper_dir = options['scraper_dir'] or settings.EVENTS_SCRAPER_DIR
+        if not os.path.isdir(scraper_dir):
+            raise CommandError("Scraper directory '%s' not found" % scraper_dir)
+
+        dates = {}
+        for field in ('from_date', 'to_date'):
+            if options[field] is not None:
+                try:
+                    dates[field] = datetime.strptime(options[field], "%Y-%m-%d")
+                except ValueError:
+                    raise CommandError("Invalid date '%s'" % options[field])
+
+        # Scrapers keep their test data and fetch caches next to their source files
+        old_cwd = os.getcwd()
+        sys.path.insert(0, scraper_dir)
+        os.chdir(scraper_dir)
+        try:
+            import scraper as scraper_module
+
+            max_age = None
+            if options['max_age'] is not None:
+                try:
+                    max_age = scraper_module.parse_age(options['max_age'])
+                except Exception:
+                    raise CommandError("Invalid age '%s'" % options['max_age'])
+
+            failed = False
+            for name in args:
+                if not self.run_one(scraper_module, name, options, max_age, dates):
+                    failed = True
+        finally:
+            os.chdir(old_cwd)
+            sys.path.remove(scraper_dir)
+
+        if failed:
+            raise CommandError("Some scrapers failed")
+
+    def run_one(self, scraper_module, name, options, max_age, dates):
+        """Runs one scraper; returns whether it finished successfully"""
+        try:
+            scraper = scraper_module.load_scraper(name)
+        except IOError:
+            self.stderr.write(u"%s: could not find scraper implementation file" % name)
+            return False
+
+        scraper.use_local_data = options['use_local']
+        if max_age is not None:
+            scraper.cache_max_age = max_age
+        if options['no_cache']:
+            scraper.use_fetch_cache = False
+        scraper.full_crawl = options['full']
+
+        ingester = ScraperIngester(options['chunk_size'], options['workers'])
+        scraper.sink = ingester
+
+        # Events found before a failure are still added
+        ok = True
+        try:
+            scraper.scrape(dates.get('from_date'), dates.get('to_date'))
+        except Exception as e:
+            self.stderr.write(u"%s: scraper failed: %s" % (name, force_text(e)))
+            ok = False
+        finally:
+            scraper.close()
+
+        for record_no, message in ingester.errors:
+            self.stderr.write(u"%s: event %d: %s" % (name, record_no, message))
+
+        self.stdout.write(u"%s: %d new, %d updated, %d duplicates, %d errors (%d pages fetched)" %
+                          (name, ingester.added, ingester.updated, ingester.duplicates, len(ingester.errors),
+                           sum(scraper.fetch_counts.values())))
+        return ok
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from events.models import Occurrence
+
+class Command(BaseCommand):
+    help = "Sets the combined start and end times of occurrences used by date range queries"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--missing', action='store_true', dest='missing', default=False,
+                    help='Only process occurrences which have no start or end time'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Occurrence.objects.all()
+        if options['missing']:
+            queryset = queryset.filter(start__isnull=True) | queryset.filter(end__isnull=True)
+
+        count = 0
+        with transaction.commit_on_success():
+            for occ in queryset.iterator():
+                occ.update_interval()
+                Occurrence.objects.filter(pk=occ.pk).update(start=occ.start, end=occ.end)
+                count += 1
+
+        self.stdout.write("Updated times for %d occurrence%s" % (count, "" if count == 1 else "s"))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from events.models import Event
+
+class Command(BaseCommand):
+    help = "Regenerates the stored short descriptions of events"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--missing', action='store_true', dest='missing', default=False,
+                    help='Only process events whose summary was never generated'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Event.objects.all()
+        if options['missing']:
+            queryset = queryset.filter(summary_source='')
+
+        count = 0
+        with transaction.commit_on_success():
+            for ev in queryset.iterator():
+                ev.update_summary()
+                ev.save(update_fields=['summary', 'summary_truncated', 'summary_source'])
+                count += 1
+
+        self.stdout.write("Updated summaries for %d event%s" % (count, "" if count == 1 else "s"))
@@ -1,5 +1,6 @@
 # Miscellaneous utilities
-from datetime import date, time, timedelta
+from datetime import date, datetime, time, timedelta
+from django.utils import timezone
 
 class OrderedSetFromQuery(object):
     """
@@ -60,6 +61,25 @@ class OrderedSetFromQuery(object):
         def __repr__(self):
             return self.lst.__repr__()
 
+def local_datetime(d, t):
+    """Combines a date and a time in the current time zone into an aware datetime"""
+    value = datetime.combine(d, t)
+    if not timezone.is_naive(value):
+        return value
+    tz = timezone.get_current_timezone()
+    if hasattr(tz, 'localize'):
+        # pytz; picks one of the two times for ambiguous times when the clocks change
+        return tz.localize(value)
+    return value.replace(tzinfo=tz)
+
+def day_bounds(start_date=None, end_date=None):
+    """
+    Returns a tuple of aware datetimes for the start of start_date and the end of
+    end_date; either may be None for no limit.
+    """
+    return (local_datetime(start_date, time.min) if start_date is not None else None,
+            local_datetime(end_date, time.max) if end_date is not None else None)
+
 def date2str(d, short=True):
     """
     Return date in a human readable format.
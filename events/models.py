@@ -1,11 +1,15 @@
 from django.db import models
-from django.utils import safestring
+from django.db.models.signals import post_save, post_delete
+from django.utils import safestring, timezone
 import django.core.urlresolvers as urlresolvers
-from misc import date2str, time2str
-from datetime import datetime, date, time
-from bs4 import BeautifulSoup, NavigableString
+from misc import date2str, time2str, local_datetime, day_bounds
+from datetime import datetime, date, time, timedelta
+from bs4 import BeautifulSoup
 import queries
-import re
+import sanitise
+import truncate
+import hashlib
+import json
 
 class Venue(models.Model):
     name = models.CharField('Name', max_length=100)
@@ -13,6 +17,7 @@ class Venue(models.Model):
     website = models.URLField('Website', blank=True)
     phone = models.CharField('Phone number', max_length=50, blank=True)
     description = models.TextField('Description', blank=True)
+    last_modified = models.DateTimeField('Last modified', auto_now=True)
 
     def this_week_events(self):
         """Returns events occurring in the next 7 days (can be used from a template)"""
@@ -25,6 +30,7 @@ class Venue(models.Model):
 class Category(models.Model):
     name = models.CharField('Category name', max_length=25)
     description = models.TextField('Description', blank=True)
+    last_modified = models.DateTimeField('Last modified', auto_now=True)
 
     def __unicode__(self):
         return self.name
@@ -35,7 +41,12 @@ class Category(models.Model):
 class Event(models.Model):
     name = models.CharField('Name', max_length=100)
     description = models.TextField('Description')
+    summary = models.TextField('Summary', blank=True, editable=False)
+    summary_truncated = models.BooleanField('Summary truncated', default=False, editable=False)
+    # Hash of the description the summary was generated from (blank if it never was)
+    summary_source = models.CharField('Summary source', max_length=40, blank=True, editable=False)
     origin_key = models.CharField('Origin key', max_length=40, blank=True)
+    fingerprint = models.CharField('Fingerprint', max_length=40, blank=True, editable=False)
 
     venue = models.ForeignKey(Venue)
     category = models.ForeignKey(Category)
@@ -44,183 +55,193 @@ class Event(models.Model):
     ticket_website = models.URLField('Ticket website', blank=True)
     ticket_details = models.CharField('Ticket details', max_length=100, blank=True)
 
+    last_modified = models.DateTimeField('Last modified', auto_now=True)
+
     occurrence_range = (None, None)
+    prefetched_occurrences = None
+
+    # Recurrences loaded by QueryEvents, covering dates in recurrence_range
+    prefetched_recurrences = None
+    recurrence_range = (None, None)
+
+    # Number of words kept in the summary shown on event lists
+    summary_words = 50
+
+    # Fields compared by update_from_json
+    json_fields = ['name', 'description', 'website', 'ticket_details', 'ticket_website', 'venue_id', 'category_id']
+
+    def __init__(self, *args, **kwargs):
+        super(Event, self).__init__(*args, **kwargs)
+
+        # Description the stored summary was generated from (None if it needs regenerating).
+        # Look in __dict__ directly so deferred fields don't get loaded. An empty summary
+        # is only trusted if summary_source says it was generated; rows saved before
+        # summary_source existed have a summary but no source.
+        description = self.__dict__.get('description')
+        source = self.__dict__.get('summary_source')
+        if source:
+            summarised = description is not None and source == self.description_hash(description)
+        else:
+            summarised = bool(self.__dict__.get('summary'))
+        self._summarised_description = description if summarised else None
+
+    def save(self, *args, **kwargs):
+        if self.description != self._summarised_description:
+            self.update_summary()
+            if 'update_fields' in kwargs and kwargs['update_fields'] is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['summary', 'summary_truncated', 'summary_source']
+        super(Event, self).save(*args, **kwargs)
 
     def set_occurrence_range(self, start_date=None, end_date=None):
         self.occurrence_range = (start_date, end_date)
+        self.prefetched_occurrences = None
+
+    def in_occurrence_range(self, occ):
+        """Returns whether an occurrence overlaps the range from set_occurrence_range"""
+        range_start, range_end = day_bounds(*self.occurrence_range)
+        if range_start is not None and occ.end < range_start:
+            return False
+        if range_end is not None and occ.start > range_end:
+            return False
+        return True
 
     def occurrences_in_range(self):
         """
         Return occurrences limited to date range from set_occurrence_range (can be used from a template)
+
+        Dates generated by the event's recurrences are included as unsaved occurrences, in
+        date order. If the occurrences have been loaded by queries.PrefetchOccurrences, no
+        query is made.
         """
+        if self.prefetched_occurrences is not None:
+            return self.prefetched_occurrences
+
         queryset = Occurrence.objects.filter(event=self)
+        range_start, range_end = day_bounds(*self.occurrence_range)
+        if range_start is not None:
+            queryset = queryset.filter(end__gte=range_start)
+        if range_end is not None:
+            queryset = queryset.filter(start__lte=range_end)
+        occurrences = list(queryset)
+
+        recurrences = Recurrence.objects.filter(event=self)
         if self.occurrence_range[0] is not None:
-            queryset = queryset.filter(start_date__gte=self.occurrence_range[0])
+            recurrences = recurrences.filter(end_date__gte=self.occurrence_range[0])
         if self.occurrence_range[1] is not None:
-            queryset = queryset.filter(start_date__lte=self.occurrence_range[1])
-        return queryset
+            recurrences = recurrences.filter(start_date__lte=self.occurrence_range[1])
+        return self.add_recurrences(occurrences, recurrences)
+
+    def add_recurrences(self, occurrences, recurrences):
+        """
+        Adds the occurrences generated by recurrences within the range from
+        set_occurrence_range to a list of occurrences, and returns it in date order
+        """
+        recurrences = list(recurrences)
+        if len(recurrences) == 0:
+            return occurrences
+
+        for rec in recurrences:
+            occurrences += rec.occurrences(self.occurrence_range[0], self.occurrence_range[1], event=self)
+        occurrences.sort(key=lambda occ: (occ.start_date, occ.start_time))
+        return occurrences
 
     def description_full(self):
         return safestring.mark_safe(self.description)
 
-    def word_count(self, text):
-        if not (isinstance(text, str) or isinstance(text, NavigableString)):
-            text = text.get_text()
-        words = re.split(r'[\s]+', text)
-        return len(words)
-
-    def keep_first_nwords(self, tag, max_words):
-        if self.word_count(tag) > max_words:
-            words = 0
-
-            to_remove = []
-            for child in tag.children:
-                # If we already have too many words, queue child for destruction
-                if words >= max_words:
-                    to_remove.append(child)
-
-                # This child won't take us over our word limit, leave it alone
-                elif words + self.word_count(child) <= max_words:
-                    words += self.word_count(child)
-
-                # We need to truncate this child
-                elif isinstance(child, NavigableString):
-                    word_list = re.split(r'[\s]+', child)
-                    s = BeautifulSoup().new_string(" ".join(word_list[0:(max_words-words)]) )
-                    #print 'Truncating string %d => %d words' % (len(word_list), max_words - words)
-                    child.replace_with(s)
-                    words = max_words
-
-                else: # It's a tag
-                    #print 'Recursing into tag %s (max_words = %d)' % (str(child), max_words - words)
-                    self.keep_first_nwords(child, max_words - words)
-                    words = max_words
-
-            map(lambda x: x.extract(), to_remove)
-            return True    # tag was truncated
-        else:
-            return False
+    @staticmethod
+    def word_count(text):
+        return truncate.word_count(text)
 
-    def description_short(self):
-        # get up to 20 words
-        soup = BeautifulSoup(self.description)
-        truncated = self.keep_first_nwords(soup, 50)
+    @staticmethod
+    def keep_first_nwords(tag, max_words):
+        return truncate.keep_first_nwords(tag, max_words)
 
-        if truncated:
-            more_info_link = soup.new_tag('a', href=urlresolvers.reverse('event', kwargs = {'pk' : str(self.id)}))
-            more_info_link['class'] = 'more_info_link'
-            more_info_link.append('[...]')
-            soup.append(more_info_link)
+    @classmethod
+    def summarise(cls, description):
+        """
+        Returns the short form of a description as a tuple (HTML, whether it was truncated).
+
+        The "more info" link is not included as the event may not have an ID yet;
+        description_short() adds it if the summary was truncated.
+        """
+        soup = BeautifulSoup(description, 'html.parser')
+        truncated = cls.keep_first_nwords(soup, cls.summary_words)
 
         # get rid of paragraphs
         for p_tag in soup.findAll('p'):
             p_tag.append(' ')  # ensure paragraph ends with a space before we flatten it
             p_tag.unwrap()
 
-        return safestring.mark_safe(soup.decode(formatter='html'))
+        return (soup.decode(formatter='html'), truncated)
+
+    def update_summary(self):
+        """
+        Regenerate the short description from self.description. This is called
+        automatically by save() when the description has changed.
+        """
+        self.set_summary(*self.summarise(self.description))
+
+    def set_summary(self, summary, truncated):
+        """Store a summary of the current description generated by summarise()"""
+        self.summary = summary
+        self.summary_truncated = truncated
+        self.summary_source = self.description_hash(self.description)
+        self._summarised_description = self.description
 
     @staticmethod
-    def sanitise_html(text, is_html):
-        if not is_html:
-            # Plain text - generate HTML
-            soup = BeautifulSoup()
-            paras = text.split('\n')
-            for para in paras:
-                # Skip empty paragraphs
-                if re.search(r'\S', para) is None:
-                    continue
-                
-                tag = soup.new_tag("p")
-                
-                # Attempt to make links and add text to the tag
-                while True:
-                    mo = re.search(r'http://\S+', para)
-                    if mo is None: 
-                        # no links found - add remaining text to tag and finish
-                        tag.append(soup.new_string(para))
-                        break
-
-                    # Add text before link (if any) as string
-                    if mo.start() > 0:
-                        tag.append(soup.new_string(para[:mo.start()]))
-
-                    # Strip final punctuation off link target, if applicable
-                    if re.match(r'.*[.,;/()]$', mo.group(0)) is not None:
-                        link_href = para[ mo.start() : mo.end() - 1]
-                        para = para[ mo.end() - 1:]
-                    else:
-                        link_href = mo.group(0)
-                        para = para[ mo.end() :]
-
-                    link_tag = soup.new_tag("a", href=link_href)
-                    if len(link_href) <= 25:
-                        link_tag.append(link_href)
-                    else:
-                        link_tag.append(link_href[:22] + '...')
-                    tag.append(link_tag)
-
-                soup.append(tag)
+    def description_hash(description):
+        """Returns the value of summary_source for a summary of description"""
+        if isinstance(description, unicode):
+            description = description.encode('utf-8')
+        return hashlib.sha1(description).hexdigest()
+
+    def more_info_link(self):
+        soup = BeautifulSoup('', 'html.parser')
+        more_info_link = soup.new_tag('a', href=urlresolvers.reverse('event', kwargs = {'pk' : str(self.id)}))
+        more_info_link['class'] = 'more_info_link'
+        more_info_link.append('[...]')
+        return more_info_link.decode(formatter='html')
+
+    def description_short(self):
+        # Unsaved or not yet backfilled - generate the summary but don't store it
+        if self.description != self._summarised_description:
+            self.update_summary()
 
+        if self.summary_truncated:
+            return safestring.mark_safe(self.summary + self.more_info_link())
         else:
-            # HTML - store sanitized HTML in the database
-            blacklist = ['script', 'style']
-            whitelist = { 'a' : ['href'],
-                          'p' : None,
-                          'div' : None,
-                          'span' : None,
-                          'br' : None,
-                          'table' : None,
-                          'tr' : None,
-                          'td' : None,
-                          'th' : None,
-                          'thead' : None,
-                          'tbody' : None,
-                          'ul' : None,
-                          'ol' : None,
-                          'li' : None,
-                          'b' : None,
-                          'strong' : None,
-                          'i' : None,
-                          'em' : None,
-                          'u' : None,
-                          'strike' : None,
-                        }
-
-            soup = BeautifulSoup(text)
-
-            for tag in soup.findAll():
-                if tag.name.lower() in blacklist:
-                    # remove including all children
-                    tag.extract()
-                elif tag.name.lower() not in whitelist:
-                    # remove, retaining children
-                    tag.unwrap()
-                else:
-                    # remove disallowed attributes
-                    permitted_attrs = whitelist[tag.name.lower()]
-                    for attr in tag.attrs:
-                        if permitted_attrs is None or attr not in permitted_attrs:
-                            del tag.attrs[attr]
-
-        return soup.decode(formatter='html')
+            return safestring.mark_safe(self.summary)
+
+    @staticmethod
+    def sanitise_html(text, is_html):
+        return sanitise.sanitise_html(text, is_html)
 
     @classmethod
-    def add_from_json(cls, ev_spec):
+    def process_description(cls, text, is_html):
         """
-        Creates and saves an event from a dictionary. Raises an exception if there were any
-        errors; you probably want to run this inside a transaction!
+        Sanitises a description and generates its summary. Returns a tuple (description,
+        summary, summary truncated).
+        """
+        description = cls.sanitise_html(text, is_html)
+        summary, truncated = cls.summarise(description)
+        return (description, summary, truncated)
 
-        Returns 'added', 'duplicate' or 'updated'.
+    @classmethod
+    def from_json(cls, ev_spec, venue=None, category=None, processed=None):
         """
-        # If an origin key was specified, see if the record already exists in the DB
-        if 'origin_key' in ev_spec:
-            q = Event.objects.filter(origin_key=ev_spec['origin_key'])
-            if q.count() == 1:
-                # TODO: check for updates here
-                return 'duplicate'
+        Creates an unsaved event from a dictionary, not including its occurrences. The
+        venue and category named in the dictionary must be looked up by the caller.
 
+        processed is the result of process_description() for the event's description,
+        if the caller has already generated it; otherwise it is looked up in (or added
+        to) the description cache.
+        """
         # FIXME: assumes the uploaded JSON was a valid event description...
-        ev = cls(name=ev_spec['name'], description=cls.sanitise_html(ev_spec['description'], ev_spec['description_is_html']))
+        if processed is None:
+            processed = descriptioncache.process_description(ev_spec['description'], ev_spec['description_is_html'])
+
+        ev = cls(name=ev_spec['name'], description=processed[0])
+        ev.set_summary(processed[1], processed[2])
 
         # optional fields
         if 'origin_key' in ev_spec: ev.origin_key = ev_spec['origin_key']
@@ -228,29 +249,143 @@ class Event(models.Model):
         if 'ticket_details' in ev_spec: ev.ticket_details = ev_spec['ticket_details']
         if 'ticket_website' in ev_spec: ev.ticket_website = ev_spec['ticket_website']
 
-        # Set venue and category.
+        if venue is not None: ev.venue = venue
+        if category is not None: ev.category = category
+
+        ev.fingerprint = cls.spec_fingerprint(ev_spec)
+
+        return ev
+
+    @staticmethod
+    def spec_fingerprint(ev_spec):
+        """Returns a hash of the contents of an event dictionary, ignoring occurrence order"""
+        normalised = {}
+        for key in ('name', 'description', 'description_is_html', 'venue', 'category', 'website', 'ticket_details', 'ticket_website'):
+            normalised[key] = ev_spec.get(key)
+        normalised['occurrences'] = sorted(json.dumps(occ_spec, sort_keys=True) for occ_spec in ev_spec['occurrences'])
+        # Only present when used, so fingerprints of other events stay the same
+        if len(ev_spec.get('recurrences', [])) > 0:
+            normalised['recurrences'] = sorted(json.dumps(rec_spec, sort_keys=True) for rec_spec in ev_spec['recurrences'])
+
+        return hashlib.sha1(json.dumps(normalised, sort_keys=True)).hexdigest()
+
+    def update_from_json(self, ev_spec, venue=None, category=None, occurrences=None, processed=None, recurrences=None):
+        """
+        Updates a saved event from a dictionary, writing only the fields, occurrences and
+        recurrences which have changed. venue, category and processed are as for
+        from_json; occurrences and recurrences are the event's current lists of each, if
+        the caller has already loaded them.
+
+        Returns True if anything was changed.
+        """
+        new = Event.from_json(ev_spec, venue, category, processed)
+
+        changed_fields = []
+        for field in self.json_fields:
+            if getattr(new, field) is not None and getattr(new, field) != getattr(self, field):
+                setattr(self, field, getattr(new, field))
+                changed_fields.append(field)
+
+        if 'description' in changed_fields and new._summarised_description == new.description:
+            self.set_summary(new.summary, new.summary_truncated)
+            changed_fields += ['summary', 'summary_truncated', 'summary_source']
+
+        # Occurrences are matched on all their fields; changed ones are replaced
+        def occurrence_key(occ):
+            return (occ.start_date, occ.start_time, occ.end_date, occ.end_time)
+
+        if occurrences is None:
+            occurrences = list(self.occurrence_set.all())
+        old_keys = set(occurrence_key(occ) for occ in occurrences)
+
+        new_occurrences = []
+        new_keys = set()
+        for occ_spec in ev_spec['occurrences']:
+            occ = Occurrence.from_json(occ_spec, self)
+            if occurrence_key(occ) not in old_keys and occurrence_key(occ) not in new_keys:
+                new_occurrences.append(occ)
+            new_keys.add(occurrence_key(occ))
+        removed_occurrences = [occ.id for occ in occurrences if occurrence_key(occ) not in new_keys]
+
+        if recurrences is None:
+            recurrences = list(self.recurrence_set.all())
+        old_keys = set(rec.key() for rec in recurrences)
+
+        new_recurrences = []
+        new_keys = set()
+        for rec_spec in ev_spec.get('recurrences', []):
+            rec = Recurrence.from_json(rec_spec, self)
+            if rec.key() not in old_keys and rec.key() not in new_keys:
+                new_recurrences.append(rec)
+            new_keys.add(rec.key())
+        removed_recurrences = [rec.id for rec in recurrences if rec.key() not in new_keys]
+
+        self.fingerprint = new.fingerprint
+        if len(changed_fields) > 0:
+            self.save(update_fields=changed_fields + ['fingerprint', 'last_modified'])
+        else:
+            Event.objects.filter(pk=self.pk).update(fingerprint=self.fingerprint)
+
+        if len(removed_occurrences) > 0:
+            Occurrence.objects.filter(id__in=removed_occurrences).delete()
+        for occ in new_occurrences:
+            occ.save()
+
+        if len(removed_recurrences) > 0:
+            Recurrence.objects.filter(id__in=removed_recurrences).delete()
+        for rec in new_recurrences:
+            rec.save()
+
+        return (len(changed_fields) > 0 or len(removed_occurrences) > 0 or len(new_occurrences) > 0 or
+                len(removed_recurrences) > 0 or len(new_recurrences) > 0)
+
+    @classmethod
+    def add_from_json(cls, ev_spec):
+        """
+        Creates and saves an event from a dictionary. Raises an exception if there were any
+        errors; you probably want to run this inside a transaction!
+
+        Returns 'added', 'duplicate' or 'updated'.
+        """
+        # If an origin key was specified, see if the record already exists in the DB
+        existing = None
+        if 'origin_key' in ev_spec:
+            q = list(Event.objects.filter(origin_key=ev_spec['origin_key'])[:2])
+            if len(q) == 1:
+                existing = q[0]
+                if existing.fingerprint == cls.spec_fingerprint(ev_spec):
+                    return 'duplicate'
+
+        venue = None
+        category = None
+
+        # Look up venue and category.
         if 'venue' in ev_spec:
             try:
-                ev.venue = Venue.objects.get(name=ev_spec['venue'])
+                venue = Venue.objects.get(name=ev_spec['venue'])
             except:
                 raise Exception("Failed to add event '%s': could not find venue '%s'" % (ev_spec['name'], ev_spec['venue']))
 
         if 'category' in ev_spec:
             try:
-                ev.category = Category.objects.get(name=ev_spec['category'])
+                category = Category.objects.get(name=ev_spec['category'])
             except:
-                return Exception("Failed to add event '%s': could not find category '%s'" % (ev_spec['name'], ev_spec['category']))
+                raise Exception("Failed to add event '%s': could not find category '%s'" % (ev_spec['name'], ev_spec['category']))
+
+        if existing is not None:
+            if existing.update_from_json(ev_spec, venue, category):
+                return 'updated'
+            else:
+                return 'duplicate'
 
+        ev = cls.from_json(ev_spec, venue, category)
         ev.save()
 
         # Process occurrences
         for occ_spec in ev_spec['occurrences']:
-            occ = Occurrence()
-            occ.start_date = datetime.strptime(occ_spec['start_date'], "%Y-%m-%d").date()
-            if 'start_time' in occ_spec: occ.start_time = datetime.strptime(occ_spec['start_time'], "%H:%M").time()
-            if 'end_date' in occ_spec: occ.end_date = datetime.strptime(occ_spec['end_date'], "%Y-%m-%d").date()
-            if 'end_time' in occ_spec: occ.end_time = datetime.strptime(occ_spec['end_time'], "%H:%M").time()
-            ev.occurrence_set.add(occ)
+            ev.occurrence_set.add(Occurrence.from_json(occ_spec))
+        for rec_spec in ev_spec.get('recurrences', []):
+            ev.recurrence_set.add(Recurrence.from_json(rec_spec))
 
         return 'added'
 
@@ -264,6 +399,54 @@ class Occurrence(models.Model):
     end_date = models.DateField('End date', null=True, blank=True)
     end_time = models.TimeField('End time', null=True, blank=True)
 
+    # When the occurrence starts and finishes, for overlap queries; set from the fields
+    # above by save() (see update_interval)
+    start = models.DateTimeField('Start', null=True, editable=False)
+    end = models.DateTimeField('End', null=True, editable=False, db_index=True)
+
+    def save(self, *args, **kwargs):
+        self.update_interval()
+        if 'update_fields' in kwargs and kwargs['update_fields'] is not None:
+            kwargs['update_fields'] = list(kwargs['update_fields']) + ['start', 'end']
+        super(Occurrence, self).save(*args, **kwargs)
+
+    def last_date(self):
+        """Returns the date the occurrence finishes on"""
+        if self.end_date is not None:
+            return self.end_date
+        if self.end_time is not None and self.start_time is not None and self.end_time < self.start_time:
+            return self.start_date + timedelta(days=1)     # finishes after midnight
+        return self.start_date
+
+    def update_interval(self):
+        """
+        Sets start and end from the date and time fields. Without an end time, an
+        occurrence with an end date lasts until the end of that day and one without is
+        just the start time.
+        """
+        if self.start_date is None or self.start_time is None:
+            return
+
+        self.start = local_datetime(self.start_date, self.start_time)
+        if self.end_time is not None:
+            self.end = local_datetime(self.last_date(), self.end_time)
+        elif self.end_date is not None:
+            self.end = local_datetime(self.end_date, time.max)
+        else:
+            self.end = self.start
+
+    @classmethod
+    def from_json(cls, occ_spec, event=None):
+        """Creates an unsaved occurrence from a dictionary"""
+        occ = cls()
+        if event is not None: occ.event = event
+        occ.start_date = datetime.strptime(occ_spec['start_date'], "%Y-%m-%d").date()
+        if 'start_time' in occ_spec: occ.start_time = datetime.strptime(occ_spec['start_time'], "%H:%M").time()
+        if 'end_date' in occ_spec: occ.end_date = datetime.strptime(occ_spec['end_date'], "%Y-%m-%d").date()
+        if 'end_time' in occ_spec: occ.end_time = datetime.strptime(occ_spec['end_time'], "%H:%M").time()
+        occ.update_interval()   # bulk_create() doesn't call save()
+        return occ
+
     def is_past(self):
         """
         Work out whether an occurrence is in the past (can be called from a template)
@@ -309,4 +492,143 @@ class Occurrence(models.Model):
         return self.to_string(short=True)
 
     class Meta:
-        ordering = ['start_date', 'start_time']
\ No newline at end of file
+        ordering = ['start_date', 'start_time']
+        # Overlap queries scan start up to the end of the range and check end from the index
+        index_together = [['start', 'end']]
+
+class Recurrence(models.Model):
+    """
+    An event happening every day or every week from start_date to end_date (on the
+    weekday of start_date), apart from the dates listed in exceptions. The dates are
+    worked out when needed, for the range being shown, rather than stored.
+    """
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    FREQUENCY_CHOICES = ((DAILY, 'Daily'), (WEEKLY, 'Weekly'))
+
+    event = models.ForeignKey(Event)
+    frequency = models.CharField('Frequency', max_length=10, choices=FREQUENCY_CHOICES, default=DAILY)
+    start_date = models.DateField('Start date')
+    end_date = models.DateField('End date')
+    start_time = models.TimeField('Start time')
+    end_time = models.TimeField('End time', null=True, blank=True)
+    exceptions = models.TextField('Exceptions', blank=True, help_text='Dates without an occurrence, as YYYY-MM-DD separated by commas')
+
+    @classmethod
+    def from_json(cls, rec_spec, event=None):
+        """Creates an unsaved recurrence from a dictionary"""
+        rec = cls()
+        if event is not None: rec.event = event
+        rec.frequency = rec_spec['frequency']
+        rec.start_date = datetime.strptime(rec_spec['start_date'], "%Y-%m-%d").date()
+        rec.end_date = datetime.strptime(rec_spec['end_date'], "%Y-%m-%d").date()
+        rec.start_time = datetime.strptime(rec_spec['start_time'], "%H:%M").time()
+        if 'end_time' in rec_spec: rec.end_time = datetime.strptime(rec_spec['end_time'], "%H:%M").time()
+        rec.exceptions = ','.join(sorted(set(rec_spec.get('exceptions', []))))
+        return rec
+
+    def key(self):
+        """Returns a tuple of the fields which define the recurrence, for comparisons"""
+        return (self.frequency, self.start_date, self.end_date, self.start_time, self.end_time, self.exceptions)
+
+    def exception_dates(self):
+        return set(datetime.strptime(d, "%Y-%m-%d").date() for d in self.exceptions.split(',') if d.strip() != '')
+
+    def dates(self, start_date=None, end_date=None, reverse=False):
+        """
+        Generates the dates of the recurrence from start_date to end_date (inclusive; None
+        for no limit), latest first if reverse is set. Only the dates in the range are
+        looked at.
+        """
+        step = 7 if self.frequency == self.WEEKLY else 1
+        first = self.start_date
+        if start_date is not None and start_date > first:
+            # round up to the next date of the recurrence
+            first += timedelta(days=-(-(start_date - first).days // step) * step)
+        last = self.end_date
+        if end_date is not None and end_date < last:
+            last = end_date
+
+        if first > last:
+            return
+        exceptions = self.exception_dates()
+
+        if reverse:
+            d = first + timedelta(days=(last - first).days // step * step)
+            while d >= first:
+                if d not in exceptions:
+                    yield d
+                d -= timedelta(days=step)
+        else:
+            d = first
+            while d <= last:
+                if d not in exceptions:
+                    yield d
+                d += timedelta(days=step)
+
+    def first_date(self, start_date=None, end_date=None, reverse=False):
+        """Returns the first (or with reverse, last) date of the recurrence in a range, or None"""
+        for d in self.dates(start_date, end_date, reverse):
+            return d
+        return None
+
+    def occurrences(self, start_date=None, end_date=None, event=None):
+        """Returns a list of unsaved occurrences for the dates in a range"""
+        if event is None:
+            event = self.event
+        occurrences = []
+        for d in self.dates(start_date, end_date):
+            occ = Occurrence(event=event, start_date=d, start_time=self.start_time, end_time=self.end_time)
+            occ.update_interval()
+            occurrences.append(occ)
+        return occurrences
+
+    def long_string(self):
+        return self.to_string(short=False)
+
+    def to_string(self, short=True):
+        ret = time2str(self.start_time)
+        if self.end_time is not None:
+            ret += " - " + time2str(self.end_time)
+
+        if self.frequency == self.WEEKLY:
+            ret += " every {0:%A}".format(self.start_date)
+        else:
+            ret += " daily"
+        ret += ", " + date2str(self.start_date, short=short) + " - " + date2str(self.end_date, short=short)
+
+        exceptions = sorted(self.exception_dates())
+        if len(exceptions) > 0:
+            ret += " (not " + ", ".join(date2str(d, short=short) for d in exceptions) + ")"
+        return ret
+
+    def __unicode__(self):
+        return self.to_string(short=True)
+
+    class Meta:
+        ordering = ['start_date', 'start_time']
+
+def occurrence_changed(sender, instance, **kwargs):
+    """Occurrences are part of their event, so update its modification time"""
+    Event.objects.filter(pk=instance.event_id).update(last_modified=timezone.now())
+
+for model in (Occurrence, Recurrence):
+    post_save.connect(occurrence_changed, sender=model)
+    post_delete.connect(occurrence_changed, sender=model)
+
+class CachedDescription(models.Model):
+    """Result of Event.process_description for a raw description (see descriptioncache)"""
+    key = models.CharField('Key', max_length=40, db_index=True)
+    description = models.TextField('Description')
+    summary = models.TextField('Summary', blank=True)
+    summary_truncated = models.BooleanField('Summary truncated', default=False)
+
+class DescriptionCacheStats(models.Model):
+    """Hit and miss counters for the description cache (a single row)"""
+    hits = models.IntegerField('Hits', default=0)
+    misses = models.IntegerField('Misses', default=0)
+
+# Connect page cache invalidation signal handlers
+import pagecache
+
+import descriptioncache
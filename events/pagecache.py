@@ -0,0 +1,210 @@
+# Cache of rendered week/day pages
+#
+# Each date has a version token stored in the cache. A cached page's key includes the
+# tokens of every date in its window, so changing an occurrence only needs to replace
+# the tokens for the dates it touches; pages for other windows stay cached and stale
+# pages are never looked up again (the cache backend evicts them eventually).
+from contextlib import contextmanager
+from datetime import date, timedelta
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_init, post_save, post_delete
+from django.http import HttpResponse
+import models
+
+_caches = {}
+
+def get_page_cache():
+    """Returns the cache backend for rendered pages, or None if page caching is disabled"""
+    alias = getattr(settings, 'EVENTS_PAGE_CACHE', None)
+    if alias is None:
+        return None
+    if alias not in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+def _new_token():
+    return uuid.uuid4().hex[:12]
+
+def _date_key(d):
+    return 'events.date.{0:%Y-%m-%d}'.format(d)
+
+_GLOBAL_KEY = 'events.global'
+
+def _get_tokens(cache, keys):
+    """Get version tokens for keys, creating fresh tokens for any that are missing"""
+    tokens = cache.get_many(keys)
+    missing = dict((key, _new_token()) for key in keys if key not in tokens)
+    if len(missing) > 0:
+        cache.set_many(missing)
+        tokens.update(missing)
+    return [tokens[key] for key in keys]
+
+def page_key(view_name, start_date, days, categories=None):
+    """
+    Returns the cache key for a page showing the given dates and set of category IDs
+    (None for all categories), or None if page caching is disabled.
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return None
+
+    if categories is None:
+        categories = 'all'
+    else:
+        categories = ','.join(str(cat) for cat in sorted(set(categories)))
+
+    # Include today's date as pages show relative dates ("Tomorrow" etc.)
+    keys = [_GLOBAL_KEY] + [_date_key(start_date + timedelta(days=i)) for i in range(days)]
+    parts = [view_name, '{0:%Y-%m-%d}'.format(start_date), categories, '{0:%Y-%m-%d}'.format(date.today())]
+    parts += _get_tokens(cache, keys)
+
+    return 'events.page.' + hashlib.md5('|'.join(parts)).hexdigest()
+
+def get_page(key):
+    """Returns the cached response for key, or None"""
+    cache = get_page_cache()
+    if cache is None or key is None:
+        return None
+
+    cached = cache.get(key)
+    if cached is None:
+        return None
+
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+def set_page(key, response):
+    """Store a rendered response under key"""
+    cache = get_page_cache()
+    if cache is None or key is None:
+        return
+
+    cache.set(key, (response.content, response['Content-Type']))
+
+_deferred = threading.local()
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Context manager which collects the dates invalidated inside it and invalidates them
+    on exit. Wrap it around a transaction so pages are invalidated after the commit;
+    otherwise a request between the invalidation and the commit could cache the old
+    events again under the new tokens. Nested uses invalidate when the outermost exits.
+    """
+    if getattr(_deferred, 'dates', None) is not None:
+        yield
+        return
+
+    _deferred.dates = []
+    try:
+        yield
+    finally:
+        dates, _deferred.dates = _deferred.dates, None
+        invalidate_dates(dates)
+
+def invalidate_dates(dates):
+    """
+    Invalidate cached pages covering any of the given dates (on leaving
+    deferred_invalidation, if inside it)
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return
+
+    if getattr(_deferred, 'dates', None) is not None:
+        _deferred.dates.extend(dates)
+        return
+
+    tokens = dict((_date_key(d), _new_token()) for d in set(dates))
+    if len(tokens) > 0:
+        cache.set_many(tokens)
+
+def invalidate_all():
+    """Invalidate all cached pages"""
+    cache = get_page_cache()
+    if cache is None:
+        return
+
+    cache.set(_GLOBAL_KEY, _new_token())
+
+def occurrence_range(occ):
+    """Returns a tuple of the first and last dates an occurrence appears on, or None"""
+    if occ.start_date is None:
+        return None
+    return (occ.start_date, max(occ.last_date(), occ.start_date))
+
+def range_dates(date_range):
+    """Returns the dates from the first to the last date of a tuple returned by occurrence_range()"""
+    if date_range is None:
+        return []
+    first_date, last_date = date_range
+    return [first_date + timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+
+def occurrence_dates(occ):
+    """Returns the dates an occurrence appears on"""
+    return range_dates(occurrence_range(occ))
+
+def recurrence_dates(rec):
+    """Returns the dates a recurrence appears on"""
+    if rec.start_date is None or rec.end_date is None:
+        return []
+    return list(rec.dates())
+
+# Signal handlers
+
+def occurrence_loaded(sender, instance, **kwargs):
+    # Remember the original date range so moving an occurrence invalidates both windows.
+    # Its dates are only worked out if it is saved or deleted.
+    instance._cached_range = occurrence_range(instance)
+
+def occurrence_changed(sender, instance, **kwargs):
+    old_range = getattr(instance, '_cached_range', None)
+    new_range = occurrence_range(instance)
+    dates = range_dates(new_range)
+    if old_range != new_range:
+        dates += range_dates(old_range)
+    invalidate_dates(dates)
+    instance._cached_range = new_range
+
+def recurrence_loaded(sender, instance, **kwargs):
+    # Keep the original rule rather than its dates, which are only needed if it changes
+    instance._cached_rule = (instance.frequency, instance.start_date, instance.end_date, instance.exceptions)
+
+def recurrence_changed(sender, instance, **kwargs):
+    dates = recurrence_dates(instance)
+    if getattr(instance, '_cached_rule', None) is not None:
+        frequency, start_date, end_date, exceptions = instance._cached_rule
+        dates += recurrence_dates(models.Recurrence(frequency=frequency, start_date=start_date, end_date=end_date, exceptions=exceptions))
+    invalidate_dates(dates)
+    instance._cached_rule = (instance.frequency, instance.start_date, instance.end_date, instance.exceptions)
+
+def event_changed(sender, instance, created=False, raw=False, **kwargs):
+    # New events have no occurrences yet; they invalidate pages as occurrences are added
+    if created or raw:
+        return
+
+    dates = []
+    for occ in models.Occurrence.objects.filter(event=instance).only('start_date', 'start_time', 'end_date', 'end_time'):
+        dates += occurrence_dates(occ)
+    for rec in models.Recurrence.objects.filter(event=instance):
+        dates += recurrence_dates(rec)
+    invalidate_dates(dates)
+
+def venue_or_category_changed(sender, **kwargs):
+    invalidate_all()
+
+post_init.connect(occurrence_loaded, sender=models.Occurrence)
+post_save.connect(occurrence_changed, sender=models.Occurrence)
+post_delete.connect(occurrence_changed, sender=models.Occurrence)
+post_init.connect(recurrence_loaded, sender=models.Recurrence)
+post_save.connect(recurrence_changed, sender=models.Recurrence)
+post_delete.connect(recurrence_changed, sender=models.Recurrence)
+post_save.connect(event_changed, sender=models.Event)
+for model in (models.Venue, models.Category):
+    post_save.connect(venue_or_category_changed, sender=model)
+    post_delete.connect(venue_or_category_changed, sender=model)
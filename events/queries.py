@@ -1,6 +1,8 @@
 from datetime import date, timedelta
+from django.db.models import Min, Max, Count, Q
+from django.utils import timezone
 import models
-from misc import OrderedSetFromQuery
+from misc import OrderedSetFromQuery, day_bounds, local_datetime
 
 def QueryEvents(**kwargs):
     """
@@ -10,6 +12,238 @@ def QueryEvents(**kwargs):
       end_date     stop searching at this date
       reverse      reverse sort order and sort by last occurrence
       categories   only return results matching one of of these category IDs
+      ordered_set  if True, use the old OrderedSetFromQuery implementation
+                   (which ignores recurrences)
+
+    Returns an EventQuery with one entry per event; the start of the first (or last)
+    matching occurrence is set as occurrence_start, and its local date and time as
+    occurrence_date and occurrence_time. Events matching by their
+    occurrences are grouped in the database, so slicing the result adds a LIMIT/OFFSET
+    clause to the query. The venue and category of each event are loaded by the same
+    query. Events matching by a recurrence are found by one more query.
+    """
+    if kwargs.get('ordered_set', False):
+        return QueryEventsOrderedSet(**kwargs)
+
+    recurrences = _filter_recurrences(models.Recurrence.objects.select_related('event__venue', 'event__category'), kwargs)
+    return EventQuery(_query_occurrence_events(kwargs), recurrences, kwargs.get('start_date'), kwargs.get('end_date'),
+                      kwargs.get('reverse', False))
+
+def _query_occurrence_events(kwargs):
+    """QuerySet for QueryEvents of the events matching by their occurrences"""
+    queryset = _filter_events(models.Event.objects.select_related('venue', 'category'), kwargs, recurrences=False)
+
+    # Aggregate the combined start rather than the date and time separately, which
+    # would pair the date of one occurrence with the time of another
+    if kwargs.get('reverse', False):
+        queryset = queryset.annotate(occurrence_start = Max('occurrence__start'))
+        queryset = queryset.order_by('-occurrence_start', '-id')
+    else:
+        queryset = queryset.annotate(occurrence_start = Min('occurrence__start'))
+        queryset = queryset.order_by('occurrence_start', 'id')
+
+    return queryset
+
+def _filter_events(queryset, kwargs, recurrences=True):
+    """
+    Apply the venue, date and category arguments of QueryEvents to an event queryset.
+    Events match the dates if they have an occurrence overlapping the range (so events
+    which started earlier and are still going on are included) or, if recurrences is
+    set, a recurrence with a date in it.
+
+    Without recurrences the occurrences are joined, so annotations can aggregate over
+    the matching ones. With them, the IDs of events matching by a recurrence are found
+    by a separate query and the occurrences are matched in a subquery, so both are
+    looked up by ID rather than outer joined against every event.
+    """
+    if 'venue' in kwargs:
+        queryset = queryset.filter(venue = kwargs['venue'])
+
+    # Date conditions go in a single filter() so they apply to the same occurrence,
+    # which is also the join that any later annotations aggregate over. Both are
+    # answered from the (start, end) index.
+    range_start, range_end = day_bounds(kwargs.get('start_date'), kwargs.get('end_date'))
+    occurrence_filter = {}
+    if range_start is not None:
+        occurrence_filter['end__gte'] = range_start
+    if range_end is not None:
+        occurrence_filter['start__lte'] = range_end
+    if len(occurrence_filter) > 0:
+        if recurrences:
+            condition = Q(id__in = models.Occurrence.objects.filter(**occurrence_filter).values('event'))
+            recurring = models.Recurrence.objects.filter(recurrence_filter(kwargs.get('start_date'),
+                                                                           kwargs.get('end_date')))
+            recurring_ids = set(recurring.values_list('event', flat=True))
+            if len(recurring_ids) > 0:
+                condition |= Q(id__in = recurring_ids)
+            queryset = queryset.filter(condition)
+        else:
+            queryset = queryset.filter(**dict(('occurrence__' + field, value)
+                                              for field, value in occurrence_filter.items()))
+
+    if 'categories' in kwargs:
+        if isinstance(kwargs['categories'], list):
+            queryset = queryset.filter(category__id__in = kwargs['categories'])
+        else:
+            queryset = queryset.filter(category__id = kwargs['categories'])
+
+    return queryset
+
+def _filter_recurrences(queryset, kwargs):
+    """Apply the arguments of QueryEvents to a recurrence queryset"""
+    if 'venue' in kwargs:
+        queryset = queryset.filter(event__venue = kwargs['venue'])
+
+    if 'start_date' in kwargs or 'end_date' in kwargs:
+        queryset = queryset.filter(recurrence_filter(kwargs.get('start_date'), kwargs.get('end_date')))
+
+    if 'categories' in kwargs:
+        if isinstance(kwargs['categories'], list):
+            queryset = queryset.filter(event__category__id__in = kwargs['categories'])
+        else:
+            queryset = queryset.filter(event__category__id = kwargs['categories'])
+
+    return queryset
+
+def recurrence_filter(start_date=None, end_date=None):
+    """
+    Returns a Q object matching recurrences with a date from start_date to end_date
+    (either may be None), not counting exceptions.
+    """
+    if start_date is None and end_date is None:
+        return Q()
+
+    daily = { 'frequency' : models.Recurrence.DAILY }
+    if start_date is not None:
+        daily['end_date__gte'] = start_date
+    if end_date is not None:
+        daily['start_date__lte'] = end_date
+    condition = Q(**daily)
+
+    # A weekly recurrence's dates fall on the weekday of its start date, so compare it
+    # with the first and last of that weekday in the range
+    for weekday in range(7):
+        weekly = { 'frequency' : models.Recurrence.WEEKLY,
+                   'start_date__week_day' : (weekday + 1) % 7 + 1 }  # 1 is Sunday
+        if start_date is not None:
+            first = start_date + timedelta(days=(weekday - start_date.weekday()) % 7)
+            if end_date is not None and first > end_date:
+                continue    # the range doesn't include this weekday
+            weekly['end_date__gte'] = first
+        if end_date is not None:
+            weekly['start_date__lte'] = end_date - timedelta(days=(end_date.weekday() - weekday) % 7)
+        condition |= Q(**weekly)
+
+    return condition
+
+class EventQuery(object):
+    """
+    Results of QueryEvents. Events matching by their occurrences come from a QuerySet
+    grouped in the database; events matching by a recurrence are found by a second
+    query when the results are first used, and merged in by their first (or last) date
+    in the range. Only the dates in the range are worked out.
+
+    Slicing adds a LIMIT/OFFSET clause to the first query (query is its SQL). Each event
+    gets its recurrences which have dates in the range as prefetched_recurrences, for
+    PrefetchOccurrences. Events whose only dates in the range are exceptions are left out.
+    """
+    def __init__(self, queryset, recurrences, start_date=None, end_date=None, reverse=False, low=0, high=None):
+        self.queryset = queryset
+        self.recurrences = recurrences
+        self.start_date = start_date
+        self.end_date = end_date
+        self.reverse = reverse
+        self.low = low
+        self.high = high
+        self.result = None
+
+    @property
+    def query(self):
+        return self.queryset[self.low:self.high].query
+
+    def _evaluate(self):
+        if self.result is not None:
+            return self.result
+
+        recurrences = {}
+        for rec in self.recurrences:
+            recurrences.setdefault(rec.event_id, []).append(rec)
+
+        if len(recurrences) == 0:
+            events = list(self.queryset[self.low:self.high])
+        else:
+            # Anything in the slice is among the first high events of either kind
+            events = list(self.queryset[:self.high])
+            events_by_id = dict((ev.id, ev) for ev in events)
+
+            for event_id, recs in recurrences.items():
+                keys = []
+                for rec in recs:
+                    d = rec.first_date(self.start_date, self.end_date, self.reverse)
+                    if d is not None:
+                        keys.append(local_datetime(d, rec.start_time))
+                if len(keys) == 0:
+                    continue
+                key = max(keys) if self.reverse else min(keys)
+
+                if event_id in events_by_id:
+                    ev = events_by_id[event_id]
+                    # Occurrences whose start hasn't been backfilled have no date to compare
+                    if ev.occurrence_start is not None:
+                        key = max(key, ev.occurrence_start) if self.reverse else min(key, ev.occurrence_start)
+                else:
+                    ev = recs[0].event
+                    events.append(ev)
+                ev.occurrence_start = key
+
+            # Events without a start go last, in the order of the first query
+            dated = [ev for ev in events if ev.occurrence_start is not None]
+            dated.sort(key=lambda ev: (ev.occurrence_start, ev.id), reverse=self.reverse)
+            events = dated + [ev for ev in events if ev.occurrence_start is None]
+            events = events[self.low:self.high]
+
+        for ev in events:
+            if ev.occurrence_start is not None:
+                start = timezone.localtime(ev.occurrence_start)
+                ev.occurrence_date, ev.occurrence_time = start.date(), start.time()
+            else:
+                ev.occurrence_date = ev.occurrence_time = None
+            ev.prefetched_recurrences = recurrences.get(ev.id, [])
+            ev.recurrence_range = (self.start_date, self.end_date)
+            for rec in ev.prefetched_recurrences:
+                rec.event = ev
+
+        self.result = events
+        return events
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self._evaluate()[index]
+
+        assert index.step is None and (index.start or 0) >= 0 and (index.stop is None or index.stop >= 0), \
+            "Only slices with non-negative bounds are supported"
+        low = self.low + (index.start or 0)
+        high = self.high
+        if index.stop is not None:
+            high = self.low + index.stop if high is None else min(high, self.low + index.stop)
+        return EventQuery(self.queryset, self.recurrences, self.start_date, self.end_date, self.reverse, low, high)
+
+    def __iter__(self):
+        return iter(self._evaluate())
+
+    def __len__(self):
+        return len(self._evaluate())
+
+    def count(self):
+        return len(self._evaluate())
+
+    def __repr__(self):
+        return repr(self._evaluate())
+
+def QueryEventsOrderedSet(**kwargs):
+    """
+    Original implementation of QueryEvents, which fetches one row per matching occurrence
+    and removes duplicates in Python. Takes the same arguments as QueryEvents.
     """
     queryset = models.Event.objects.all()
 
@@ -73,3 +307,123 @@ def RecentEvents(**kwargs):
     kwargs['reverse'] = True
 
     return QueryEvents(**kwargs)
+
+def UpcomingEventCounts(**kwargs):
+    """
+    Counts events occurring in the near future for each venue, in a single grouped
+    query plus one for the events recurring in the date range. Takes the same arguments as UpcomingEvents (apart from venue and reverse).
+
+    Returns a dictionary mapping venue IDs to event counts; venues with no events
+    in the date range are not included.
+    """
+    if not 'start_date' in kwargs:
+        kwargs['start_date'] = date.today()
+
+    if 'days' in kwargs:
+        kwargs['end_date'] = kwargs['start_date'] + timedelta(days=kwargs['days'] - 1)
+        del kwargs['days']
+
+    queryset = _filter_events(models.Event.objects.all(), kwargs)
+    queryset = queryset.values('venue').annotate(event_count = Count('id', distinct=True))
+
+    return dict((row['venue'], row['event_count']) for row in queryset)
+
+def AvailableCategories(**kwargs):
+    """
+    Returns the set of IDs of categories which have events matching the arguments, using
+    a single query plus one for the events recurring in the date range. Takes the same arguments as QueryEvents (apart from reverse).
+    """
+    queryset = _filter_events(models.Event.objects.all(), kwargs)
+    queryset = queryset.order_by().values_list('category', flat=True).distinct()
+
+    return set(queryset)
+
+def EventsModified(**kwargs):
+    """
+    Returns the latest modification time and number of events matching the arguments,
+    plus the latest modification time of their venues, using a single query plus one for
+    the events recurring in the date range. Takes the same arguments as QueryEvents
+    (apart from reverse).
+
+    Returns a dictionary with keys last_modified, venue_last_modified and count; the
+    times are None if there are no matching events.
+    """
+    queryset = _filter_events(models.Event.objects.all(), kwargs).order_by()
+    return queryset.aggregate(last_modified = Max('last_modified'),
+                              venue_last_modified = Max('venue__last_modified'),
+                              count = Count('id', distinct=True))
+
+def CategoriesModified():
+    """
+    Returns the latest modification time and number of categories, which are listed on
+    every event list page, using a single query.
+
+    Returns a dictionary with keys last_modified and count.
+    """
+    return models.Category.objects.aggregate(last_modified = Max('last_modified'), count = Count('id'))
+
+def _covers(outer, inner):
+    """Whether the date range outer includes all of inner (None meaning no limit)"""
+    if outer[0] is not None and (inner[0] is None or inner[0] < outer[0]):
+        return False
+    if outer[1] is not None and (inner[1] is None or inner[1] > outer[1]):
+        return False
+    return True
+
+def PrefetchOccurrences(events):
+    """
+    Loads the occurrences for a list of events in a single query, limited to each event's
+    range from set_occurrence_range, and adds those generated by their recurrences.
+    Recurrences loaded by QueryEvents are used if they cover the range; those of any
+    other events are loaded with one more query. Afterwards occurrences_in_range() on
+    each event returns the prefetched occurrences without querying the database.
+
+    Returns the list of events.
+    """
+    events = list(events)
+    if len(events) == 0:
+        return events
+
+    queryset = models.Occurrence.objects.filter(event__in = [ev.id for ev in events])
+
+    # Restrict the query to the widest range that covers every event
+    start_dates = [ev.occurrence_range[0] for ev in events]
+    end_dates = [ev.occurrence_range[1] for ev in events]
+    range_start, range_end = day_bounds(min(start_dates) if None not in start_dates else None,
+                                        max(end_dates) if None not in end_dates else None)
+    if range_start is not None:
+        queryset = queryset.filter(end__gte = range_start)
+    if range_end is not None:
+        queryset = queryset.filter(start__lte = range_end)
+
+    events_by_id = {}
+    for ev in events:
+        ev.prefetched_occurrences = []
+        events_by_id[ev.id] = ev
+
+    for occ in queryset:
+        ev = events_by_id[occ.event_id]
+        if ev.in_occurrence_range(occ):
+            occ.event = ev
+            ev.prefetched_occurrences.append(occ)
+
+    recurrences = {}
+    missing = []
+    for ev in events:
+        if ev.prefetched_recurrences is not None and _covers(ev.recurrence_range, ev.occurrence_range):
+            recurrences[ev.id] = ev.prefetched_recurrences
+        else:
+            recurrences[ev.id] = []
+            missing.append(ev.id)
+
+    if len(missing) > 0:
+        queryset = models.Recurrence.objects.filter(event__in = missing)
+        queryset = queryset.filter(recurrence_filter(min(start_dates) if None not in start_dates else None,
+                                                     max(end_dates) if None not in end_dates else None))
+        for rec in queryset:
+            recurrences[rec.event_id].append(rec)
+
+    for ev in events:
+        ev.prefetched_occurrences = ev.add_recurrences(ev.prefetched_occurrences, recurrences[ev.id])
+
+    return events
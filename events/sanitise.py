@@ -0,0 +1,324 @@
+# Description sanitiser
+#
+# sanitise_html() produces the same output as building a BeautifulSoup tree with the
+# html.parser builder, filtering its tags and calling decode(formatter='html') - see
+# sanitise_html_soup(), which is kept as the reference implementation - but does it in a
+# single pass over the parser's events without building a tree.
+import re
+from HTMLParser import HTMLParser
+
+from bs4 import BeautifulSoup, UnicodeDammit
+from bs4.dammit import EntitySubstitution
+
+# Tags removed including all their children
+BLACKLIST = ['script', 'style']
+
+# Tags kept, with the attributes they may keep (None for no attributes). Any other tag is
+# removed but its children are kept.
+WHITELIST = { 'a' : ['href'],
+              'p' : None,
+              'div' : None,
+              'span' : None,
+              'br' : None,
+              'table' : None,
+              'tr' : None,
+              'td' : None,
+              'th' : None,
+              'thead' : None,
+              'tbody' : None,
+              'ul' : None,
+              'ol' : None,
+              'li' : None,
+              'b' : None,
+              'strong' : None,
+              'i' : None,
+              'em' : None,
+              'u' : None,
+              'strike' : None,
+            }
+
+# Links in plain text descriptions
+LINK_RE = re.compile(r'http://\S+')
+LINK_TRAILING_PUNCTUATION = '.,;/()'
+LINK_MAX_LENGTH = 25
+NON_SPACE_RE = re.compile(r'\S')
+
+# Tags Beautiful Soup writes as <tag/> when they have no contents
+EMPTY_ELEMENT_TAGS = set(['br', 'hr', 'input', 'img', 'meta', 'spacer', 'link', 'frame', 'base'])
+
+# Tags whose whitespace-only strings Beautiful Soup leaves alone
+PRESERVE_WHITESPACE_TAGS = set(['pre', 'textarea'])
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+NON_ASCII_SPACE_RE = re.compile('[^%s]' % ASCII_SPACES)
+
+format_string = EntitySubstitution.substitute_html
+
+def format_link(href):
+    """Returns an <a> tag linking to href, with the link text shortened if necessary"""
+    if len(href) <= LINK_MAX_LENGTH:
+        text = href
+    else:
+        text = href[:LINK_MAX_LENGTH - 3] + '...'
+    return u'<a href=%s>%s</a>' % (EntitySubstitution.quoted_attribute_value(format_string(href)), format_string(text))
+
+def sanitise_text(text):
+    """Convert a plain text description to HTML, one paragraph per line"""
+    out = []
+    for para in text.split('\n'):
+        # Skip empty paragraphs
+        if NON_SPACE_RE.search(para) is None:
+            continue
+
+        out.append(u'<p>')
+        pos = 0
+        for mo in LINK_RE.finditer(para):
+            href = mo.group(0)
+
+            # Strip final punctuation off link target, if applicable
+            if href[-1] in LINK_TRAILING_PUNCTUATION:
+                href = href[:-1]
+
+            if mo.start() > pos:
+                out.append(format_string(para[pos:mo.start()]))
+            out.append(format_link(href))
+            pos = mo.start() + len(href)
+
+        if pos < len(para):
+            out.append(format_string(para[pos:]))
+        out.append(u'</p>')
+
+    return u''.join(out)
+
+class SanitisingParser(HTMLParser):
+    """
+    HTMLParser which writes out the sanitised document as it goes.
+
+    Keeps a stack of open tags, like Beautiful Soup does, so that unclosed and
+    mismatched tags are closed the same way.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.out = []
+        self.data = []          # text since the last tag, which Beautiful Soup joins into one string
+        self.stack = []         # (name, is output) for each open tag
+        self.blacklisted = 0    # number of open blacklisted tags
+        self.preserve = 0       # number of open whitespace-preserving tags
+        self.pending = False    # whether an empty-element tag is waiting for '>' or '/>'
+
+    def emit(self, s):
+        if self.pending:
+            self.out.append(u'>')
+            self.pending = False
+        self.out.append(s)
+
+    def end_data(self):
+        if len(self.data) == 0:
+            return
+        data = u''.join(self.data)
+        self.data = []
+
+        if self.blacklisted > 0:
+            return
+
+        self.emit(format_string(self.collapse_whitespace(data)))
+
+    def collapse_whitespace(self, data):
+        # Beautiful Soup replaces whitespace-only strings (comments etc. included) by a
+        # single space or newline
+        if self.preserve == 0 and NON_ASCII_SPACE_RE.search(data) is None:
+            return u'\n' if '\n' in data else u' '
+        return data
+
+    def handle_starttag(self, name, attrs):
+        self.end_data()
+
+        output = False
+        if name in BLACKLIST:
+            self.blacklisted += 1
+        elif self.blacklisted == 0 and name in WHITELIST:
+            output = True
+            permitted_attrs = WHITELIST[name]
+            attr_dict = {}
+            if permitted_attrs is not None:
+                for key, value in attrs:
+                    if key in permitted_attrs:
+                        attr_dict[key] = value if value is not None else ''
+
+            tag = u'<' + name
+            for key, value in sorted(attr_dict.items()):
+                tag += u' %s=%s' % (key, EntitySubstitution.quoted_attribute_value(format_string(value)))
+
+            if name in EMPTY_ELEMENT_TAGS:
+                # We don't know if this will be <br/> or <br>...</br> until we see its contents
+                self.emit(tag)
+                self.pending = True
+            else:
+                self.emit(tag + u'>')
+
+        if name in PRESERVE_WHITESPACE_TAGS:
+            self.preserve += 1
+        self.stack.append((name, output))
+
+    def handle_endtag(self, name):
+        self.end_data()
+
+        # Close tags up to the most recent one with this name, or all of them if there
+        # isn't one (as Beautiful Soup does)
+        while len(self.stack) > 0:
+            open_name, output = self.stack.pop()
+            self.close_tag(open_name, output)
+            if open_name == name:
+                break
+
+    def close_tag(self, name, output):
+        if name in BLACKLIST:
+            self.blacklisted -= 1
+        if name in PRESERVE_WHITESPACE_TAGS:
+            self.preserve -= 1
+
+        if output:
+            if self.pending:
+                self.out.append(u'/>')
+                self.pending = False
+            else:
+                self.out.append(u'</%s>' % name)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith('x'):
+            real_name = int(name.lstrip('x'), 16)
+        elif name.startswith('X'):
+            real_name = int(name.lstrip('X'), 16)
+        else:
+            real_name = int(name)
+
+        try:
+            data = unichr(real_name)
+        except (ValueError, OverflowError):
+            data = u"\N{REPLACEMENT CHARACTER}"
+
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        if character is not None:
+            self.data.append(character)
+        else:
+            self.data.append(u"&%s;" % name)
+
+    def handle_special(self, prefix, data, suffix):
+        # Comments etc. are written out unchanged
+        self.end_data()
+        if self.blacklisted == 0:
+            self.emit(prefix + self.collapse_whitespace(data) + suffix)
+
+    def handle_comment(self, data):
+        self.handle_special(u'<!--', data, u'-->')
+
+    def handle_decl(self, data):
+        if data.startswith("DOCTYPE "):
+            data = data[len("DOCTYPE "):]
+        elif data == 'DOCTYPE':
+            data = ''
+        self.handle_special(u'<!DOCTYPE ', data, u'>\n')
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self.handle_special(u'<![CDATA[', data[len('CDATA['):], u']]>')
+        else:
+            self.handle_special(u'<!', data, u'!>')
+
+    def handle_pi(self, data):
+        if data.endswith("?") and data.lower().startswith("xml"):
+            data = data[:-1]
+        self.handle_special(u'<?', data, u'?>')
+
+    def result(self):
+        # Beautiful Soup never calls close(), so anything the parser is still holding
+        # back at the end of the input (an incomplete tag or entity, say) is dropped
+        self.end_data()
+        while len(self.stack) > 0:
+            self.close_tag(*self.stack.pop())
+        return u''.join(self.out)
+
+def sanitise_html(text, is_html):
+    """
+    Returns text as sanitised HTML. If is_html is False, text is treated as plain text
+    with one paragraph per line, and links are created for any URLs in it.
+    """
+    if not is_html:
+        return sanitise_text(text)
+
+    if not isinstance(text, unicode):
+        text = UnicodeDammit(text, is_html=True).unicode_markup
+
+    parser = SanitisingParser()
+    parser.feed(text)
+    return parser.result()
+
+def sanitise_html_soup(text, is_html):
+    """
+    Reference implementation of sanitise_html() using a BeautifulSoup tree, which is
+    much slower. Used for testing and benchmarking.
+    """
+    if not is_html:
+        # Plain text - generate HTML
+        soup = BeautifulSoup('', 'html.parser')
+        paras = text.split('\n')
+        for para in paras:
+            # Skip empty paragraphs
+            if re.search(r'\S', para) is None:
+                continue
+
+            tag = soup.new_tag("p")
+
+            # Attempt to make links and add text to the tag
+            while True:
+                mo = re.search(r'http://\S+', para)
+                if mo is None:
+                    # no links found - add remaining text to tag and finish
+                    tag.append(soup.new_string(para))
+                    break
+
+                # Add text before link (if any) as string
+                if mo.start() > 0:
+                    tag.append(soup.new_string(para[:mo.start()]))
+
+                # Strip final punctuation off link target, if applicable
+                if re.match(r'.*[.,;/()]$', mo.group(0)) is not None:
+                    link_href = para[ mo.start() : mo.end() - 1]
+                    para = para[ mo.end() - 1:]
+                else:
+                    link_href = mo.group(0)
+                    para = para[ mo.end() :]
+
+                link_tag = soup.new_tag("a", href=link_href)
+                if len(link_href) <= 25:
+                    link_tag.append(link_href)
+                else:
+                    link_tag.append(link_href[:22] + '...')
+                tag.append(link_tag)
+
+            soup.append(tag)
+
+    else:
+        soup = BeautifulSoup(text, 'html.parser')
+
+        for tag in soup.findAll():
+            if tag.name.lower() in BLACKLIST:
+                # remove including all children
+                tag.extract()
+            elif tag.name.lower() not in WHITELIST:
+                # remove, retaining children
+                tag.unwrap()
+            else:
+                # remove disallowed attributes
+                permitted_attrs = WHITELIST[tag.name.lower()]
+                for attr in list(tag.attrs):
+                    if permitted_attrs is None or attr not in permitted_attrs:
+                        del tag.attrs[attr]
+
+    return soup.decode(formatter='html')
@@ -1,16 +1,826 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from datetime import date, time, timedelta
+from StringIO import StringIO
+import calendar
+import json
+import os
+import shutil
+import sys
+import tempfile
 
-Replace this with more appropriate tests for your application.
-"""
+from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.http import http_date
 
-from django.test import TestCase
+from events.models import Venue, Category, Event, Occurrence, Recurrence, CachedDescription, DescriptionCacheStats
+from events import queries, pagecache, ingest, sanitise, descriptioncache, truncate
+from events.management.commands.benchmark_summaries import nested_description
 
+def occurrence_spec(day, start_time='20:00'):
+    """Returns an occurrence dictionary for the given day of October 2013"""
+    return { 'start_date' : '2013-10-%02d' % day, 'start_time' : start_time }
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+def event_spec(name='Event', **fields):
+    """
+    Returns an event dictionary in the format accepted by ingest_events, for a plain text
+    event at the test venue at 8pm on 2 October 2013. Keyword arguments replace its
+    fields; those set to None are left out.
+    """
+    spec = { 'name' : name, 'description' : 'About ' + name, 'description_is_html' : False,
+             'venue' : 'Test Venue', 'category' : 'Gigs', 'occurrences' : [occurrence_spec(2)] }
+    spec.update(fields)
+    return dict((key, value) for key, value in spec.items() if value is not None)
+
+class EventTestCase(TestCase):
+    def setUp(self):
+        if pagecache.get_page_cache() is not None:
+            pagecache.get_page_cache().clear()
+        self.venue = Venue.objects.create(name='Test Venue')
+        self.category = Category.objects.create(name='Gigs')
+
+    def make_event(self, **kwargs):
+        fields = { 'name' : 'Event', 'description' : '<p>Details</p>',
+                   'venue' : self.venue, 'category' : self.category }
+        fields.update(kwargs)
+        return Event.objects.create(**fields)
+
+class SummaryTest(EventTestCase):
+    def test_summary_stored_on_save(self):
+        ev = self.make_event(description='<p>Short <b>description</b></p><p>here</p>')
+        ev = Event.objects.get(pk=ev.pk)
+        self.assertEqual(ev.summary, 'Short <b>description</b> here ')
+        self.assertFalse(ev.summary_truncated)
+        self.assertEqual(ev.description_short(), ev.summary)
+
+    def test_long_description_gets_link(self):
+        ev = self.make_event(description='<p>%s</p>' % ' '.join(['word'] * 80))
+        ev = Event.objects.get(pk=ev.pk)
+        self.assertTrue(ev.summary_truncated)
+        self.assertEqual(len(ev.summary.split()), 50)
+        self.assertIn('more_info_link', ev.description_short())
+        self.assertIn('/event/%d' % ev.pk, ev.description_short())
+
+    def test_summary_updated_when_description_changes(self):
+        ev = self.make_event(description='<p>Old text</p>')
+        ev = Event.objects.get(pk=ev.pk)
+        ev.description = '<p>New text</p>'
+        ev.save()
+        self.assertEqual(Event.objects.get(pk=ev.pk).summary, 'New text ')
+
+    def test_summary_not_regenerated_when_unchanged(self):
+        ev = self.make_event()
+        ev = Event.objects.get(pk=ev.pk)
+        ev.summary = 'Marker'
+        ev.name = 'Renamed'
+        ev.save()
+        self.assertEqual(Event.objects.get(pk=ev.pk).summary, 'Marker')
+
+    def test_backfill_command(self):
+        ev = self.make_event(description='<p>Some text</p>')
+        Event.objects.filter(pk=ev.pk).update(summary='', summary_source='')
+        call_command('update_summaries', missing=True, stdout=StringIO())
+        self.assertEqual(Event.objects.get(pk=ev.pk).summary, 'Some text ')
+
+        out = StringIO()
+        call_command('update_summaries', missing=True, stdout=out)
+        self.assertIn('Updated summaries for 0 events', out.getvalue())
+
+    def test_empty_summary_is_not_regenerated(self):
+        ev = self.make_event(description='')
+        ev = Event.objects.get(pk=ev.pk)
+        self.assertEqual(ev._summarised_description, ev.description)
+
+        out = StringIO()
+        call_command('update_summaries', missing=True, stdout=out)
+        self.assertIn('Updated summaries for 0 events', out.getvalue())
+
+        # A description changed behind the model's back is summarised again
+        Event.objects.filter(pk=ev.pk).update(description='<p>Changed</p>')
+        self.assertEqual(Event.objects.get(pk=ev.pk).description_short(), 'Changed ')
+
+    def test_truncation_matches_original(self):
+        with open(os.path.join(os.path.dirname(__file__), 'testdata', 'sanitise_corpus.json')) as f:
+            descriptions = [sanitise.sanitise_html(case['description'], case['description_is_html']) for case in json.load(f)]
+        descriptions += [nested_description(5, 3, 4), nested_description(30, 10, 7),
+                         '<div> a <!-- not counted --> b<span>c </span> <i></i>d<br/>e  f</div>',
+                         ' lead\tand trail <b> </b>x\xa0y ']
+
+        for description in descriptions:
+            for max_words in (0, 1, 2, 3, 7, 50):
+                expected, soup = BeautifulSoup(description, 'html.parser'), BeautifulSoup(description, 'html.parser')
+                expected_result = truncate.keep_first_nwords_reference(expected, max_words)
+                self.assertEqual(truncate.keep_first_nwords(soup, max_words), expected_result)
+                self.assertEqual(soup.decode(formatter='html'), expected.decode(formatter='html'))
+                self.assertEqual(list(soup.descendants), list(expected.descendants))
+
+class PrefetchOccurrencesTest(EventTestCase):
+    def add_occurrences(self, ev, *days):
+        for day in days:
+            Occurrence.objects.create(event=ev, start_date=date(2013, 10, day), start_time=time(20, 0))
+
+    def test_occurrences_clipped_to_range(self):
+        ev1 = self.make_event()
+        self.add_occurrences(ev1, 1, 5, 9)
+        ev2 = self.make_event()
+        self.add_occurrences(ev2, 4, 6)
+
+        events = list(Event.objects.all())
+        for ev in events:
+            ev.set_occurrence_range(start_date=date(2013, 10, 3), end_date=date(2013, 10, 5))
+
+        # One for the occurrences and one for recurrences
+        with self.assertNumQueries(2):
+            queries.PrefetchOccurrences(events)
+            prefetched = [[o.start_date.day for o in ev.occurrences_in_range()] for ev in events]
+
+        self.assertEqual(prefetched, [[5], [4]])
+
+    def test_per_event_ranges(self):
+        ev1 = self.make_event()
+        self.add_occurrences(ev1, 1, 5, 9)
+        ev2 = self.make_event()
+        self.add_occurrences(ev2, 1, 5, 9)
+
+        ev1.set_occurrence_range(start_date=date(2013, 10, 5))
+        ev2.set_occurrence_range(end_date=date(2013, 10, 5))
+        queries.PrefetchOccurrences([ev1, ev2])
+
+        self.assertEqual([o.start_date.day for o in ev1.occurrences_in_range()], [5, 9])
+        self.assertEqual([o.start_date.day for o in ev2.occurrences_in_range()], [1, 5])
+
+
+class QueryEventsTest(EventTestCase):
+    def setUp(self):
+        super(QueryEventsTest, self).setUp()
+        self.early = self.make_event(name='Early')
+        self.late = self.make_event(name='Late')
+        for ev, days in ((self.early, (1, 4, 20)), (self.late, (2, 3, 10))):
+            for day in days:
+                Occurrence.objects.create(event=ev, start_date=date(2013, 10, day), start_time=time(20, 0))
+
+    def test_events_returned_once_in_order(self):
+        events = queries.QueryEvents(start_date=date(2013, 10, 1))
+        self.assertEqual([ev.name for ev in events], ['Early', 'Late'])
+
+    def test_ordering_uses_matching_occurrences(self):
+        events = queries.QueryEvents(start_date=date(2013, 10, 3))
+        self.assertEqual([ev.name for ev in events], ['Late', 'Early'])
+        events = queries.QueryEvents(end_date=date(2013, 10, 15), reverse=True)
+        self.assertEqual([ev.name for ev in events], ['Late', 'Early'])
+
+    def test_ordering_combines_date_and_time(self):
+        a, b = self.make_event(name='A'), self.make_event(name='B')
+        Occurrence.objects.create(event=a, start_date=date(2013, 11, 2), start_time=time(22, 0))
+        Occurrence.objects.create(event=a, start_date=date(2013, 11, 5), start_time=time(10, 0))
+        Occurrence.objects.create(event=b, start_date=date(2013, 11, 2), start_time=time(20, 0))
+
+        events = list(queries.QueryEvents(start_date=date(2013, 11, 1)))
+        self.assertEqual([ev.name for ev in events], ['B', 'A'])
+        self.assertEqual((events[1].occurrence_date, events[1].occurrence_time), (date(2013, 11, 2), time(22, 0)))
+        events = list(queries.QueryEvents(start_date=date(2013, 11, 1), reverse=True))
+        self.assertEqual([ev.name for ev in events], ['A', 'B'])
+        self.assertEqual((events[0].occurrence_date, events[0].occurrence_time), (date(2013, 11, 5), time(10, 0)))
+
+    def test_date_conditions_apply_to_same_occurrence(self):
+        events = queries.QueryEvents(start_date=date(2013, 10, 11), end_date=date(2013, 10, 19))
+        self.assertEqual(list(events), [])
+
+    def test_slice_is_limit(self):
+        events = queries.QueryEvents(start_date=date(2013, 10, 1))[0:1]
+        self.assertIn('LIMIT', str(events.query))
+        self.assertEqual([ev.name for ev in events], ['Early'])
+        self.assertEqual(queries.QueryEvents(start_date=date(2013, 10, 1)).count(), 2)
+
+    def test_ordered_set_fallback(self):
+        events = queries.QueryEvents(start_date=date(2013, 10, 1), ordered_set=True)
+        self.assertEqual([ev.name for ev in events], ['Early', 'Late'])
+
+class OverlapTest(EventTestCase):
+    def test_interval(self):
+        ev = self.make_event()
+        late = Occurrence.objects.create(event=ev, start_date=date(2013, 10, 5), start_time=time(22, 0), end_time=time(2, 0))
+        self.assertEqual(late.end - late.start, timedelta(hours=4))
+        self.assertEqual(late.last_date(), date(2013, 10, 6))
+
+        run = Occurrence.objects.create(event=ev, start_date=date(2013, 10, 5), start_time=time(10, 0), end_date=date(2013, 10, 9))
+        self.assertEqual(timezone.localtime(run.end).date(), date(2013, 10, 9))
+
+    def test_multi_day_occurrences_overlap_range(self):
+        running = self.make_event(name='Running')
+        Occurrence.objects.create(event=running, start_date=date(2013, 9, 28), start_time=time(10, 0),
+                                  end_date=date(2013, 10, 9), end_time=time(18, 0))
+        single = self.make_event(name='Single')
+        Occurrence.objects.create(event=single, start_date=date(2013, 10, 8), start_time=time(20, 0))
+
+        response = self.client.get('/dailyinfo/week/2013-10-07')
+        self.assertEqual([ev.name for ev in response.context['event_list']], ['Running', 'Single'])
+        self.assertEqual(len(response.context['event_list'][0].occurrences_in_range()), 1)
+
+        self.assertEqual([ev.name for ev in queries.QueryEvents(start_date=date(2013, 10, 10))], [])
+        self.assertEqual(queries.UpcomingEventCounts(start_date=date(2013, 10, 9), days=1), { self.venue.id : 1 })
+
+        running.set_occurrence_range(date(2013, 10, 1), date(2013, 10, 1))
+        self.assertEqual(len(running.occurrences_in_range()), 1)
+
+    def test_backfill_command(self):
+        ev = self.make_event()
+        occ = Occurrence.objects.create(event=ev, start_date=date(2013, 10, 2), start_time=time(20, 0))
+        Occurrence.objects.update(start=None, end=None)
+        self.assertEqual(list(queries.QueryEvents(start_date=date(2013, 10, 1))), [])
+
+        call_command('update_occurrence_times', missing=True, stdout=StringIO())
+        self.assertEqual(Occurrence.objects.get().start, occ.start)
+        self.assertEqual(list(queries.QueryEvents(start_date=date(2013, 10, 1))), [ev])
+
+class RecurrenceTest(EventTestCase):
+    def add_recurrence(self, ev, frequency, start_day, end_day, exceptions=''):
+        return Recurrence.objects.create(event=ev, frequency=frequency, start_date=date(2013, 10, start_day),
+                                         end_date=date(2013, 10, end_day), start_time=time(19, 0), exceptions=exceptions)
+
+    def test_dates(self):
+        ev = self.make_event()
+        daily = self.add_recurrence(ev, Recurrence.DAILY, 1, 31, '2013-10-05,2013-10-06')
+        weekly = self.add_recurrence(ev, Recurrence.WEEKLY, 2, 31)
+
+        self.assertEqual([d.day for d in daily.dates(date(2013, 10, 3), date(2013, 10, 8))], [3, 4, 7, 8])
+        self.assertEqual([d.day for d in weekly.dates()], [2, 9, 16, 23, 30])
+        self.assertEqual([d.day for d in weekly.dates(date(2013, 10, 10), date(2013, 10, 30), reverse=True)], [30, 23, 16])
+        self.assertEqual(weekly.first_date(date(2013, 10, 3), date(2013, 10, 8)), None)
+
+    def test_query_events_merges_recurrences(self):
+        weekly = self.make_event(name='Weekly')
+        self.add_recurrence(weekly, Recurrence.WEEKLY, 2, 30)
+        daily = self.make_event(name='Daily')
+        self.add_recurrence(daily, Recurrence.DAILY, 5, 25, '2013-10-12')
+        single = self.make_event(name='Single')
+        Occurrence.objects.create(event=single, start_date=date(2013, 10, 10), start_time=time(20, 0))
+
+        def names(**kwargs):
+            return [ev.name for ev in queries.QueryEvents(**kwargs)]
+
+        self.assertEqual(names(start_date=date(2013, 10, 10), end_date=date(2013, 10, 16)), ['Daily', 'Single', 'Weekly'])
+        self.assertEqual(names(start_date=date(2013, 10, 3), end_date=date(2013, 10, 8)), ['Daily'])
+        self.assertEqual(names(start_date=date(2013, 10, 9), end_date=date(2013, 10, 9)), ['Weekly', 'Daily'])
+        # Only an exception in the range
+        self.assertEqual(names(start_date=date(2013, 10, 12), end_date=date(2013, 10, 12)), [])
+        self.assertEqual(names(end_date=date(2013, 10, 20), reverse=True), ['Daily', 'Weekly', 'Single'])
+        self.assertEqual([ev.name for ev in queries.UpcomingEvents(start_date=date(2013, 10, 10))[1:2]], ['Single'])
+        self.assertEqual(queries.UpcomingEventCounts(start_date=date(2013, 10, 3), days=6), { self.venue.id : 1 })
+        # Events matching by occurrences and by recurrences are counted together
+        self.assertEqual(queries.UpcomingEventCounts(start_date=date(2013, 10, 10), days=7), { self.venue.id : 3 })
+        self.assertEqual(queries.EventsModified(start_date=date(2013, 10, 9), end_date=date(2013, 10, 10))['count'], 3)
+        self.assertEqual(queries.AvailableCategories(start_date=date(2013, 10, 3), end_date=date(2013, 10, 8)),
+                         set([self.category.id]))
+
+        events = queries.QueryEvents(start_date=date(2013, 10, 14), end_date=date(2013, 10, 16))
+        for ev in events:
+            ev.set_occurrence_range(date(2013, 10, 14), date(2013, 10, 16))
+        with self.assertNumQueries(1):
+            queries.PrefetchOccurrences(events)
+        self.assertEqual([[o.start_date.day for o in ev.occurrences_in_range()] for ev in events], [[14, 15, 16], [16]])
+
+
+    def test_merge_without_occurrence_start(self):
+        # Occurrences whose start hasn't been backfilled yet
+        both = self.make_event(name='Both')
+        Occurrence.objects.create(event=both, start_date=date(2013, 10, 2), start_time=time(20, 0))
+        self.add_recurrence(both, Recurrence.DAILY, 10, 12)
+        unset = self.make_event(name='Unset')
+        Occurrence.objects.create(event=unset, start_date=date(2013, 10, 1), start_time=time(20, 0))
+        weekly = self.make_event(name='Weekly')
+        self.add_recurrence(weekly, Recurrence.WEEKLY, 2, 30)
+        Occurrence.objects.update(start=None, end=None)
+
+        events = list(queries.QueryEvents())
+        self.assertEqual([ev.name for ev in events], ['Weekly', 'Both', 'Unset'])
+        self.assertEqual(events[1].occurrence_date, date(2013, 10, 10))
+        self.assertEqual(events[2].occurrence_date, None)
+        self.assertEqual([ev.name for ev in queries.QueryEvents(reverse=True)], ['Weekly', 'Both', 'Unset'])
+    def test_occurrences_in_range(self):
+        ev = self.make_event()
+        self.add_recurrence(ev, Recurrence.WEEKLY, 2, 30)
+        Occurrence.objects.create(event=ev, start_date=date(2013, 10, 10), start_time=time(20, 0))
+        ev.set_occurrence_range(date(2013, 10, 5), date(2013, 10, 20))
+        self.assertEqual([(o.start_date.day, o.start_time.hour) for o in ev.occurrences_in_range()], [(9, 19), (10, 20), (16, 19)])
+
+    def test_week_view(self):
+        ev = self.make_event(name='Exhibition')
+        self.add_recurrence(ev, Recurrence.DAILY, 1, 31)
+        response = self.client.get('/dailyinfo/week/2013-10-07')
+        self.assertEqual([e.name for e in response.context['event_list']], ['Exhibition'])
+        self.assertEqual(len(response.context['event_list'][0].occurrences_in_range()), 7)
+        self.assertContains(self.client.get('/dailyinfo/event/%d' % ev.id), '7pm daily')
+
+        # Shortening the recurrence invalidates the cached page
+        rec = Recurrence.objects.get()
+        rec.end_date = date(2013, 10, 3)
+        rec.save()
+        self.assertEqual(list(self.client.get('/dailyinfo/week/2013-10-07').context['event_list']), [])
+
+    def test_ingest(self):
+        spec = event_spec('Residency', description='Every day', origin_key='test|r', occurrences=[],
+                          recurrences=[{ 'frequency' : 'daily', 'start_date' : '2013-10-01', 'end_date' : '2014-03-31',
+                                         'start_time' : '20:00', 'exceptions' : ['2013-12-25'] }])
+        self.assertEqual(ingest.ingest_events([spec]), (1, 0, 0))
+        self.assertEqual(Occurrence.objects.count(), 0)
+        rec = Recurrence.objects.get()
+        self.assertEqual((rec.end_date, rec.exceptions), (date(2014, 3, 31), '2013-12-25'))
+
+        self.assertEqual(ingest.ingest_events([spec]), (0, 0, 1))
+        spec['recurrences'][0]['end_date'] = '2014-01-31'
+        self.assertEqual(ingest.ingest_events([spec]), (0, 1, 0))
+        self.assertEqual(Recurrence.objects.get().end_date, date(2014, 1, 31))
+
+        del spec['recurrences']
+        self.assertRaises(ValueError, ingest.validate_spec, spec)
+
+class VenueListTest(EventTestCase):
+    def test_this_week_counts(self):
+        Venue.objects.create(name='Empty Venue')
+        for i in range(3):
+            ev = self.make_event()
+            # several occurrences per event should still count once
+            for days in (0, 1, 10):
+                Occurrence.objects.create(event=ev, start_date=date.today() + timedelta(days=days), start_time=time(20, 0))
+
+        self.assertEqual(queries.UpcomingEventCounts(days=7), { self.venue.id : 3 })
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/dailyinfo/venues/')
+        self.assertContains(response, '3 events in the next 7 days')
+        self.assertContains(response, '0 events in the next 7 days')
+
+class PeriodViewTest(EventTestCase):
+    def add_events(self, count, category=None):
+        for i in range(count):
+            ev = self.make_event(category=category or self.category)
+            Occurrence.objects.create(event=ev, start_date=date(2013, 10, 2), start_time=time(20, 0))
+            Occurrence.objects.create(event=ev, start_date=date(2013, 10, 3), start_time=time(20, 0))
+
+    def test_fixed_query_budget(self):
+        # Including one for the recurrences in the range and three for the validator
+        self.add_events(1)
+        with self.assertNumQueries(9):
+            self.client.get('/dailyinfo/week/2013-10-01')
+
+        self.add_events(10)
+        with self.assertNumQueries(9):
+            response = self.client.get('/dailyinfo/week/2013-10-01')
+        self.assertEqual(len(response.context['event_list']), 11)
+
+        with self.assertNumQueries(9):
+            self.client.get('/dailyinfo/day/2013-10-02')
+
+    def test_available_categories(self):
+        empty = Category.objects.create(name='Theatre')
+        self.add_events(2)
+        response = self.client.get('/dailyinfo/week/2013-10-01', { 'categories' : str(empty.id) })
+
+        self.assertEqual(len(response.context['event_list']), 0)
+        available = dict((cat.id, cat.available) for cat in response.context['categories'])
+        self.assertEqual(available, { self.category.id : True, empty.id : False })
+
+class PageCacheTest(EventTestCase):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        self.event = self.make_event(name='Cached event')
+        self.occurrence = Occurrence.objects.create(event=self.event, start_date=date(2013, 10, 2), start_time=time(20, 0))
+
+    def test_repeat_request_is_cached(self):
+        first = self.client.get('/dailyinfo/week/2013-10-01')
+        # Only the conditional GET validator is queried, with one query for the
+        # events recurring in the range
+        with self.assertNumQueries(3):
+            second = self.client.get('/dailyinfo/week/2013-10-01')
+        self.assertEqual(first.content, second.content)
+
+    def test_category_set_is_normalised(self):
+        other = Category.objects.create(name='Theatre')
+        self.client.get('/dailyinfo/week/2013-10-01', { 'categories' : '%d,%d' % (self.category.id, other.id) })
+        with self.assertNumQueries(3):
+            self.client.get('/dailyinfo/week/2013-10-01', { 'categories' : '%d,%d' % (other.id, self.category.id) })
+
+    def test_occurrence_change_invalidates_window(self):
+        self.client.get('/dailyinfo/week/2013-10-01')
+        self.client.get('/dailyinfo/week/2013-11-01')
+
+        self.occurrence.start_date = date(2013, 10, 3)
+        self.occurrence.save()
+
+        response = self.client.get('/dailyinfo/week/2013-10-01')
+        self.assertIn('Thu 03 Oct 2013', response.content)
+
+        # Pages for other dates are untouched
+        with self.assertNumQueries(3):
+            self.client.get('/dailyinfo/week/2013-11-01')
+
+    def test_moved_occurrence_invalidates_old_dates(self):
+        self.assertIn('Cached event', self.client.get('/dailyinfo/week/2013-10-01').content)
+
+        occ = Occurrence.objects.get(pk=self.occurrence.pk)
+        occ.start_date = date(2013, 11, 4)
+        occ.save()
+        self.assertNotIn('Cached event', self.client.get('/dailyinfo/week/2013-10-01').content)
+
+    def test_event_change_invalidates_its_dates(self):
+        self.client.get('/dailyinfo/day/2013-10-02')
+        self.event.name = 'Renamed event'
+        self.event.save()
+        self.assertContains(self.client.get('/dailyinfo/day/2013-10-02'), 'Renamed event')
+
+    def test_ingest_invalidates_after_commit(self):
+        key = pagecache.page_key('week', date(2013, 10, 1), 7)
+        with pagecache.deferred_invalidation():
+            ingest.ingest_events([event_spec('Ingested event')])
+            self.occurrence.start_date = date(2013, 10, 3)
+            self.occurrence.save()
+            self.assertEqual(pagecache.page_key('week', date(2013, 10, 1), 7), key)
+        self.assertNotEqual(pagecache.page_key('week', date(2013, 10, 1), 7), key)
+
+        # ingest_chunk defers invalidation past its own transaction
+        self.client.get('/dailyinfo/week/2013-10-01')
+        ingest.ingest_chunk([(1, event_spec('Chunk event'))], [])
+        self.assertContains(self.client.get('/dailyinfo/week/2013-10-01'), 'Chunk event')
+
+class ConditionalGetTest(EventTestCase):
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.event = self.make_event()
+        Occurrence.objects.create(event=self.event, start_date=date(2013, 10, 2), start_time=time(20, 0))
+
+    def assertRevalidates(self, url, num_queries=1):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+
+        with self.assertNumQueries(num_queries):
+            revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        return response['ETag']
+
+    def test_week_view(self):
+        etag = self.assertRevalidates('/dailyinfo/week/2013-10-01', num_queries=3)
+
+        # A new occurrence, or removing an event, changes the validator
+        Occurrence.objects.create(event=self.event, start_date=date(2013, 10, 3), start_time=time(20, 0))
+        response = self.client.get('/dailyinfo/week/2013-10-01', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        self.event.delete()
+        response = self.client.get('/dailyinfo/week/2013-10-01', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_week_view_lists_categories(self):
+        etag = self.assertRevalidates('/dailyinfo/week/2013-10-01', num_queries=3)
+
+        # Renaming or adding a category without events changes the validator
+        self.category.name = 'Music'
+        self.category.save()
+        response = self.client.get('/dailyinfo/week/2013-10-01', HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Music')
+
+        etag = response['ETag']
+        Category.objects.create(name='Theatre')
+        response = self.client.get('/dailyinfo/week/2013-10-01', HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Theatre')
+
+    def test_event_detail(self):
+        self.assertRevalidates('/dailyinfo/event/%d' % self.event.id)
+        response = self.client.get('/dailyinfo/event/%d' % self.event.id)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # A Last-Modified from before this hour doesn't revalidate, as occurrences may
+        # have become past since
+        Event.objects.filter(pk=self.event.id).update(last_modified=timezone.now() - timedelta(days=2))
+        Venue.objects.filter(pk=self.venue.id).update(last_modified=timezone.now() - timedelta(days=2))
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        response = self.client.get('/dailyinfo/event/%d' % self.event.id,
+                                   HTTP_IF_MODIFIED_SINCE=http_date(calendar.timegm((hour - timedelta(minutes=1)).utctimetuple())))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/dailyinfo/event/%d' % self.event.id, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_venue_detail(self):
+        etag = self.assertRevalidates('/dailyinfo/venue/%d' % self.venue.id)
+        self.venue.description = 'Changed'
+        self.venue.save()
+        response = self.client.get('/dailyinfo/venue/%d' % self.venue.id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_event(self):
+        self.assertEqual(self.client.get('/dailyinfo/event/9999').status_code, 404)
+
+class IngestTest(EventTestCase):
+    def spec(self, name, origin_key=None, days=(2,)):
+        return event_spec(name, origin_key=origin_key, occurrences=[occurrence_spec(day) for day in days])
+
+    def test_bulk_ingest(self):
+        specs = [self.spec('Event %d' % i, origin_key='test|%d' % i, days=(1, 2)) for i in range(20)]
+        specs.append(self.spec('No key'))
+        specs.append(self.spec('Repeat', origin_key='test|3'))
+
+        # 7 for the events, plus 2 for the description cache (lookup and insert)
+        with self.assertNumQueries(9):
+            result = ingest.ingest_events(specs)
+        self.assertEqual(result, (21, 0, 1))
+        self.assertEqual(Occurrence.objects.count(), 41)
+
+        ev = Event.objects.get(origin_key='test|7')
+        self.assertEqual(ev.name, 'Event 7')
+        self.assertEqual(ev.summary, 'About Event 7 ')
+        self.assertEqual(ev.occurrence_set.count(), 2)
+
+        # Ingesting again only finds duplicates
+        self.assertEqual(ingest.ingest_events(specs[:20]), (0, 0, 20))
+
+    def test_unknown_venue(self):
+        spec = self.spec('Lost', origin_key='test|lost')
+        spec['venue'] = 'Nowhere'
+        self.assertRaises(Exception, ingest.ingest_events, [spec])
+
+    def test_batch_add_view(self):
+        response = self.client.post('/dailyinfo/batch-add/', { 'event_data' : json.dumps([self.spec('Posted', 'test|p')]) })
+        self.assertContains(response, '1 new, 0 updated, 0 duplicates')
+
+class IngestStreamTest(TransactionTestCase):
+    def setUp(self):
+        Venue.objects.create(name='Test Venue')
+        Category.objects.create(name='Gigs')
+
+    def line(self, name, **kwargs):
+        return json.dumps(event_spec(name, origin_key='test|' + name, **kwargs)) + '\n'
+
+    def test_bad_records_are_skipped(self):
+        lines = [self.line('Event %d' % i) for i in range(7)]
+        lines[1] = '{not json\n'
+        lines[3] = self.line('Lost', venue='Nowhere')
+        lines[5] = self.line('Bad date', occurrences=[{ 'start_date' : '2013-13-45', 'start_time' : '20:00' }])
+        lines.insert(2, '\n')
+
+        added, updated, duplicates, errors = ingest.ingest_stream(lines, chunk_size=3)
+
+        self.assertEqual((added, updated, duplicates), (4, 0, 0))
+        self.assertEqual([line_no for line_no, message in errors], [2, 5, 7])
+        self.assertEqual(Event.objects.count(), 4)
+
+    def test_non_ascii_errors(self):
+        lines = [self.line('Good'), self.line(u'Caf\xe9 night', venue=u'Caf\xe9 Nowhere')]
+        added, updated, duplicates, errors = ingest.ingest_stream(lines, chunk_size=1)
+        self.assertEqual(added, 1)
+        self.assertEqual(errors, [(2, u"Failed to add event 'Caf\xe9 night': could not find venue 'Caf\xe9 Nowhere'")])
+
+        # Both the chunk and the per-record retry fail
+        added, updated, duplicates, errors = ingest.ingest_stream(lines[::-1], chunk_size=2)
+        self.assertEqual([line_no for line_no, message in errors], [1])
+
+    def test_command(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.line('One') + self.line('Two') + self.line('One'))
+        try:
+            out = StringIO()
+            call_command('ingest_events', filename, chunk_size=2, stdout=out, stderr=StringIO())
+        finally:
+            os.remove(filename)
+        self.assertIn('2 new, 0 updated, 1 duplicates, 0 errors', out.getvalue())
+
+    def test_upload_view(self):
+        upload = StringIO(self.line('Uploaded') + 'junk\n')
+        upload.name = 'events.jsonl'
+        response = self.client.post('/dailyinfo/batch-upload/', { 'event_file' : upload })
+        self.assertContains(response, '1 new, 0 updated, 0 duplicates')
+        self.assertContains(response, 'Line 2:')
+
+    def test_run_scrapers_command(self):
+        out = StringIO()
+        call_command('run_scrapers', 'testdata', chunk_size=2, stdout=out, stderr=StringIO())
+        self.assertIn('testdata: 3 new, 0 updated, 0 duplicates, 0 errors', out.getvalue())
+        self.assertEqual(Event.objects.get(origin_key='testdata|3').ticket_details, u'\xa34-6 advance, \xa38-10 on the door')
+
+        out = StringIO()
+        call_command('run_scrapers', 'testdata', no_cache=True, full=True, stdout=out, stderr=StringIO())
+        self.assertIn('testdata: 0 new, 0 updated, 3 duplicates, 0 errors', out.getvalue())
+
+    def test_run_scrapers_reports_non_ascii_errors(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'failing.py'), 'w') as f:
+            f.write("from scraper import ScraperBase\n\n"
+                    "class FailingScraper(ScraperBase):\n"
+                    "    def scrape(self, from_date, to_date):\n"
+                    "        raise Exception(u'Caf\\xe9 listing missing')\n\n"
+                    "def get_scraper():\n"
+                    "    return FailingScraper()\n")
+
+        err = StringIO()
+        sys.path.insert(0, settings.EVENTS_SCRAPER_DIR)
+        try:
+            self.assertRaises(CommandError, call_command, 'run_scrapers', 'failing', scraper_dir=directory,
+                              stdout=StringIO(), stderr=err)
+        finally:
+            sys.path.remove(settings.EVENTS_SCRAPER_DIR)
+            shutil.rmtree(directory)
+        self.assertIn(u'failing: scraper failed: Caf\xe9 listing missing', err.getvalue().decode('utf-8'))
+
+    def test_ingester_skips_repeats(self):
+        ingester = ingest.Ingester(chunk_size=10)
+        spec = json.loads(self.line('Repeated'))
+        for i in range(3):
+            ingester.add(spec)
+        ingester.add({ 'name' : 'Incomplete' })
+        self.assertEqual(len(ingester.records), 1)
+        ingester.close()
+        self.assertEqual((ingester.added, ingester.updated, ingester.duplicates), (1, 0, 2))
+        self.assertEqual(ingester.errors, [(4, "missing field 'description'")])
+
+class UpdateTest(EventTestCase):
+    def spec(self, **kwargs):
+        fields = { 'name' : 'Gig', 'description' : 'A gig', 'origin_key' : 'test|gig', 'ticket_details' : '5 pounds',
+                   'occurrences' : [occurrence_spec(2), occurrence_spec(3)] }
+        fields.update(kwargs)
+        return event_spec(**fields)
+
+    def test_unchanged_is_duplicate(self):
+        ingest.ingest_events([self.spec()])
+        reordered = self.spec()
+        reordered['occurrences'].reverse()
+        with self.assertNumQueries(3):
+            self.assertEqual(ingest.ingest_events([reordered]), (0, 0, 1))
+
+    def test_changed_fields_and_occurrences(self):
+        ingest.ingest_events([self.spec()])
+        ev = Event.objects.get(origin_key='test|gig')
+        kept = ev.occurrence_set.get(start_date=date(2013, 10, 2))
+
+        spec = self.spec(ticket_details='6 pounds', description='A better gig',
+                         occurrences=[occurrence_spec(2), occurrence_spec(4, '19:30')])
+        self.assertEqual(ingest.ingest_events([spec]), (0, 1, 0))
+
+        ev = Event.objects.get(origin_key='test|gig')
+        self.assertEqual(ev.ticket_details, '6 pounds')
+        self.assertEqual(ev.summary, 'A better gig ')
+        self.assertEqual(ev.fingerprint, Event.spec_fingerprint(spec))
+        self.assertEqual([(o.start_date.day, o.start_time) for o in ev.occurrence_set.all()], [(2, time(20, 0)), (4, time(19, 30))])
+        self.assertTrue(ev.occurrence_set.filter(id=kept.id).exists())
+
+        # Seen again, it's a duplicate
+        self.assertEqual(ingest.ingest_events([spec]), (0, 0, 1))
+
+    def test_missing_fingerprint(self):
+        ingest.ingest_events([self.spec()])
+        Event.objects.update(fingerprint='')
+        self.assertEqual(ingest.ingest_events([self.spec()]), (0, 0, 1))
+        self.assertNotEqual(Event.objects.get().fingerprint, '')
+
+    def test_add_from_json(self):
+        self.assertEqual(Event.add_from_json(self.spec()), 'added')
+        self.assertEqual(Event.add_from_json(self.spec()), 'duplicate')
+        self.assertEqual(Event.add_from_json(self.spec(name='Renamed gig')), 'updated')
+        self.assertEqual(Event.objects.get().name, 'Renamed gig')
+
+        self.assertRaises(Exception, Event.add_from_json, self.spec(category='Unknown'))
+        self.assertEqual(Event.objects.get().category, self.category)
+
+class SanitiseTest(TestCase):
+    def test_parity_with_soup_implementation(self):
+        with open(os.path.join(os.path.dirname(__file__), 'testdata', 'sanitise_corpus.json')) as f:
+            corpus = json.load(f)
+
+        for case in corpus:
+            self.assertEqual(sanitise.sanitise_html(case['description'], case['description_is_html']),
+                             sanitise.sanitise_html_soup(case['description'], case['description_is_html']),
+                             "Output differs for %r" % case['description'])
+
+    def test_rules(self):
+        self.assertEqual(sanitise.sanitise_html('<p class="x">a<script>b</script><font>c</font><br></p>', True),
+                         '<p>ac<br/></p>')
+        self.assertEqual(sanitise.sanitise_html('<a href="http://x/" target="_blank">x</a>', True),
+                         '<a href="http://x/">x</a>')
+        self.assertEqual(sanitise.sanitise_html('See http://example.com/a/long/path/here.', False),
+                         '<p>See <a href="http://example.com/a/long/path/here">http://example.com/a/l...</a>.</p>')
+
+class ParallelIngestTest(EventTestCase):
+    def specs(self, count):
+        return [event_spec('Event %d' % i, description='<p>Event <b>%d</b> %s</p>' % (i, 'word ' * i),
+                           description_is_html=True, origin_key='test|%d' % i) for i in range(count)]
+
+    def test_parallel_matches_serial(self):
+        specs = self.specs(ingest.PARALLEL_MIN_EVENTS + 10)
+        self.assertEqual(ingest.process_descriptions(specs, workers=2), ingest.process_descriptions(specs, workers=1))
+
+    def test_parallel_ingest(self):
+        specs = self.specs(ingest.PARALLEL_MIN_EVENTS + 10)
+        self.assertEqual(ingest.ingest_events(specs, workers=2), (len(specs), 0, 0))
+
+        ev = Event.objects.get(origin_key='test|59')
+        self.assertEqual(ev.description, '<p>Event <b>59</b> %s</p>' % ('word ' * 59))
+        self.assertTrue(ev.summary_truncated)
+        self.assertEqual((ev.summary, ev.summary_truncated), Event.summarise(ev.description))
+
+    def test_ingester_reuses_pool(self):
+        pools = []
+        real_pool = ingest.multiprocessing.Pool
+        def make_pool(*args, **kwargs):
+            pools.append(real_pool(*args, **kwargs))
+            return pools[-1]
+
+        ingest.multiprocessing.Pool = make_pool
+        try:
+            ingester = ingest.Ingester(chunk_size=ingest.PARALLEL_MIN_EVENTS, workers=2)
+            for spec in self.specs(ingest.PARALLEL_MIN_EVENTS * 3):
+                ingester.add(spec)
+            ingester.close()
+        finally:
+            ingest.multiprocessing.Pool = real_pool
+
+        self.assertEqual(ingester.added, ingest.PARALLEL_MIN_EVENTS * 3)
+        self.assertEqual(len(pools), 1)
+        self.assertIsNone(ingester.pool)
+
+    def test_web_ingest_is_serial(self):
+        real_pool = ingest.multiprocessing.Pool
+        def make_pool(*args, **kwargs):
+            raise AssertionError("worker pool started")
+
+        ingest.multiprocessing.Pool = make_pool
+        try:
+            response = self.client.post('/dailyinfo/batch-add/', { 'event_data' : json.dumps(self.specs(ingest.PARALLEL_MIN_EVENTS + 10)) })
+        finally:
+            ingest.multiprocessing.Pool = real_pool
+        self.assertContains(response, '%d new' % (ingest.PARALLEL_MIN_EVENTS + 10))
+
+class DescriptionCacheTest(EventTestCase):
+    def setUp(self):
+        super(DescriptionCacheTest, self).setUp()
+        descriptioncache.reset_stats()
+
+    def spec(self, i):
+        return event_spec('Event %d' % i, description='<p>Weekly <script>x</script>quiz</p>',
+                          description_is_html=True, origin_key='test|%d' % i)
+
+    def test_repeated_descriptions(self):
+        processed = []
+        def process(descriptions):
+            processed.extend(descriptions)
+            return [Event.process_description(*d) for d in descriptions]
+
+        descriptions = [(u'<p>One</p>', True), (u'<p>Two</p>', True), (u'<p>One</p>', True)]
+        results = descriptioncache.process_descriptions(descriptions, process)
+        self.assertEqual(results, [Event.process_description(*d) for d in descriptions])
+        self.assertEqual(sorted(processed), [(u'<p>One</p>', True), (u'<p>Two</p>', True)])
+
+        # Same text as plain text is a different description
+        descriptioncache.process_descriptions(descriptions + [(u'<p>One</p>', False)], process)
+        self.assertEqual(processed[2:], [(u'<p>One</p>', False)])
+        self.assertEqual(descriptioncache.get_stats(), { 'hits' : 4, 'misses' : 3 })
+
+    def test_ingest_uses_cache(self):
+        ingest.ingest_events([self.spec(i) for i in range(3)], workers=1)
+        Event.add_from_json(self.spec(3))
+        self.assertEqual(descriptioncache.get_stats(), { 'hits' : 3, 'misses' : 1 })
+        self.assertEqual(Event.objects.get(origin_key='test|3').description, '<p>Weekly quiz</p>')
+
+    def test_stats_command(self):
+        descriptioncache.process_descriptions([(u'a', False), (u'a', False)])
+        out = StringIO()
+        call_command('description_cache_stats', reset=True, stdout=out)
+        self.assertIn('Hit ratio: 50.0%', out.getvalue())
+        self.assertEqual(descriptioncache.get_stats(), { 'hits' : 0, 'misses' : 0 })
+
+    def test_stats_are_written_in_batches(self):
+        descriptioncache.process_descriptions([(u'a', False)])
+        self.assertEqual(DescriptionCacheStats.objects.count(), 0)
+
+        descriptioncache.process_descriptions([(u'a', False)] * descriptioncache.STATS_FLUSH_INTERVAL)
+        self.assertEqual(DescriptionCacheStats.objects.get().hits, descriptioncache.STATS_FLUSH_INTERVAL)
+        self.assertEqual(descriptioncache.get_stats(), { 'hits' : descriptioncache.STATS_FLUSH_INTERVAL, 'misses' : 1 })
+
+        descriptioncache.flush_stats()
+        self.assertEqual(DescriptionCacheStats.objects.get().misses, 1)
+
+    @override_settings(EVENTS_DESCRIPTION_CACHE_SIZE=10)
+    def test_cull_removes_oldest(self):
+        descriptioncache.process_descriptions([(u'Description %d' % i, False) for i in range(12)])
+        # Cut back to leave room for a tenth of the size
+        remaining = [cached.description for cached in CachedDescription.objects.order_by('id')]
+        self.assertEqual(len(remaining), 9)
+
+        processed = []
+        def process(descriptions):
+            processed.extend(descriptions)
+            return [Event.process_description(*d) for d in descriptions]
+        descriptioncache.process_descriptions([(u'Description 0', False), (u'Description 11', False)], process)
+        self.assertEqual(processed, [(u'Description 0', False)])
+
+    def test_key_includes_version(self):
+        key = descriptioncache.description_key(u'a', False)
+        real_version = descriptioncache.VERSION
+        descriptioncache.VERSION += 1
+        try:
+            self.assertNotEqual(descriptioncache.description_key(u'a', False), key)
+        finally:
+            descriptioncache.VERSION = real_version
@@ -0,0 +1,170 @@
+# Word truncation for event summaries
+#
+# keep_first_nwords() gives the same result as keep_first_nwords_reference(), the original
+# implementation, which counts the words in a tag by splitting its get_text() - for every
+# child at every level of the tree, so nested descriptions take quadratic time. Here each
+# node's text is summarised once, bottom-up, in a form which can be combined the way
+# get_text() concatenates strings, and the words of every tag counted from that.
+import re
+
+from bs4 import BeautifulSoup, NavigableString, CData
+
+WHITESPACE_RE = re.compile(r'[\s]+')
+WHITESPACE_CHARS = frozenset(' \t\n\r\f\v')
+
+# Strings included in Tag.get_text() (other NavigableString subclasses, such as comments,
+# are not)
+TEXT_TYPES = (NavigableString, CData)
+
+def word_count(text):
+    """Number of words in a string or tag, as counted by the original implementation"""
+    if not (isinstance(text, str) or isinstance(text, NavigableString)):
+        text = text.get_text()
+    words = re.split(r'[\s]+', text)
+    return len(words)
+
+# A summary of a piece of text is a tuple (number of whitespace runs, starts with
+# whitespace, ends with whitespace), or None for the empty string. The text has one more
+# word than it has whitespace runs, as re.split() returns empty strings at the ends.
+
+def _text_summary(text):
+    if len(text) == 0:
+        return None
+    return (len(WHITESPACE_RE.findall(text)), text[0] in WHITESPACE_CHARS, text[-1] in WHITESPACE_CHARS)
+
+def _join(a, b):
+    """Summary of the concatenation of two pieces of text"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (a[0] + b[0] - (1 if a[2] and b[1] else 0), a[1], b[2])
+
+def _count(summary):
+    return 1 if summary is None else summary[0] + 1
+
+def word_counts(tag):
+    """
+    Returns a dictionary mapping id() of each descendant of tag (and tag itself) to its
+    word_count(), in one pass over the tree.
+    """
+    counts = {}
+
+    def visit(node):
+        if isinstance(node, NavigableString):
+            summary = _text_summary(node)
+            counts[id(node)] = _count(summary)
+            return summary if type(node) in TEXT_TYPES else None
+
+        summary = None
+        for child in node.contents:
+            summary = _join(summary, visit(child))
+        counts[id(node)] = _count(summary)
+        return summary
+
+    visit(tag)
+    return counts
+
+def _remove_children_from(tag, index):
+    """Removes tag's children from index onwards, like calling extract() on each of them"""
+    removed = tag.contents[index:]
+    if len(removed) == 0:
+        return
+
+    first = removed[0]
+    last_descendant = removed[-1]._last_descendant()
+    next_element = last_descendant.next_element
+
+    if first.previous_element is not None:
+        first.previous_element.next_element = next_element
+    if next_element is not None:
+        next_element.previous_element = first.previous_element
+    first.previous_element = None
+    last_descendant.next_element = None
+
+    if first.previous_sibling is not None:
+        first.previous_sibling.next_sibling = None
+    first.previous_sibling = None
+
+    for child in removed:
+        child.parent = None
+    del tag.contents[index:]
+
+def keep_first_nwords(tag, max_words, counts=None):
+    """
+    Truncates tag in place so it contains at most max_words words, cutting the string
+    which contains the last word allowed. Returns True if anything was removed.
+
+    counts is the result of word_counts(tag), if the caller already has it.
+    """
+    if counts is None:
+        counts = word_counts(tag)
+
+    if counts[id(tag)] <= max_words:
+        return False
+
+    # Only one child at each level needs truncating, so walk down the tree instead of
+    # recursing. The counts stay valid as nothing inside that child has changed yet.
+    while tag is not None:
+        words = 0
+        next_tag = None
+        for index, child in enumerate(tag.contents):
+            # If we already have enough words, remove this child and the rest
+            if words >= max_words:
+                _remove_children_from(tag, index)
+                break
+
+            # This child won't take us over our word limit, leave it alone
+            elif words + counts[id(child)] <= max_words:
+                words += counts[id(child)]
+
+            # We need to truncate this child
+            elif isinstance(child, NavigableString):
+                word_list = re.split(r'[\s]+', child)
+                child.replace_with(BeautifulSoup('', 'html.parser').new_string(" ".join(word_list[0:(max_words-words)])))
+                words = max_words
+
+            else: # It's a tag
+                next_tag, next_max_words = child, max_words - words
+                words = max_words
+
+        if next_tag is not None:
+            tag, max_words = next_tag, next_max_words
+        else:
+            tag = None
+
+    return True
+
+def keep_first_nwords_reference(tag, max_words):
+    """
+    Original implementation of keep_first_nwords(), which takes quadratic time on nested
+    tags. Used for testing and benchmarking.
+    """
+    if word_count(tag) > max_words:
+        words = 0
+
+        to_remove = []
+        for child in tag.children:
+            # If we already have too many words, queue child for destruction
+            if words >= max_words:
+                to_remove.append(child)
+
+            # This child won't take us over our word limit, leave it alone
+            elif words + word_count(child) <= max_words:
+                words += word_count(child)
+
+            # We need to truncate this child
+            elif isinstance(child, NavigableString):
+                word_list = re.split(r'[\s]+', child)
+                s = BeautifulSoup('', 'html.parser').new_string(" ".join(word_list[0:(max_words-words)]) )
+                child.replace_with(s)
+                words = max_words
+
+            else: # It's a tag
+                keep_first_nwords_reference(child, max_words - words)
+                words = max_words
+
+        map(lambda x: x.extract(), to_remove)
+        return True    # tag was truncated
+    else:
+        return False
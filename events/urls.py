@@ -14,4 +14,5 @@ urlpatterns = patterns('',
     url(r'^event/(?P<pk>\d+)', views.EventDetailView.as_view(), name='event'),
 
     url(r'^batch-add/$', views.BatchAddView.as_view()),
+    url(r'^batch-upload/$', views.BatchUploadView.as_view()),
     )
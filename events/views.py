@@ -1,45 +1,112 @@
 from datetime import date, datetime, timedelta
+import hashlib
 import json
 
 from django.http import HttpResponse
 from django.views import generic
 from django import forms
-from django.utils import safestring
+from django.utils import safestring, timezone
 from django.shortcuts import render
+from django.template.loader import render_to_string
 from django.db import transaction
+from django.db.models import Max, Count
+from django.views.decorators.http import condition
 import django.core.urlresolvers as urlresolvers
 
 from models import *
 from misc import date2str, time2str
 import queries
+import pagecache
+import ingest
 
 class AllEventsView(generic.ListView):
     model = Event
     template_name = "events/event_list.html"
 
-class PeriodView(generic.TemplateView):
+def make_etag(*parts):
+    return hashlib.md5('|'.join(unicode(part) for part in parts)).hexdigest()
+
+class ConditionalMixin(object):
+    """
+    Answers conditional GET requests with 304 Not Modified. Views override get_etag()
+    and/or get_last_modified(), which should be cheap: they are called before any
+    other processing of the request.
+    """
+    def get_etag(self):
+        return None
+
+    def get_last_modified(self):
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        handler = super(ConditionalMixin, self).dispatch
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+
+        # The view's attributes are only set up by as_view() once dispatch is called
+        self.request, self.args, self.kwargs = request, args, kwargs
+        return condition(etag_func = lambda request, *args, **kwargs: self.get_etag(),
+                         last_modified_func = lambda request, *args, **kwargs: self.get_last_modified())(handler)(request, *args, **kwargs)
+
+class PeriodView(ConditionalMixin, generic.TemplateView):
     template_name = 'events/event_list.html'
-    
-    def get_context_data(self, **kwargs):
-        context = super(PeriodView, self).get_context_data(**kwargs)
 
+    def get_start_date(self):
         if 'start_date' in self.kwargs and self.kwargs['start_date'] is not None:
-            start_date = datetime.strptime(self.kwargs['start_date'], "%Y-%m-%d").date()
+            return datetime.strptime(self.kwargs['start_date'], "%Y-%m-%d").date()
         else:
-            start_date = date.today()
+            return date.today()
+
+    def get_wanted_categories(self):
+        """If available, get list of category IDs we're interested in"""
+        if 'categories' in self.request.GET:
+            try:
+                return map(lambda x: int(x), self.request.GET['categories'].split(","))
+            except ValueError:
+                pass
+        return None
+
+    def get_etag(self):
+        start_date = self.get_start_date()
+        end_date = start_date + timedelta(days=self.days - 1)
+        categories = self.get_wanted_categories()
+
+        if categories is None:
+            modified = queries.EventsModified(start_date=start_date, end_date=end_date)
+        else:
+            modified = queries.EventsModified(start_date=start_date, end_date=end_date, categories=categories)
+            categories = sorted(set(categories))
+
+        # The page lists every category, not just those of the events on it
+        categories_modified = queries.CategoriesModified()
+
+        # Include today's date as pages show relative dates ("Tomorrow" etc.)
+        return make_etag(self.url_name, start_date, categories, date.today(),
+                         modified['last_modified'], modified['venue_last_modified'], modified['count'],
+                         categories_modified['last_modified'], categories_modified['count'])
+
+    def get(self, request, *args, **kwargs):
+        # Serve the rendered page from the page cache if possible
+        key = pagecache.page_key(self.url_name, self.get_start_date(), self.days, self.get_wanted_categories())
+        response = pagecache.get_page(key)
+
+        if response is None:
+            response = super(PeriodView, self).get(request, *args, **kwargs)
+            response.render()
+            pagecache.set_page(key, response)
+
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super(PeriodView, self).get_context_data(**kwargs)
 
+        start_date = self.get_start_date()
         end_date = start_date + timedelta(days=self.days - 1)
 
         context['start_date'] = start_date
         context['end_date'] = end_date
 
-        # If available, get list of category IDs we're interested in
-        wanted_categories = None
-        if 'categories' in self.request.GET:
-            try:
-                wanted_categories = map(lambda x: int(x), self.request.GET['categories'].split(","))
-            except ValueError:
-                pass
+        wanted_categories = self.get_wanted_categories()
 
         # If no category set has been specified, get everything within the date range
         if wanted_categories is None:
@@ -50,6 +117,7 @@ class PeriodView(generic.TemplateView):
         # Set occurrence range
         for ev in context['event_list']:
             ev.set_occurrence_range(start_date=start_date, end_date=end_date)
+        queries.PrefetchOccurrences(context['event_list'])
 
         context['next_url'] = urlresolvers.reverse(self.url_name, kwargs = {'start_date' : "{0:%Y-%m-%d}".format(start_date + timedelta(days=self.days))} )
         context['prev_url'] = urlresolvers.reverse(self.url_name, kwargs = {'start_date' : "{0:%Y-%m-%d}".format(start_date - timedelta(days=self.days))} )
@@ -69,10 +137,8 @@ class PeriodView(generic.TemplateView):
                     cat.active = False
 
         # See which categories we actually have in the date range
-        available_categories = {}
-        for ev in context['event_list']:
-            available_categories[ev.category.id] = True
-            
+        available_categories = queries.AvailableCategories(start_date=start_date, end_date=end_date)
+
         for cat in categories:
             if cat.id in available_categories:
                 cat.available = True
@@ -117,27 +183,73 @@ class DayView(PeriodView):
 
         return context
 
-class EventDetailView(generic.DetailView):
+class EventDetailView(ConditionalMixin, generic.DetailView):
     model = Event
     template_name = "events/event_detail.html"
 
+    def get_modified(self):
+        if not hasattr(self, 'modified'):
+            self.modified = Event.objects.filter(pk=self.kwargs['pk']).aggregate(last_modified = Max('last_modified'),
+                                                                                venue_last_modified = Max('venue__last_modified'))
+        return self.modified
+
+    def get_hour(self):
+        # Occurrences are shown differently once they are in the past, so the page
+        # changes every hour as well as when the event does
+        if not hasattr(self, 'hour'):
+            self.hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        return self.hour
+
+    def get_last_modified(self):
+        modified = self.get_modified()
+        if modified['last_modified'] is None:
+            return None
+        return max(modified['last_modified'], modified['venue_last_modified'], self.get_hour())
+
+    def get_etag(self):
+        last_modified = self.get_last_modified()
+        if last_modified is None:
+            return None
+        return make_etag('event', self.kwargs['pk'], last_modified, self.get_hour().strftime("%Y-%m-%d %H"))
+
 class VenueListView(generic.ListView):
     model = Venue
     template_name = "events/venue_list.html"
 
-class VenueDetailView(generic.DetailView):
+    def get_context_data(self, **kwargs):
+        context = super(VenueListView, self).get_context_data(**kwargs)
+
+        event_counts = queries.UpcomingEventCounts(days=7)
+        for venue in context['venue_list']:
+            venue.this_week_count = event_counts.get(venue.id, 0)
+
+        return context
+
+class VenueDetailView(ConditionalMixin, generic.DetailView):
     model = Venue
     template_name = "events/venue_detail.html"
 
+    def get_etag(self):
+        modified = Venue.objects.filter(pk=self.kwargs['pk']).aggregate(last_modified = Max('last_modified'),
+                                                                        events_last_modified = Max('event__last_modified'),
+                                                                        count = Count('event'))
+        if modified['last_modified'] is None:
+            return None
+        # Upcoming/recent events are relative to today
+        return make_etag('venue', self.kwargs['pk'], date.today(),
+                         modified['last_modified'], modified['events_last_modified'], modified['count'])
+
     def get_context_data(self, **kwargs):
         context = super(VenueDetailView, self).get_context_data(**kwargs)
         context['upcoming_events'] = queries.UpcomingEvents(venue = self.object)[0:10]
         for ev in context['upcoming_events']:
             ev.set_occurrence_range(start_date=date.today())
+        queries.PrefetchOccurrences(context['upcoming_events'])
 
         context['recent_events'] = queries.RecentEvents(venue = self.object)[0:10]
         for ev in context['recent_events']:
             ev.set_occurrence_range(end_date=date.today() - timedelta(days=1))
+        queries.PrefetchOccurrences(context['recent_events'])
 
         return context
 
@@ -150,21 +262,11 @@ class BatchAddForm(forms.Form):
 
     def perform_insert(self):
         scraped_events = json.loads(self.cleaned_data['event_data'])
-        added = 0
-        updated = 0
-        duplicates = 0
-
-        with transaction.commit_on_success():
-            for ev_spec in scraped_events:
-                result = Event.add_from_json(ev_spec)
-                if result == 'added':
-                    added += 1
-                elif result == 'updated':
-                    updated += 1
-                elif result == 'duplicate':
-                    duplicates += 1
-
-        return (added,updated,duplicates)
+
+        # Don't fork worker processes from the web server
+        with pagecache.deferred_invalidation():
+            with transaction.commit_on_success():
+                return ingest.ingest_events(scraped_events, workers=1)
 
 class BatchAddView(generic.FormView):
     form_class = BatchAddForm
@@ -178,3 +280,20 @@ class BatchAddView(generic.FormView):
 """ % (added,updated,duplicates))
         
         return render(self.request, 'events/base.html', {'content' : content})
+
+class BatchUploadForm(forms.Form):
+    event_file = forms.FileField(label='Event file (one JSON event per line)')
+
+    def perform_insert(self):
+        return ingest.ingest_stream(self.cleaned_data['event_file'], workers=1)
+
+class BatchUploadView(generic.FormView):
+    form_class = BatchUploadForm
+    template_name = 'events/batch_add.html'
+
+    def form_valid(self, form):
+        added,updated,duplicates,errors = form.perform_insert()
+        content = render_to_string('events/batch_add_result.html',
+                                   { 'added' : added, 'updated' : updated, 'duplicates' : duplicates, 'errors' : errors })
+
+        return render(self.request, 'events/base.html', {'content' : safestring.mark_safe(content)})
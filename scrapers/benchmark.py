@@ -0,0 +1,80 @@
+# Benchmarks scrapers on their saved test data
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import scraper as scraper_module
+
+def recorded_scrapers(directory='.'):
+    """Returns the names of scrapers which have saved test data (a <name>.testdata directory)"""
+    return sorted(filename[:-len('.testdata')] for filename in os.listdir(directory)
+                  if filename.endswith('.testdata') and os.path.exists(os.path.join(directory, filename[:-len('.testdata')] + '.py')))
+
+def replay(name, targeted_parsing, parser=None, from_date=None, to_date=None):
+    """
+    Runs a scraper on its saved test data. Returns a tuple (total time, time spent
+    parsing, number of events).
+    """
+    scraper = scraper_module.load_scraper(name)
+    scraper.use_local_data = True
+    scraper.targeted_parsing = targeted_parsing
+    if parser is not None:
+        scraper.parser = parser
+
+    # Keep the scraper's progress messages out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        scraper.scrape(from_date, to_date)
+        total = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        scraper.close()
+
+    return total, scraper.parse_time, scraper.event_count
+
+def main():
+    parser = ArgumentParser(description="Replays scrapers' saved test data (see scraper.py -s) and reports "
+                                        "how long they take with targeted and full parsing")
+    parser.add_argument('scraper_names', nargs='*')
+    parser.add_argument('--repeat', '-r', dest='repeat', type=int, default=5)
+    parser.add_argument('--parser', dest='parser', help="BeautifulSoup parser to use (default %s)" % scraper_module.DEFAULT_PARSER)
+    parser.add_argument('--from-date', '-F', dest='from_date', help="date range the test data was saved with")
+    parser.add_argument('--to-date', '-T', dest='to_date')
+
+    args = parser.parse_args()
+
+    names = args.scraper_names or recorded_scrapers()
+    if len(names) == 0:
+        print "No saved test data found; save some with 'scraper.py -s name'"
+        return
+
+    dates = {}
+    for field in ('from_date', 'to_date'):
+        if getattr(args, field) is not None:
+            dates[field] = datetime.strptime(getattr(args, field), "%Y-%m-%d")
+
+    print "%-16s %-8s %7s %9s %9s %10s" % ('scraper', 'parsing', 'events', 'total', 'parse', 'events/s')
+    for name in names:
+        results = {}
+        for mode, targeted in (('full', False), ('targeted', True)):
+            try:
+                # Take the fastest run, which is the least disturbed by anything else
+                runs = [replay(name, targeted, args.parser, **dates) for i in range(args.repeat)]
+            except Exception as e:
+                print "%-16s %-8s failed: %s" % (name, mode, e)
+                break
+
+            total, parse_time, events = min(runs)
+            results[mode] = total
+            print "%-16s %-8s %7d %8.3fs %8.3fs %10.1f" % (name, mode, events, total, parse_time, events / total if total > 0 else 0)
+
+        if len(results) == 2 and results['targeted'] > 0:
+            print "%-16s speedup  %.1fx" % (name, results['full'] / results['targeted'])
+
+if __name__ == '__main__':
+    main()
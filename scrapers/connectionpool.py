@@ -0,0 +1,91 @@
+# Keep-alive HTTP connections for scrapers
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+
+class ConnectionPool(object):
+    """
+    Keeps HTTP connections open between requests, so that fetching many pages from one
+    site doesn't open a new connection each time. Safe to use from several threads; each
+    connection is only used by one request at a time.
+    """
+    max_redirects = 5
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.idle = {}      # (scheme, host) => list of idle connections
+        self.lock = threading.Lock()
+
+    def _get_connection(self, scheme, host):
+        """Returns (connection, whether it has been used before)"""
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _put_connection(self, scheme, host, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(connection)
+
+    def _request_once(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported URL scheme in '%s'" % url)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # A connection the server has closed since we last used it only shows up as an
+        # error when we try to use it, so retry those once on a fresh connection
+        while True:
+            connection, reused = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._put_connection(parts.scheme, parts.netloc, connection)
+
+        return response.status, response.reason, response.msg, body
+
+    def request(self, url, headers=None):
+        """
+        GETs url, following redirects. Returns a tuple (status, response headers, body),
+        where status is 200 or 304; raises urllib2.HTTPError for other statuses.
+        """
+        if headers is None:
+            headers = {}
+
+        for i in range(self.max_redirects + 1):
+            status, reason, response_headers, body = self._request_once(url, headers)
+            if status in (301, 302, 303, 307) and response_headers.getheader('location'):
+                url = urlparse.urljoin(url, response_headers.getheader('location'))
+                continue
+            if status not in (200, 304):
+                raise urllib2.HTTPError(url, status, reason, response_headers, None)
+            return status, response_headers, body
+
+        raise urllib2.HTTPError(url, status, "Too many redirects", response_headers, None)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
@@ -0,0 +1,71 @@
+# Record of what a scraper found on previous runs
+import json
+import os
+import time
+
+class CrawlState(object):
+    """
+    Remembers the items (events, say) a scraper has seen, keyed by an ID such as the one
+    in the item's URL. For each it records when the ID was last listed ('seen'), when its
+    detail page was last fetched ('fetched'), the SHA-1 of that page and the events
+    found on it, so unchanged items can be reported again without fetching or parsing
+    their pages.
+
+    The state is kept in memory and written to filename by save(). Items not seen for
+    expiry seconds are dropped then.
+    """
+    def __init__(self, filename, expiry=None):
+        self.filename = filename
+        self.expiry = expiry
+        self.changed = False
+
+        self.items = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.items = json.load(f)
+
+    def get(self, item_id):
+        """Returns the entry for item_id (a dictionary with 'seen', 'fetched', 'sha1' and 'events') or None"""
+        return self.items.get(item_id)
+
+    def seen(self, item_id):
+        """Records that item_id was listed on this run"""
+        entry = self.items.get(item_id)
+        if entry is not None:
+            entry['seen'] = time.time()
+            self.changed = True
+
+    def needs_fetch(self, item_id, max_age):
+        """Whether item_id is new or its page was fetched more than max_age seconds ago (None for never)"""
+        entry = self.items.get(item_id)
+        if entry is None:
+            return True
+        return max_age is not None and time.time() - entry['fetched'] > max_age
+
+    def touch(self, item_id):
+        """Records that item_id's page was fetched again and had not changed"""
+        self.items[item_id]['fetched'] = time.time()
+        self.changed = True
+
+    def record(self, item_id, sha1, events):
+        """Records the SHA-1 of item_id's page, just fetched, and the events found on it"""
+        now = time.time()
+        self.items[item_id] = { 'seen' : now, 'fetched' : now, 'sha1' : sha1, 'events' : events }
+        self.changed = True
+
+    def save(self):
+        if self.expiry is not None:
+            cutoff = time.time() - self.expiry
+            for item_id, entry in self.items.items():
+                if entry['seen'] < cutoff:
+                    del self.items[item_id]
+                    self.changed = True
+
+        if not self.changed:
+            return
+
+        # Write under a temporary name, so there's never a partial file
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.items, f, separators=(',', ':'))
+        os.rename(self.filename + '.tmp', self.filename)
+        self.changed = False
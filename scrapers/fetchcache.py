@@ -0,0 +1,135 @@
+# Store of previously fetched pages
+import json
+import hashlib
+import os
+import threading
+import time
+import zlib
+
+class FetchCache(object):
+    """
+    Stores the body of each page fetched along with the validators (ETag and
+    Last-Modified) the server sent, so the page can be requested again with
+    If-None-Match/If-Modified-Since and a 304 response answered from the stored copy,
+    or not requested at all if it was fetched recently enough.
+
+    Bodies are compressed and stored under the SHA-1 of their content, so identical pages
+    are only stored once; an index maps URLs to them. When the stored bodies take up more
+    than max_size bytes, the least recently used URLs are dropped. The index is kept in
+    memory and written out (after any eviction) by save().
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.index_filename = os.path.join(directory, 'index.json')
+        self.objects_directory = os.path.join(directory, 'objects')
+        self.lock = threading.Lock()
+        self.changed = False
+
+        self.index = {}
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as f:
+                # Ignore entries from before bodies were content-addressed
+                self.index = dict((url, entry) for url, entry in json.load(f).items() if 'sha1' in entry)
+
+    def _object_filename(self, digest):
+        return os.path.join(self.objects_directory, digest + '.z')
+
+    def get(self, url):
+        """
+        Returns the stored entry for url, or None. The entry is a dictionary with 'etag',
+        'last_modified', 'fetched' (when the page was last fetched or found to be
+        unchanged) and 'used' times.
+        """
+        with self.lock:
+            entry = self.index.get(url)
+        if entry is None or not os.path.exists(self._object_filename(entry['sha1'])):
+            return None
+        return entry
+
+    def is_fresh(self, entry, max_age):
+        """Whether an entry was fetched no more than max_age seconds ago (None for no limit)"""
+        return max_age is not None and time.time() - entry['fetched'] <= max_age
+
+    def body(self, url):
+        with self.lock:
+            entry = self.index[url]
+            entry['used'] = time.time()
+            self.changed = True
+        with open(self._object_filename(entry['sha1']), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def put(self, url, data, etag=None, last_modified=None):
+        """Stores a page and its validators"""
+        digest = hashlib.sha1(data).hexdigest()
+        filename = self._object_filename(digest)
+
+        if not os.path.exists(filename):
+            if not os.path.exists(self.objects_directory):
+                try:
+                    os.makedirs(self.objects_directory)
+                except OSError:
+                    # another thread got there first
+                    pass
+
+            # Write under a temporary name, so there's never a partial file
+            temp_filename = '%s.%d.tmp' % (filename, threading.current_thread().ident)
+            with open(temp_filename, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.rename(temp_filename, filename)
+
+        now = time.time()
+        with self.lock:
+            self.index[url] = { 'etag' : etag, 'last_modified' : last_modified, 'sha1' : digest,
+                                'size' : os.path.getsize(filename), 'fetched' : now, 'used' : now }
+            self.changed = True
+
+    def touch(self, url):
+        """Records that the stored copy of url was found to be up to date"""
+        with self.lock:
+            if url in self.index:
+                self.index[url]['fetched'] = time.time()
+                self.changed = True
+
+    def size(self):
+        """Total size of the stored bodies, in bytes"""
+        with self.lock:
+            return sum(dict((entry['sha1'], entry['size']) for entry in self.index.values()).values())
+
+    def evict(self):
+        """Drops the least recently used URLs until the stored bodies fit in max_size"""
+        with self.lock:
+            sizes = dict((entry['sha1'], entry['size']) for entry in self.index.values())
+            if self.max_size is not None:
+                refs = {}
+                for entry in self.index.values():
+                    refs[entry['sha1']] = refs.get(entry['sha1'], 0) + 1
+
+                total = sum(sizes.values())
+                for url, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+                    if total <= self.max_size:
+                        break
+                    del self.index[url]
+                    self.changed = True
+                    refs[entry['sha1']] -= 1
+                    if refs[entry['sha1']] == 0:
+                        total -= entry['size']
+
+            # Remove bodies no URL refers to any more
+            if os.path.exists(self.objects_directory):
+                referenced = set(entry['sha1'] + '.z' for entry in self.index.values())
+                for filename in os.listdir(self.objects_directory):
+                    if filename.endswith('.z') and filename not in referenced:
+                        os.remove(os.path.join(self.objects_directory, filename))
+
+    def save(self):
+        self.evict()
+        with self.lock:
+            if not self.changed:
+                return
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(self.index_filename + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.rename(self.index_filename + '.tmp', self.index_filename)
+            self.changed = False
@@ -1,6 +1,5 @@
 from scraper import ScraperBase
 from datetime import datetime
-from bs4 import BeautifulSoup
 import re
 
 class HotNumbersScraper(ScraperBase):
@@ -9,7 +8,7 @@ class HotNumbersScraper(ScraperBase):
         self.category = 'Gigs'
 
         raw = self.fetch("http://hotnumberscoffee.co.uk/live-music/")
-        soup = BeautifulSoup(raw)
+        soup = self.parse(raw, "article", class_="eventlist-event")
 
         for ev_node in soup("article", class_="eventlist-event"):
             ev_spec = {}
@@ -1,6 +1,5 @@
-from scraper import ScraperBase
-from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+from scraper import ScraperBase, date_windows
+from datetime import datetime
 import re
 
 class PortlandArmsScraper(ScraperBase):
@@ -14,27 +13,34 @@ class PortlandArmsScraper(ScraperBase):
                     return True
             return False
 
-        # Extract event IDs. Some may be duplicates (for repeating events)
-        event_ids = set()
-
-        for month, year in self.get_month_list(from_date, to_date):
-            url = "http://www.theportlandarms.co.uk/mbbs2//calendar/calendar-view.asp?calendarid=3&month=%d&year=%d" % (month,year)
-            calendar_soup = BeautifulSoup(self.fetch(url))
-
+        def calendar_event_ids(window):
+            start, end = window
+            url = "http://www.theportlandarms.co.uk/mbbs2//calendar/calendar-view.asp?calendarid=3&month=%d&year=%d" % (start.month, start.year)
+            calendar_soup = self.parse(self.fetch(url), "a", href=re.compile(r'^event-view\.asp'))
 
+            ids = []
             for ev_link_node in calendar_soup(is_event_link):
                 mo = re.match(r'event-view.asp\?eventid=(\d+)', ev_link_node['href'])
                 if mo is None:
                     print "Warning: failed to extract event ID for event '%s'" % ev_link_node.string
                     continue
 
-                event_ids.add(mo.group(1))
+                ids.append(mo.group(1))
+            return ids
 
-        # Crawl all linked event pages
-        for i, event_id in enumerate(event_ids):
-            url = "http://www.theportlandarms.co.uk/mbbs2//calendar/event-view.asp?eventid=%s" % event_id
-            raw = self.fetch(url, "event %d/%d" % (i+1, len(event_ids)))
-            ev_soup = BeautifulSoup(raw)
+        # Extract event IDs from each month's calendar page, fetched concurrently. Some may
+        # be duplicates (for repeating events)
+        event_ids = set()
+        for window, ids in self.map_concurrent(calendar_event_ids, date_windows(from_date, to_date)):
+            event_ids.update(ids)
+
+        # Crawl linked event pages. Pages are fetched concurrently and arrive in any order;
+        # those of events seen on recent runs are skipped (see ScraperBase.fetch_items)
+        items = [(event_id, "http://www.theportlandarms.co.uk/mbbs2//calendar/event-view.asp?eventid=%s" % event_id)
+                 for event_id in sorted(event_ids)]
+
+        for event_id, url, raw in self.fetch_items(items, 'event'):
+            ev_soup = self.parse(raw, "td", class_="maintable")
             table_node = ev_soup.find("td", class_="maintable").find("table", class_="bbstable")
 
             ev_spec = { 'name' : table_node.find("td", class_="messagecellheader").get_text(),
@@ -69,14 +75,12 @@ class PortlandArmsScraper(ScraperBase):
                 ev_spec['occurrences'] = [self.occurrence(start_date = datetime.strptime(single_date.group(1), '%d/%m/%Y'),
                                                           start_time = start_time_parsed)]
             else:
-                # Create an occurrence for each day in the range
+                # The event happens every day in the range
                 first_date = datetime.strptime(date_range.group(1), '%d/%m/%Y')
                 last_date = datetime.strptime(date_range.group(2), '%d/%m/%Y')
                 ev_spec['occurrences'] = []
-                d = first_date
-                while d < last_date + timedelta(seconds=1):
-                    ev_spec['occurrences'] += [self.occurrence(start_date = d, start_time = start_time_parsed)]
-                    d += timedelta(days=1)
+                ev_spec['recurrences'] = [self.recurrence(start_date = first_date, end_date = last_date,
+                                                          start_time = start_time_parsed)]
 
             self.add_event(**ev_spec)
 
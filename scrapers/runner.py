@@ -0,0 +1,169 @@
+# Runs several scrapers at once
+import json
+import multiprocessing
+import os
+import Queue
+import re
+import sys
+import time
+import traceback
+from argparse import ArgumentParser
+from datetime import datetime
+
+import scraper as scraper_module
+
+GET_SCRAPER_RE = re.compile(r'^def get_scraper\(', re.M)
+
+# Scrapers which only run when named (such as testdata.py) set discover = False
+NO_DISCOVER_RE = re.compile(r'^discover\s*=\s*False\b', re.M)
+
+def discover_scrapers(directory='.'):
+    """
+    Returns the names of the scraper implementation files (those defining get_scraper())
+    in directory, apart from those which set discover = False
+    """
+    names = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.py'):
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            source = f.read()
+        if GET_SCRAPER_RE.search(source) is not None and NO_DISCOVER_RE.search(source) is None:
+            names.append(filename[:-3])
+    return names
+
+def _run_one(name, options, results):
+    # Runs in a worker process. Output goes to <name>.log so scrapers don't interleave.
+    sys.stdout = open(name + '.log', 'w', 1)
+    result = { 'name' : name }
+    scraper = None
+    try:
+        scraper = scraper_module.load_scraper(name)
+        scraper.use_local_data = options['use_local']
+        if options['max_age'] is not None:
+            scraper.cache_max_age = options['max_age']
+        if options['no_cache']:
+            scraper.use_fetch_cache = False
+        scraper.full_crawl = options['full']
+
+        scraper_module.run_scraper(scraper, options['from_date'], options['to_date'])
+        result['status'] = 'ok'
+        result['events'] = scraper.event_count
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+
+    if scraper is not None:
+        result['fetch_counts'] = scraper.fetch_counts
+    results.put(result)
+
+def run_scrapers(names, jobs=4, timeout=600, **options):
+    """
+    Runs the named scrapers, up to jobs at a time, each in its own process. A scraper
+    still running after timeout seconds is killed.
+
+    Returns a list with a dictionary for each scraper, containing its 'name', 'status'
+    ('ok', 'failed' or 'timeout'), 'duration' in seconds and, if available, the number of
+    'events' it found and its 'fetch_counts' (see ScraperBase.fetch_counts).
+    """
+    options.setdefault('use_local', False)
+    options.setdefault('max_age', None)
+    options.setdefault('no_cache', False)
+    options.setdefault('full', False)
+    options.setdefault('from_date', None)
+    options.setdefault('to_date', None)
+
+    results = multiprocessing.Queue()
+    waiting = list(names)
+    running = {}        # name => (process, start time)
+    finished = {}       # name => result
+
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < jobs:
+            name = waiting.pop(0)
+            process = multiprocessing.Process(target=_run_one, args=(name, options, results))
+            process.start()
+            running[name] = (process, time.time())
+
+        time.sleep(0.1)
+
+        # Collect results before joining, so no process is left blocked writing to the queue
+        while not results.empty():
+            result = results.get()
+            finished[result['name']] = result
+
+        for name, (process, start) in running.items():
+            if not process.is_alive():
+                process.join()
+                # Results can arrive after the process exits
+                deadline = time.time() + 1
+                while name not in finished and time.time() < deadline:
+                    try:
+                        result = results.get(True, 0.1)
+                        finished[result['name']] = result
+                    except Queue.Empty:
+                        pass
+
+                if name not in finished:
+                    finished[name] = { 'name' : name, 'status' : 'failed',
+                                       'error' : 'worker exited with code %s' % process.exitcode }
+            elif time.time() - start > timeout:
+                process.terminate()
+                process.join()
+                finished[name] = { 'name' : name, 'status' : 'timeout' }
+
+                # Remove the unfinished output file
+                if os.path.exists(name + '.json.tmp'):
+                    os.remove(name + '.json.tmp')
+            else:
+                continue
+
+            finished[name]['duration'] = time.time() - start
+            del running[name]
+
+    return [finished[name] for name in names]
+
+def main():
+    parser = ArgumentParser(description="Runs all scrapers (or the ones named) in parallel")
+    parser.add_argument('scraper_names', nargs='*')
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=4,
+                        help="number of scrapers to run at once")
+    parser.add_argument('--timeout', dest='timeout', type=int, default=600,
+                        help="seconds after which a scraper is stopped")
+    parser.add_argument('--test', '-t', dest='use_local', action='store_true')
+    parser.add_argument('--from-date', '-F', dest='from_date')
+    parser.add_argument('--to-date', '-T', dest='to_date')
+    parser.add_argument('--max-age', '-m', dest='max_age', type=scraper_module.parse_age)
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true')
+    parser.add_argument('--full', dest='full', action='store_true')
+    parser.add_argument('--stats', dest='stats', default='runner-stats.json',
+                        help="file to record the results in")
+
+    args = parser.parse_args()
+
+    names = args.scraper_names or discover_scrapers()
+    dates = {}
+    for field in ('from_date', 'to_date'):
+        if getattr(args, field) is not None:
+            dates[field] = datetime.strptime(getattr(args, field), "%Y-%m-%d")
+
+    results = run_scrapers(names, args.jobs, args.timeout, use_local=args.use_local, max_age=args.max_age,
+                           no_cache=args.no_cache, full=args.full, **dates)
+
+    print "%-20s %-8s %9s %7s %8s" % ('scraper', 'status', 'duration', 'events', 'fetches')
+    for result in results:
+        fetches = sum(result['fetch_counts'].values()) if 'fetch_counts' in result else '-'
+        print "%-20s %-8s %8.1fs %7s %8s" % (result['name'], result['status'], result['duration'],
+                                             result.get('events', '-'), fetches)
+        if 'error' in result:
+            print "    %s (see %s.log)" % (result['error'], result['name'])
+
+    with open(args.stats, 'w') as f:
+        json.dump({ 'finished' : time.time(), 'results' : results }, f, indent=1)
+
+    if any(result['status'] != 'ok' for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,117 @@
 # Screenscraper infrastructure
 import json
+import errno
 import sys
 import os
 import imp
 import re
 import hashlib
-from datetime import datetime, date, time
-from argparse import ArgumentParser
-from urllib2 import urlopen
+import threading
+import time as timer
+import urlparse
+import Queue
+from contextlib import contextmanager
+from datetime import datetime, date, time, timedelta
+from argparse import ArgumentParser, ArgumentTypeError
+from bs4 import BeautifulSoup, SoupStrainer
+from connectionpool import ConnectionPool
+from fetchcache import FetchCache
+from crawlstate import CrawlState
+from sinks import ListSink, JSONArraySink, JSONLinesSink
+
+# lxml is much faster than Python's HTML parser, so use it if it is installed
+try:
+    import lxml
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
 
 class ScraperBase(object):
     """Base class for screenscraper implementations"""
-    scraped_events = []
-    
     # Default venue and category that can be set by derived class
     venue = None
     category = None
 
-    def __init__(self):
-        pass
+    # Test/debug data modes (see README)
+    use_local_data = False
+    save_local_data = False
+
+    # Limits for fetching: threads used by fetch_many() and map_concurrent(), concurrent
+    # requests to one host and minimum number of seconds between starting requests to one host
+    max_workers = 8
+    max_per_host = 2
+    host_delay = 0.5
+
+    # Socket timeout for requests, in seconds
+    fetch_timeout = 60
+
+    # Whether to keep copies of fetched pages (in <name>.fetchcache) and re-request them
+    # with If-None-Match/If-Modified-Since
+    use_fetch_cache = True
+
+    # Pages fetched less than this many seconds ago are taken from the fetch cache without
+    # asking the server (None to always ask)
+    cache_max_age = None
 
-    def add_event(self, name, description, occurrences, origin_key=None, venue=None, category=None, website=None, ticket_website=None, ticket_details=None, description_is_html=False):
+    # Maximum size of the fetch cache, in bytes of compressed pages
+    fetch_cache_size = 50 * 1024 * 1024
+
+    # Parser used by parse() (None for DEFAULT_PARSER), and whether to only build the parts
+    # of pages scrapers ask for
+    parser = None
+    targeted_parsing = True
+
+    # Whether fetch_items() remembers items between runs (in <name>.crawlstate) and only
+    # fetches the pages of new ones and those fetched more than crawl_refresh_age seconds
+    # ago. Items not listed for crawl_state_expiry seconds are forgotten.
+    use_crawl_state = True
+    crawl_refresh_age = 7 * 24 * 60 * 60
+    crawl_state_expiry = 90 * 24 * 60 * 60
+
+    # Fetch and process every item's page, still updating the crawl state (scraper.py --full)
+    full_crawl = False
+
+    def __init__(self):
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self.fetch_counts = { 'network' : 0, 'not modified' : 0, 'cache' : 0, 'local' : 0 }
+        self.parse_time = 0.0
+        self._counts_lock = threading.Lock()
+        self.connections = ConnectionPool(timeout=self.fetch_timeout)
+        self._fetch_cache = None
+        self._crawl_state = None
+        self._item_events = None
+
+        # Events go to the sink as they are scraped (see sinks.py)
+        self.sink = ListSink()
+        self.event_count = 0
+
+        # Events with an origin key already passed to the sink are dropped
+        self._origin_keys = set()
+        self.duplicate_count = 0
+        self._events_lock = threading.Lock()
+
+    @property
+    def scraped_events(self):
+        """List of the events scraped so far, if they are being kept in a ListSink"""
+        if not isinstance(self.sink, ListSink):
+            raise AttributeError("scraped events are not kept when using %s" % type(self.sink).__name__)
+        return self.sink.events
+
+    def add_event(self, name, description, occurrences, origin_key=None, venue=None, category=None, website=None, ticket_website=None, ticket_details=None, description_is_html=False, recurrences=None):
         """
-        Constructs an event record and adds it to the scraped_events array
+        Constructs an event record and passes it to the sink
 
         Name, description and occurrences are required. Occurrences should be a list of
-        dictionaries created with occurrence(). If venue or category is not specified
-        the default (self.venue/self.category) is used.
+        dictionaries created with occurrence(); an event happening every day or week can
+        instead have an empty list of occurrences and a list of recurrences created with
+        recurrence(). If venue or category is not specified the default
+        (self.venue/self.category) is used.
         """
         assert name is not None
         assert description is not None
         assert occurrences is not None
+        assert len(occurrences) > 0 or recurrences
 
         new_event = { 'name' : name,
                       'description' : description, 
@@ -50,6 +131,7 @@ class ScraperBase(object):
         else:
             new_event['category'] = category
 
+        if recurrences: new_event['recurrences'] = recurrences
         if website is not None: new_event['website'] = website
         if ticket_website is not None: new_event['ticket_website'] = ticket_website
         if ticket_details is not None: new_event['ticket_details'] = ticket_details
@@ -62,7 +144,22 @@ class ScraperBase(object):
                 origin_key = sha1.hexdigest()
             new_event['origin_key'] = origin_key
 
-        self.scraped_events += [new_event]
+        # Remember the events found on an item's page (see fetch_items())
+        if self._item_events is not None:
+            self._item_events.append(new_event)
+
+        self._emit(new_event)
+
+    def _emit(self, event):
+        with self._events_lock:
+            if 'origin_key' in event:
+                if event['origin_key'] in self._origin_keys:
+                    self.duplicate_count += 1
+                    return
+                self._origin_keys.add(event['origin_key'])
+
+            self.sink.add(event)
+            self.event_count += 1
 
     def occurrence(self, start_date, start_time=None, end_date=None, end_time=None):
         """
@@ -95,6 +192,33 @@ class ScraperBase(object):
 
         return new_occurrence
 
+    def recurrence(self, start_date, end_date, start_time, end_time=None, weekly=False, exceptions=None):
+        """
+        Construct a recurrence record for an event happening every day (or with weekly
+        set, every week on the weekday of start_date) from start_date to end_date, at
+        start_time (until end_time, if given). exceptions is an optional list of dates
+        on which the event doesn't happen.
+
+        Returns a dictionary which can be JSON-serialized as part of an event record.
+        """
+        assert start_date is not None
+        assert end_date is not None
+        assert start_time is not None
+
+        new_recurrence = { 'frequency' : 'weekly' if weekly else 'daily',
+                           'start_date' : start_date.strftime("%Y-%m-%d"),
+                           'end_date' : end_date.strftime("%Y-%m-%d"),
+                           'start_time' : start_time.strftime("%H:%M"),
+                         }
+
+        if end_time is not None:
+            new_recurrence['end_time'] = end_time.strftime("%H:%M")
+
+        if exceptions:
+            new_recurrence['exceptions'] = sorted(d.strftime("%Y-%m-%d") for d in exceptions)
+
+        return new_recurrence
+
     def scrape(self, from_date, to_date):
         """
         Perform screenscraping (must be overridden by implementation class)
@@ -102,8 +226,7 @@ class ScraperBase(object):
         from_date/to_date are optional and are time range hints. It's OK to return events from
         outside this range if available and does not require any more requests.
 
-        The override method should add any events it has discovered into self.scraped_events.
-        The easiest way of doing this is by calling add_event().
+        The override method should call add_event() for each event it discovers.
         """
         raise NotImplementedError("Derived scraper class must implement scrape()!")
 
@@ -115,61 +238,354 @@ class ScraperBase(object):
         # get rid of problematic characters; deal with urlencoded special characters
         url_cleaned = re.sub('[^\w\d.]+|%[0-9a-fA-F]{2}', '_', url)
 
-        # create directory for test data to live in, if required
-        if not os.path.exists(self.name + '.testdata'):
+        # create directory for test data to live in, if required (concurrent fetches may
+        # race to do this)
+        try:
             os.mkdir(self.name + '.testdata')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
         return os.path.join(self.name + '.testdata', url_cleaned)
 
     def fetch(self, url, description=None):
+        if description is None:
+            label = url
+        else:
+            label = "%s (%s)" % (url, description)
+
         if not self.use_local_data:
-            if description is None:
-                print "Retrieving %s..." % url,
+            data, source = self.fetch_remote(url)
+            if source == 'cache':
+                status = "fresh copy in fetch cache"
+            elif source == 'not modified':
+                status = "not modified, using stored copy"
             else:
-                print "Retrieving %s (%s)..." % (url,description),
-
-            data = urlopen(url).read()
-            print "got %d bytes" % len(data),
+                status = "got %d bytes" % len(data)
 
             if self.save_local_data:
                 with open(self.make_local_filename(url), "w") as f:
                     f.write(data)
-                    print " (saved to local store)"
+                print "Retrieved %s: %s (saved to local store)" % (label, status)
             else:
-                print ""
+                print "Retrieved %s: %s" % (label, status)
 
         else:
             data = open(self.make_local_filename(url)).read()
-            if description is None:
-                print "Retrieved %s from local store" % url
-            else:
-                print "Retrieved %s (%s) from local store" % (url,description)
+            source = 'local'
+            print "Retrieved %s from local store" % label
+
+        with self._counts_lock:
+            self.fetch_counts[source] += 1
 
         return data
 
-    def get_month_list(self, from_date, to_date):
-        if from_date is None:
-            from_date = datetime.today()
-        if to_date is None:
-            to_date = datetime.today()
-
-        month = from_date.month
-        year = from_date.year
-        months = []
-
-        while month <= to_date.month and year <= to_date.year:
-            months += [ (month,year) ]
-            if month == 12:
-                month = 1
-                year += 1
+    @property
+    def fetch_cache(self):
+        """The FetchCache of pages fetched before (None if it is disabled)"""
+        if self._fetch_cache is None and self.use_fetch_cache:
+            self._fetch_cache = FetchCache(self.name + '.fetchcache', self.fetch_cache_size)
+        return self._fetch_cache
+
+    def fetch_remote(self, url):
+        """
+        Requests url from the server over a kept-alive connection, conditionally if we have
+        a stored copy, or not at all if the stored copy is newer than cache_max_age.
+        Returns a tuple (data, source) where source is 'network', 'not modified' or
+        'cache'.
+        """
+        cache = self.fetch_cache
+        entry = cache.get(url) if cache is not None else None
+
+        if entry is not None and cache.is_fresh(entry, self.cache_max_age):
+            return cache.body(url), 'cache'
+
+        headers = {}
+        if entry is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        with self.host_slot(url):
+            status, response_headers, data = self.connections.request(url, headers)
+
+        if status == 304 and entry is not None:
+            cache.touch(url)
+            return cache.body(url), 'not modified'
+
+        if cache is not None:
+            cache.put(url, data, response_headers.getheader('etag'), response_headers.getheader('last-modified'))
+
+        return data, 'network'
+
+    @property
+    def crawl_state(self):
+        """
+        The CrawlState recording items from previous runs (None if it is disabled, or
+        when using or saving test data)
+        """
+        if self._crawl_state is None and self.use_crawl_state and not (self.use_local_data or self.save_local_data):
+            self._crawl_state = CrawlState(self.name + '.crawlstate', self.crawl_state_expiry)
+        return self._crawl_state
+
+    def fetch_items(self, items, label='item'):
+        """
+        Fetches the detail pages of a list of (item ID, URL) tuples concurrently (see
+        fetch_many()) and yields (item ID, URL, data) for each one the scraper needs to
+        process. Call add_event() for the events on each page before taking the next.
+
+        Using the crawl state, pages of items seen on earlier runs are only fetched once
+        they are more than crawl_refresh_age seconds old, and only yielded if they have
+        changed; otherwise the events found on them last time are passed to the sink
+        again without fetching or parsing anything.
+        """
+        state = self.crawl_state
+        items = list(items)
+
+        to_fetch = []
+        for item_id, url in items:
+            if state is None or self.full_crawl or state.needs_fetch(item_id, self.crawl_refresh_age):
+                to_fetch.append((item_id, url))
             else:
-                month += 1
+                state.seen(item_id)
+                self._add_recorded_events(state.get(item_id))
+
+        if state is not None and len(to_fetch) < len(items):
+            print "Skipping %d of %d %ss fetched in the last %d hours" % (len(items) - len(to_fetch), len(items), label, self.crawl_refresh_age // 3600)
+
+        item_id_for_url = dict((url, item_id) for item_id, url in to_fetch)
+        descriptions = ["%s %d/%d" % (label, i + 1, len(to_fetch)) for i in range(len(to_fetch))]
+
+        for url, data in self.fetch_many([url for item_id, url in to_fetch], descriptions):
+            item_id = item_id_for_url[url]
+            if state is None:
+                yield item_id, url, data
+                continue
+
+            digest = hashlib.sha1(data).hexdigest()
+            entry = state.get(item_id)
+            if entry is not None and entry['sha1'] == digest and not self.full_crawl:
+                state.touch(item_id)
+                state.seen(item_id)
+                self._add_recorded_events(entry)
+                continue
+
+            # Only record the item once the scraper has finished with it, so a failure
+            # part way through doesn't leave it with some of its events missing
+            self._item_events = []
+            yield item_id, url, data
+            state.record(item_id, digest, self._item_events)
+            self._item_events = None
+
+    def _add_recorded_events(self, entry):
+        for event in entry['events']:
+            self._emit(event)
+
+    def close(self):
+        """
+        Closes the event sink and kept-alive connections, and saves the fetch cache index
+        and crawl state
+        """
+        self.sink.close()
+        self.connections.close()
+        if self._fetch_cache is not None:
+            self._fetch_cache.save()
+        if self._crawl_state is not None:
+            self._crawl_state.save()
+
+    @contextmanager
+    def host_slot(self, url):
+        """
+        Waits until a request to url's host is allowed by max_per_host and host_delay,
+        and holds one of the host's slots until the block exits
+        """
+        host = urlparse.urlsplit(url).netloc.lower()
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = { 'slots' : threading.BoundedSemaphore(self.max_per_host),
+                                      'lock' : threading.Lock(),
+                                      'last_start' : 0 }
+            state = self._hosts[host]
+
+        with state['slots']:
+            with state['lock']:
+                wait = state['last_start'] + self.host_delay - timer.time()
+                if wait > 0:
+                    timer.sleep(wait)
+                state['last_start'] = timer.time()
+            yield
+
+    def fetch_many(self, urls, descriptions=None):
+        """
+        Fetches a list of URLs concurrently using up to max_workers threads, observing the
+        per-host limits. Yields (url, data) tuples in the order the responses arrive; if
+        a request fails, its exception is raised when its turn comes.
 
-        return months
+        descriptions is an optional list of descriptions for the log, as for fetch().
+        With use_local_data set the pages are read from the local store one at a time.
+        """
+        urls = list(urls)
+        if descriptions is None:
+            descriptions = [None] * len(urls)
+
+        for (url, description), data in self.map_concurrent(lambda task: self.fetch(*task), zip(urls, descriptions)):
+            yield url, data
+
+    def map_concurrent(self, func, items):
+        """
+        Calls func(item) for each item in a list using up to max_workers threads, and
+        yields (item, result) tuples in the order they finish; if a call fails, its
+        exception is raised when its turn comes. Requests made by func are subject to the
+        per-host limits. With use_local_data set the calls are made one at a time, in order.
+        """
+        items = list(items)
+        if self.use_local_data or self.max_workers <= 1 or len(items) <= 1:
+            for item in items:
+                yield item, func(item)
+            return
+
+        tasks = Queue.Queue()
+        for item in items:
+            tasks.put(item)
+        results = Queue.Queue()
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    item = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    results.put((item, func(item), None))
+                except Exception:
+                    results.put((item, None, sys.exc_info()))
+
+        for i in range(min(self.max_workers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for i in range(len(items)):
+                # Poll so that Ctrl-C still works while we wait
+                while True:
+                    try:
+                        item, result, exc_info = results.get(True, 0.5)
+                        break
+                    except Queue.Empty:
+                        pass
+
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield item, result
+        finally:
+            # Don't start any more calls if we finish early
+            stop.set()
+
+    def parse(self, data, *args, **kwargs):
+        """
+        Parses a page and returns the BeautifulSoup tree. Any arguments are passed to
+        SoupStrainer to select the tags the scraper needs, and only those tags (with their
+        contents) are built into the tree; for example parse(data, 'article', class_='event').
+        """
+        parse_only = None
+        if self.targeted_parsing and (len(args) > 0 or len(kwargs) > 0):
+            # While parsing, the class attribute is still a single string rather than a
+            # list of classes, so make class_='foo' match class="foo bar" as find() would
+            class_ = kwargs.get('class_')
+            if isinstance(class_, basestring) and ' ' not in class_:
+                kwargs['class_'] = re.compile(r'(^|\s)%s(\s|$)' % re.escape(class_))
+            parse_only = SoupStrainer(*args, **kwargs)
+
+        start = timer.time()
+        soup = BeautifulSoup(data, self.parser or DEFAULT_PARSER, parse_only=parse_only)
+        with self._counts_lock:
+            self.parse_time += timer.time() - start
+        return soup
+
+    def get_month_list(self, from_date, to_date):
+        """Returns a list of (month, year) tuples for each month from from_date to to_date"""
+        return [(start.month, start.year) for start, end in date_windows(from_date, to_date)]
 
     def to_json(self):
         return json.dumps(self.scraped_events, separators=(',', ':'))
 
+def parse_age(value):
+    """Parses an age such as '3600' (seconds), '30m', '6h' or '2d' into seconds"""
+    mo = re.match(r'^(\d+)([smhd]?)$', value.strip())
+    if mo is None:
+        raise ArgumentTypeError("invalid age '%s'" % value)
+    return int(mo.group(1)) * { '' : 1, 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400 }[mo.group(2)]
+
+def _as_date(value):
+    if value is None:
+        return date.today()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def date_windows(from_date, to_date, months=1, days=None):
+    """
+    Splits the range from from_date to to_date (dates or datetimes, today if None) into
+    a list of (start, end) date tuples, both inclusive. By default each window is one
+    calendar month (the first and last clipped to the range); with days set, windows
+    are that many days long, starting from from_date.
+    """
+    from_date = _as_date(from_date)
+    to_date = _as_date(to_date)
+
+    windows = []
+    start = from_date
+    while start <= to_date:
+        if days is not None:
+            next_start = start + timedelta(days=days)
+        else:
+            month_index = start.year * 12 + start.month - 1 + months
+            next_start = date(month_index // 12, month_index % 12 + 1, 1)
+
+        windows.append((start, min(next_start - timedelta(days=1), to_date)))
+        start = next_start
+
+    return windows
+
+def load_scraper(name):
+    """Loads the scraper implementation in <name>.py and returns an instance of it"""
+    mod = imp.load_source('scraper_module_' + name, name + '.py')
+    scraper = mod.get_scraper()
+    scraper.name = name
+    return scraper
+
+def run_scraper(scraper, from_date=None, to_date=None, save_local=False, jsonl=False):
+    """
+    Runs a scraper and writes the events to <name>.json as they are scraped (or to
+    <name>.jsonl, one per line, with jsonl set). The file is only replaced if the scraper
+    finishes successfully. With save_local it just saves test data.
+    """
+    if save_local:
+        try:
+            scraper.get_test_data(from_date, to_date)
+        finally:
+            scraper.close()
+        return
+
+    filename = scraper.name + (".jsonl" if jsonl else ".json")
+    try:
+        with open(filename + ".tmp", "w") as f:
+            scraper.sink = JSONLinesSink(f) if jsonl else JSONArraySink(f)
+            try:
+                scraper.scrape(from_date, to_date)
+            finally:
+                scraper.close()
+            if scraper.duplicate_count > 0:
+                print "Dropped %d events with repeated origin keys" % scraper.duplicate_count
+    except:
+        os.remove(filename + ".tmp")
+        raise
+    os.rename(filename + ".tmp", filename)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('scraper_name')
@@ -177,23 +593,35 @@ def main():
     parser.add_argument('--save-test', '-s', dest='save_local', action='store_true')
     parser.add_argument('--from-date', '-F', dest='from_date')
     parser.add_argument('--to-date', '-T', dest='to_date')
+    parser.add_argument('--max-age', '-m', dest='max_age', type=parse_age,
+                        help="use pages fetched less than this long ago (e.g. 3600, 30m, 6h, 2d) without asking the server")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help="don't use or update the fetch cache")
+    parser.add_argument('--jsonl', dest='jsonl', action='store_true',
+                        help="write events to name.jsonl, one per line, instead of name.json")
+    parser.add_argument('--full', dest='full', action='store_true',
+                        help="fetch every item's page, not just new or stale ones")
 
     args = parser.parse_args()
 
-    filename = args.scraper_name + '.py'
-
     try:
-        mod = imp.load_source('scraper_module', filename)
+        scraper = load_scraper(args.scraper_name)
     except IOError:
-        print "Could not find scraper implementation file '%s'" % filename
+        print "Could not find scraper implementation file '%s'" % (args.scraper_name + '.py')
         return
 
-    scraper = mod.get_scraper()
-    
     # Test/debug data
-    scraper.name = args.scraper_name
     scraper.use_local_data = args.use_local
 
+    # Fetch cache
+    if args.max_age is not None:
+        scraper.cache_max_age = args.max_age
+    if args.no_cache:
+        scraper.use_fetch_cache = False
+
+    # Crawl state
+    scraper.full_crawl = args.full
+
     # Date range
     if args.from_date is not None:
         from_date = datetime.strptime(args.from_date, "%Y-%m-%d")
@@ -205,13 +633,7 @@ def main():
     else:
         to_date = None
 
-    if not args.save_local:
-        scraper.scrape(from_date, to_date)
-        json = scraper.to_json()
-        with open(args.scraper_name + ".json", "w") as f:
-            f.write(json)
-    else:
-        scraper.get_test_data(from_date, to_date)
+    run_scraper(scraper, from_date, to_date, args.save_local, args.jsonl)
 
 if __name__ == '__main__':
     main()
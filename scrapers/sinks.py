@@ -0,0 +1,44 @@
+# Destinations for scraped events
+#
+# A sink has an add(event) method, called by ScraperBase.add_event() for each event as it
+# is scraped, and a close() method called when the scraper has finished.
+import json
+
+class ListSink(object):
+    """Keeps events in a list (ScraperBase.to_json() uses this)"""
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+class JSONArraySink(object):
+    """Writes events to a file as a JSON array, one at a time"""
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.f.write('[')
+
+    def add(self, event):
+        if self.count > 0:
+            self.f.write(',')
+        self.f.write(json.dumps(event, separators=(',', ':')))
+        self.count += 1
+
+    def close(self):
+        self.f.write(']')
+        self.f.flush()
+
+class JSONLinesSink(object):
+    """Writes events to a file with one JSON object per line"""
+    def __init__(self, f):
+        self.f = f
+
+    def add(self, event):
+        self.f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self.f.flush()
@@ -2,17 +2,20 @@
 from scraper import ScraperBase
 from datetime import datetime, timedelta
 
+# Made-up events for testing, so runner.py only runs this scraper when it is named
+discover = False
+
 class TestDataScraper(ScraperBase):
-    def scrape(self):
+    def scrape(self, from_date=None, to_date=None):
         self.venue = 'Test Venue'
         self.category = 'Gigs'
 
-        self.add_event(name='Event 1', description='Details of event 1', occurrences=[self.occurrence(datetime.now() + timedelta(days=1))])
-        self.add_event(name='Event 2', description='Details of event 2', occurrences=[self.occurrence(datetime.now() + timedelta(days=8)),
+        self.add_event(name='Event 1', origin_key='1', description='Details of event 1', occurrences=[self.occurrence(datetime.now() + timedelta(days=1))])
+        self.add_event(name='Event 2', origin_key='2', description='Details of event 2', occurrences=[self.occurrence(datetime.now() + timedelta(days=8)),
                                                                                       self.occurrence(datetime.now() + timedelta(days=15)),
                                                                                       self.occurrence(datetime.now() - timedelta(days=3))] )
 
-        self.add_event(name='Event 3', description='Details of event 3', website='http://website/', ticket_website='http://ticket-website/', 
+        self.add_event(name='Event 3', origin_key='3', description='Details of event 3', website='http://website/', ticket_website='http://ticket-website/', 
                        ticket_details=u'£4-6 advance, £8-10 on the door', occurrences=[self.occurrence(datetime.now() + timedelta(days=4))])
 
 def get_scraper(*args): # factory method
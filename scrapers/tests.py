@@ -0,0 +1,345 @@
+# Tests for the scraper infrastructure. Run with "python tests.py" in this directory.
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import date, datetime, timedelta
+
+from fetchcache import FetchCache
+from runner import discover_scrapers
+from scraper import ScraperBase, date_windows
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestServer(object):
+    """
+    HTTP/1.1 server on localhost in a background thread, serving pages from a
+    dictionary of path => (body, ETag or None) and answering If-None-Match with 304.
+    Each request is recorded as a (client address, path, headers) tuple in requests.
+    """
+    def __init__(self, pages=None):
+        self.pages = pages if pages is not None else {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append((self.client_address, self.path, self.headers))
+                if self.path not in server.pages:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body, etag = server.pages[self.path]
+                if etag is not None and self.headers.getheader('if-none-match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadedHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+    def connection_count(self):
+        """Number of different connections requests arrived on"""
+        return len(set(address for address, path, headers in self.requests))
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TestScraper(ScraperBase):
+    host_delay = 0
+
+    def __init__(self, directory):
+        ScraperBase.__init__(self)
+        self.name = os.path.join(directory, 'test')
+
+class ItemScraper(TestScraper):
+    """Scraper adding an event for each of a list of item pages, using fetch_items()"""
+    use_fetch_cache = False
+
+    def __init__(self, directory, items):
+        TestScraper.__init__(self, directory)
+        self.items = items
+        self.processed = []
+
+    def scrape(self, from_date, to_date):
+        for item_id, url, data in self.fetch_items(self.items):
+            self.processed.append(item_id)
+            self.add_event(data, '', [self.occurrence(date(2013, 10, 1))], origin_key=item_id)
+
+class ScraperTestCase(unittest.TestCase):
+    """Runs each test with a server, a directory for the scrapers' files and the log discarded"""
+    def setUp(self):
+        self.server = TestServer()
+        self.directory = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+        self.server.close()
+
+    def make_scraper(self, **kwargs):
+        scraper = TestScraper(self.directory)
+        for key, value in kwargs.items():
+            setattr(scraper, key, value)
+        return scraper
+
+class ConnectionTest(ScraperTestCase):
+    def setUp(self):
+        super(ConnectionTest, self).setUp()
+        for i in range(10):
+            self.server.pages['/page/%d' % i] = ('Page %d' % i, '"v%d"' % i)
+
+    def test_connection_reused(self):
+        scraper = self.make_scraper(use_fetch_cache=False)
+        for i in range(5):
+            self.assertEqual(scraper.fetch(self.server.url('/page/%d' % i)), 'Page %d' % i)
+        scraper.close()
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connection_count(), 1)
+
+    def test_concurrent_fetches_share_connections(self):
+        scraper = self.make_scraper(use_fetch_cache=False, max_per_host=2)
+        urls = [self.server.url('/page/%d' % i) for i in range(10)]
+        self.assertEqual(sorted(scraper.fetch_many(urls)), sorted((url, 'Page %d' % i) for i, url in enumerate(urls)))
+        scraper.close()
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertTrue(self.server.connection_count() <= 2)
+
+    def test_conditional_get(self):
+        url = self.server.url('/page/1')
+        scraper = self.make_scraper()
+        self.assertEqual(scraper.fetch(url), 'Page 1')
+        scraper.close()
+        self.assertEqual(scraper.fetch_counts['network'], 1)
+
+        # Unchanged: answered from the stored copy
+        scraper = self.make_scraper()
+        self.assertEqual(scraper.fetch(url), 'Page 1')
+        scraper.close()
+        self.assertEqual(self.server.requests[-1][2].getheader('if-none-match'), '"v1"')
+        self.assertEqual(scraper.fetch_counts['not modified'], 1)
+
+        # Changed
+        self.server.pages['/page/1'] = ('Page 1 again', '"v1.1"')
+        scraper = self.make_scraper()
+        self.assertEqual(scraper.fetch(url), 'Page 1 again')
+        scraper.close()
+        self.assertEqual(scraper.fetch_counts['network'], 1)
+
+    def test_save_local_data(self):
+        # The fetches race to create the test data directory
+        scraper = self.make_scraper(save_local_data=True, max_per_host=10, max_workers=10)
+        urls = [self.server.url('/page/%d' % i) for i in range(10)]
+        list(scraper.fetch_many(urls))
+        scraper.close()
+
+        scraper = self.make_scraper(use_local_data=True)
+        self.assertEqual(sorted(scraper.fetch_many(urls)), sorted((url, 'Page %d' % i) for i, url in enumerate(urls)))
+        self.assertEqual(scraper.fetch_counts['local'], 10)
+
+class FetchCacheTest(ScraperTestCase):
+    def test_max_age(self):
+        self.server.pages['/page'] = ('Page', None)
+        url = self.server.url('/page')
+        scraper = self.make_scraper()
+        scraper.fetch(url)
+        scraper.close()
+
+        # Fresh enough: no request at all
+        scraper = self.make_scraper(cache_max_age=3600)
+        self.assertEqual(scraper.fetch(url), 'Page')
+        scraper.close()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(scraper.fetch_counts['cache'], 1)
+
+        # Too old, and no validators to make the request conditional
+        cache = FetchCache(os.path.join(self.directory, 'test.fetchcache'))
+        cache.index[url]['fetched'] -= 7200
+        cache.changed = True
+        cache.save()
+        scraper = self.make_scraper(cache_max_age=3600)
+        scraper.fetch(url)
+        scraper.close()
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(scraper.fetch_counts['network'], 1)
+
+        cache = FetchCache(os.path.join(self.directory, 'test.fetchcache'))
+        entry = cache.get(url)
+        self.assertTrue(cache.is_fresh(entry, 60))
+        self.assertFalse(cache.is_fresh(entry, None))
+
+    def test_lru_eviction(self):
+        directory = os.path.join(self.directory, 'cache')
+        bodies = dict((name, os.urandom(1000)) for name in 'abc')
+        cache = FetchCache(directory)
+        for name in 'abc':
+            cache.put(name, bodies[name])
+        cache.put('a copy', bodies['a'])
+        cache.save()
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'objects'))), 3)
+
+        # Room for all but one body: b was used least recently
+        cache = FetchCache(directory, max_size=cache.size() - cache.index['b']['size'])
+        for url, used in (('b', 1), ('a', 2), ('c', 3), ('a copy', 4)):
+            cache.index[url]['used'] = used
+        cache.save()
+        cache = FetchCache(directory)
+        self.assertEqual(sorted(cache.index), ['a', 'a copy', 'c'])
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'objects'))), 2)
+
+        # Room for one: dropping a doesn't free its body, which a copy still uses
+        cache = FetchCache(directory, max_size=cache.index['a']['size'])
+        for url, used in (('a', 1), ('c', 2), ('a copy', 3)):
+            cache.index[url]['used'] = used
+        cache.save()
+        cache = FetchCache(directory)
+        self.assertEqual(sorted(cache.index), ['a copy'])
+        self.assertEqual(cache.body('a copy'), bodies['a'])
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'objects'))), 1)
+
+class CrawlStateTest(ScraperTestCase):
+    def setUp(self):
+        super(CrawlStateTest, self).setUp()
+        self.items = []
+        for i in range(3):
+            self.server.pages['/event/%d' % i] = ('Event %d' % i, None)
+            self.items.append((str(i), self.server.url('/event/%d' % i)))
+
+    def crawl(self, **kwargs):
+        """Runs an ItemScraper; returns the items processed and the events' names"""
+        scraper = ItemScraper(self.directory, self.items)
+        for key, value in kwargs.items():
+            setattr(scraper, key, value)
+        scraper.scrape(None, None)
+        scraper.close()
+        return sorted(scraper.processed), sorted(event['name'] for event in scraper.scraped_events)
+
+    def test_unchanged_items_skipped(self):
+        all_events = ['Event 0', 'Event 1', 'Event 2']
+        self.assertEqual(self.crawl(), (['0', '1', '2'], all_events))
+        self.assertEqual(len(self.server.requests), 3)
+
+        # Seen recently: not fetched, events recorded last time output again
+        self.assertEqual(self.crawl(), ([], all_events))
+        self.assertEqual(len(self.server.requests), 3)
+
+        # Fetched again, but only the changed page is processed
+        self.server.pages['/event/1'] = ('Event 1 changed', None)
+        self.assertEqual(self.crawl(crawl_refresh_age=0), (['1'], ['Event 0', 'Event 1 changed', 'Event 2']))
+        self.assertEqual(len(self.server.requests), 6)
+
+        self.assertEqual(self.crawl(full_crawl=True), (['0', '1', '2'], ['Event 0', 'Event 1 changed', 'Event 2']))
+        self.assertEqual(len(self.server.requests), 9)
+
+    def test_new_items_fetched(self):
+        self.crawl()
+        self.server.pages['/event/3'] = ('Event 3', None)
+        self.items.append(('3', self.server.url('/event/3')))
+        self.assertEqual(self.crawl(), (['3'], ['Event 0', 'Event 1', 'Event 2', 'Event 3']))
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_not_used_with_test_data(self):
+        self.crawl(save_local_data=True)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'test.crawlstate')))
+
+class DateWindowsTest(unittest.TestCase):
+    def assertContiguous(self, windows, from_date, to_date):
+        self.assertEqual(windows[0][0], from_date)
+        self.assertEqual(windows[-1][1], to_date)
+        for (start, end), (next_start, next_end) in zip(windows, windows[1:]):
+            self.assertTrue(start <= end)
+            self.assertEqual(next_start, end + timedelta(days=1))
+
+    def test_months_across_year_end(self):
+        windows = date_windows(date(2013, 11, 15), date(2014, 2, 3))
+        self.assertEqual(windows, [(date(2013, 11, 15), date(2013, 11, 30)),
+                                   (date(2013, 12, 1), date(2013, 12, 31)),
+                                   (date(2014, 1, 1), date(2014, 1, 31)),
+                                   (date(2014, 2, 1), date(2014, 2, 3))])
+        self.assertEqual(date_windows(datetime(2013, 11, 15, 20, 0), datetime(2014, 2, 3, 1, 0)), windows)
+
+        for months in (1, 2, 5, 12):
+            self.assertContiguous(date_windows(date(2013, 11, 15), date(2015, 2, 3), months=months),
+                                  date(2013, 11, 15), date(2015, 2, 3))
+
+    def test_days(self):
+        windows = date_windows(date(2013, 12, 25), date(2014, 1, 10), days=7)
+        self.assertEqual(windows, [(date(2013, 12, 25), date(2013, 12, 31)),
+                                   (date(2014, 1, 1), date(2014, 1, 7)),
+                                   (date(2014, 1, 8), date(2014, 1, 10))])
+
+    def test_single_day(self):
+        self.assertEqual(date_windows(date(2013, 12, 31), date(2013, 12, 31)), [(date(2013, 12, 31), date(2013, 12, 31))])
+        self.assertEqual(date_windows(date(2014, 1, 1), date(2013, 12, 31)), [])
+
+class DuplicateEventTest(unittest.TestCase):
+    def test_repeats_dropped_across_windows(self):
+        # Windows of a week overlapping by three days, each listing one event per day
+        scraper = TestScraper(tempfile.gettempdir())
+        windows = [(start, start + timedelta(days=9)) for start, end in date_windows(date(2013, 12, 1), date(2014, 1, 31), days=7)]
+
+        def list_window(window):
+            day = window[0]
+            while day <= window[1]:
+                scraper.add_event('Event', '', [scraper.occurrence(day)], origin_key=day.isoformat())
+                day += timedelta(days=1)
+
+        list(scraper.map_concurrent(list_window, windows))
+        days = sorted(event['occurrences'][0]['start_date'] for event in scraper.scraped_events)
+        self.assertEqual(len(days), len(set(days)))
+        self.assertEqual(days[0], '2013-12-01')
+        self.assertEqual(days[-1], windows[-1][1].isoformat())
+        self.assertEqual(scraper.duplicate_count, 10 * len(windows) - len(days))
+
+class DiscoverTest(unittest.TestCase):
+    def test_discover_scrapers(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = { 'venue.py' : 'def get_scraper():\n    pass\n',
+                      'fixture.py' : 'discover = False\n\ndef get_scraper():\n    pass\n',
+                      'helpers.py' : 'def parse_listing():\n    pass\n',
+                      'notes.txt' : 'def get_scraper():\n' }
+            for filename, source in files.items():
+                with open(os.path.join(directory, filename), 'w') as f:
+                    f.write(source)
+            self.assertEqual(discover_scrapers(directory), ['venue'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_repository_scrapers(self):
+        names = discover_scrapers(os.path.dirname(os.path.abspath(__file__)))
+        self.assertIn('portland', names)
+        self.assertNotIn('testdata', names)
+        self.assertNotIn('tests', names)
+
+if __name__ == '__main__':
+    unittest.main()